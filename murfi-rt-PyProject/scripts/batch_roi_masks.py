@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Rebuild the resting-state ROI masks of many participants, for any set of template networks
+
+Runs what the process_roi_masks step does, without the interactive parts, for every
+participant given, with one process per participant:
+
+    1. register the example func (median of rest run 1) to MNI and invert the registration
+    2. bring the template networks into native space (and melodic_IC, if the example func is
+       not isometric)
+    3. correlate every IC with every network template and select the strongest IC per network
+    4. weight each selected IC by its network mask and keep the top --num-voxels voxels
+    5. copy the masks to the participant's mask folder and project them back to MNI
+
+flirt / convert_xfm go through fsl_cache.py, so only registrations whose inputs changed are
+recomputed (e.g. after a template change only the template resampling runs again).
+Networks are given as NAME CORRELATION_TEMPLATE WEIGHT_TEMPLATE; a volume of a 4D
+correlation template is selected with #<volume> (1-based). Default: DMN and CEN, as in
+process_roi_masks. A QC summary with one row per participant and network is written as CSV.
+
+Usage (from the scripts folder):
+    python batch_roi_masks.py sub-mindbpd2001 sub-mindbpd2002 --workers 4 \
+        --network dmn template_networks.nii#1 DMNax_brainmaskero2.nii \
+        --network cen template_networks.nii#2 CENa_brainmaskero2.nii \
+        --network mpfc mpfc_template.nii mpfc_template.nii
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from build_roi_masks import NUM_VOXELS_DESIRED, build_mask
+from check_isometric import check_isometric
+from fsl_cache import cached_run, find_file, image_stem
+from ica_network_selection import (load_masked, masked_spatial_correlation, select_components, write_component,
+                                   write_fslcc_file)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SUBJECTS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'subjects')
+MNI_TEMPLATE = os.path.join(SCRIPT_DIR, 'MNI152_T1_2mm_brain')
+SES = 'ses-lo1'
+
+DEFAULT_NETWORKS = (
+    ('dmn', os.path.join(SCRIPT_DIR, 'template_networks.nii#1'), os.path.join(SCRIPT_DIR, 'DMNax_brainmaskero2.nii')),
+    ('cen', os.path.join(SCRIPT_DIR, 'template_networks.nii#2'), os.path.join(SCRIPT_DIR, 'CENa_brainmaskero2.nii')),
+)
+
+SUMMARY_COLUMNS = ['subject', 'ica_version', 'network', 'ic', 'correlation', 'nonzero_voxels', 'threshold',
+                   'mask_voxels', 'isometric', 'status']
+
+
+def split_volume(spec):
+    """'image.nii#2' -> ('image.nii', 2); 'image.nii' -> ('image.nii', None)"""
+    path, _, volume = spec.partition('#')
+    return path, int(volume) if volume else None
+
+
+def find_ica_directory(subj_dir):
+    """ICA folder, ICA version and melodic_IC image of a participant (multi-run ICA first)"""
+    multi_run = os.path.join(subj_dir, 'rest', 'rs_network.gica', 'groupmelodic.ica')
+    single_run = os.path.join(subj_dir, 'rest', 'rs_network.ica')
+    if os.path.isdir(multi_run):
+        return multi_run, 'multi_run', os.path.join(multi_run, 'melodic_IC.nii')
+    if os.path.isdir(os.path.join(single_run, 'filtered_func_data.ica')):
+        return single_run, 'single_run', os.path.join(single_run, 'filtered_func_data.ica', 'melodic_IC.nii')
+    raise FileNotFoundError(f"no ICA directory found in {subj_dir}/rest")
+
+
+def process_subject(subj, networks, num_voxels=NUM_VOXELS_DESIRED, subjects_dir=SUBJECTS_DIR):
+    """
+    Build the ROI masks of one participant
+
+    Parameters
+    ----------
+    subj : str
+        Participant ID (folder in subjects_dir)
+    networks : list of (name, correlation_template, weight_template)
+        Templates in MNI space; correlation_template may select a volume with #<volume>
+    num_voxels : int
+        Voxels per mask
+
+    Returns
+    -------
+    list of dict
+        One QC summary row per network
+    """
+    subj_dir = os.path.join(subjects_dir, subj)
+    cache_dir = os.path.join(subj_dir, 'xfm', 'cache')
+    ica_directory, ica_version, ic_file = find_ica_directory(subj_dir)
+    reg_dir = os.path.join(ica_directory, 'reg')
+    os.makedirs(reg_dir, exist_ok=True)
+
+    rest = os.path.join(subj_dir, 'rest', f'{subj}_{SES}_task-rest_run-01_bold_mcflirt_median_bet')
+    examplefunc = find_file(rest + '.nii', required=True)
+    examplefunc_mask = find_file(rest + '_mask.nii', required=True)
+
+    # register example func to MNI, then calculate the inverse to bring the templates to native space
+    example_func2mni_mat = os.path.join(reg_dir, 'example_func2mni.mat')
+    mni2example_func_mat = os.path.join(reg_dir, 'mni2example_func.mat')
+    cached_run(['flirt', '-in', examplefunc, '-ref', MNI_TEMPLATE, '-out', os.path.join(reg_dir, 'example_func2mni'),
+                '-omat', example_func2mni_mat], cache_dir)
+    cached_run(['convert_xfm', '-omat', mni2example_func_mat, '-inverse', example_func2mni_mat], cache_dir)
+
+    def to_native(image, out_path, *options):
+        cached_run(['flirt', '-in', image, '-ref', examplefunc, '-out', out_path, '-init', mni2example_func_mat,
+                    '-applyxfm'] + list(options), cache_dir)
+        return find_file(out_path, required=True)
+
+    native = {}
+    for template in sorted({split_volume(c)[0] for _, c, _ in networks} | {w for _, _, w in networks}):
+        stem = os.path.basename(image_stem(template))
+        native[template] = to_native(template, os.path.join(reg_dir, f'{stem}2example_func.nii'))
+
+    is_isometric, _ = check_isometric(examplefunc)
+    if not is_isometric:
+        ic_file = to_native(ic_file, os.path.join(ica_directory, 'melodic_IC_examplefunc.nii'), '-interp', 'trilinear')
+    ic_file = find_file(ic_file, required=True)
+
+    # correlate every IC with the correlation template of every network
+    mask = np.asanyarray(nib.load(examplefunc_mask).dataobj) != 0
+    ic_data = load_masked(ic_file, mask)
+    template_data, template_columns = {}, []
+    for _, correlation_template, _ in networks:
+        path, volume = split_volume(correlation_template)
+        if path not in template_data:
+            template_data[path] = load_masked(native[path], mask)
+        template_columns.append(template_data[path][:, (volume or 1) - 1])
+    correlations = masked_spatial_correlation(ic_data, np.column_stack(template_columns))
+    write_fslcc_file(correlations, os.path.join(ica_directory, 'template_rsn_correlations_with_ICs.txt'))
+    selection = select_components(correlations, {name: i + 1 for i, (name, _, _) in enumerate(networks)})
+
+    rows = []
+    mask_dir = os.path.join(subj_dir, 'mask')
+    os.makedirs(os.path.join(mask_dir, 'mni'), exist_ok=True)
+    for name, _, weight_template in networks:
+        ic_index, correlation = selection[name]
+        uthresh = os.path.join(ica_directory, f'{name}_uthresh.nii')
+        thresh = os.path.join(ica_directory, f'{name}_thresh.nii')
+        write_component(ic_file, ic_index, uthresh)
+        qc = build_mask(uthresh, native[weight_template], thresh, num_voxels, weighted_out=uthresh)
+
+        # copy to the participant's mask folder, and project back to MNI with the example func registration
+        shutil.copyfile(thresh, os.path.join(mask_dir, f'{name}_native_rest.nii'))
+        cached_run(['flirt', '-in', thresh, '-ref', MNI_TEMPLATE, '-out', os.path.join(mask_dir, 'mni', f'{name}_mni.nii'),
+                    '-init', example_func2mni_mat, '-applyxfm', '-interp', 'nearestneighbour'], cache_dir)
+
+        rows.append({'subject': subj, 'ica_version': ica_version, 'network': name, 'ic': ic_index + 1,
+                     'correlation': round(correlation, 4), 'nonzero_voxels': qc['nonzero_voxels'],
+                     'threshold': qc['threshold'] if qc['threshold'] is None else round(qc['threshold'], 6),
+                     'mask_voxels': qc['mask_voxels'], 'isometric': is_isometric,
+                     'status': 'ok' if qc['mask_voxels'] == num_voxels else f'only {qc["mask_voxels"]} voxels'})
+    return rows
+
+
+def _process_subject_safely(subj, networks, num_voxels, subjects_dir):
+    """process_subject for the pool: errors become a summary row instead of stopping the batch"""
+    try:
+        return process_subject(subj, networks, num_voxels, subjects_dir)
+    except Exception as e:
+        return [{'subject': subj, 'status': f'error: {e}'}]
+
+
+def run_batch(subjects, networks=DEFAULT_NETWORKS, num_voxels=NUM_VOXELS_DESIRED, subjects_dir=SUBJECTS_DIR,
+              workers=None, summary=None):
+    """
+    Build masks for all participants in a process pool
+
+    Returns
+    -------
+    list of dict
+        QC summary rows, in the order of `subjects`
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_subject_safely, subj, list(networks), num_voxels, subjects_dir)
+                   for subj in subjects]
+        rows = [row for future in futures for row in future.result()]
+
+    if summary:
+        with open(summary, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild ROI masks for many participants and networks')
+    parser.add_argument('subjects', nargs='+', help='Participant IDs (folders in ../subjects)')
+    parser.add_argument('--network', nargs=3, action='append',
+                        metavar=('NAME', 'CORRELATION_TEMPLATE', 'WEIGHT_TEMPLATE'),
+                        help='Network name, template to correlate ICs with (image or image#volume) '
+                             'and template to weight the selected IC with (default: DMN and CEN)')
+    parser.add_argument('--num-voxels', type=int, default=NUM_VOXELS_DESIRED,
+                        help=f'Number of voxels per mask (default: {NUM_VOXELS_DESIRED})')
+    parser.add_argument('--workers', type=int, default=None, help='Participants processed at once (default: cores)')
+    parser.add_argument('--summary', default=os.path.join(SUBJECTS_DIR, 'roi_mask_qc_summary.csv'),
+                        help='QC summary CSV (default: ../subjects/roi_mask_qc_summary.csv)')
+    args = parser.parse_args()
+
+    networks = DEFAULT_NETWORKS
+    if args.network:
+        networks = [(name, os.path.abspath(correlation), os.path.abspath(weight))
+                    for name, correlation, weight in args.network]
+
+    try:
+        rows = run_batch(args.subjects, networks, args.num_voxels, workers=args.workers, summary=args.summary)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+    for row in rows:
+        if 'network' in row:
+            print(f"{row['subject']} {row['network'].upper()}: IC {row['ic']} (r = {row['correlation']}), "
+                  f"{row['mask_voxels']} voxels, {row['status']}")
+        else:
+            print(f"{row['subject']}: {row['status']}")
+    print(f"QC summary written to {args.summary}")
+    if any(row['status'] != 'ok' for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Build fixed-size binary ROI masks from the selected ICA components
+
+Replaces the fslmaths -mul / fslstats -V / fslstats -P / fslmaths -thr -bin sequence of the
+process_roi_masks step. Each component is loaded once, weighted by its template network
+(so only voxels inside the template can be selected), and exactly the top num_voxels
+voxels are kept:
+
+    - voxels are ranked by weighted value, highest first; equal values are ranked by
+      flat voxel index (lowest first), so the selection is deterministic
+    - only positive voxels end up in the mask (as with fslmaths -bin)
+    - components with fewer than num_voxels non-zero voxels are binarised as they are
+
+Masks are written as short (int16) images, like fslmaths -odt short.
+
+Usage:
+    python build_roi_masks.py --num-voxels 2000 \
+        --network dmn dmn_uthresh.nii template_dmn2example_func.nii dmn_thresh.nii \
+        --network cen cen_uthresh.nii template_cen2example_func.nii cen_thresh.nii
+"""
+
+import argparse
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from fsl_cache import find_file
+
+NUM_VOXELS_DESIRED = 2000
+
+
+def top_n_mask(weights, num_voxels):
+    """
+    Binary mask of the num_voxels highest non-zero voxels
+
+    Parameters
+    ----------
+    weights : np.ndarray
+        Weighted component (any shape)
+    num_voxels : int
+        Number of voxels to select
+
+    Returns
+    -------
+    mask : np.ndarray of bool, same shape as weights
+    threshold : float or None
+        Value of the lowest selected voxel (None if no thresholding was needed)
+    """
+    flat = weights.ravel()
+    candidates = np.flatnonzero(flat)  # ascending flat index
+    values = flat[candidates]
+    selected = np.zeros(flat.shape, dtype=bool)
+
+    if len(candidates) < num_voxels:
+        selected[candidates] = values > 0
+        return selected.reshape(weights.shape), None
+
+    # value of the num_voxels-th highest voxel
+    kth = len(values) - num_voxels
+    threshold = values[np.argpartition(values, kth)[kth]]
+
+    # everything above the threshold, then ties at the threshold by lowest flat index
+    above = candidates[values > threshold]
+    ties = candidates[values == threshold][:num_voxels - len(above)]
+    selected[above] = True
+    selected[ties] = True
+    selected &= flat > 0
+    return selected.reshape(weights.shape), float(threshold)
+
+
+def build_mask(component_path, template_path, out_path, num_voxels=NUM_VOXELS_DESIRED, weighted_out=None):
+    """
+    Weight a component by its template and write the top-N voxel mask
+
+    Parameters
+    ----------
+    component_path : str
+        Unthresholded component (e.g. dmn_uthresh.nii)
+    template_path : str
+        Template network in the same space (e.g. template_dmn2example_func.nii)
+    out_path : str
+        Output mask (int16)
+    num_voxels : int
+        Number of voxels desired
+    weighted_out : str, optional
+        Also write the template-weighted component here (the shell wrote it back over the component)
+
+    Returns
+    -------
+    dict with voxel counts for QC
+    """
+    # not memory-mapped: the weighted component may be written back over the same file
+    component_img = nib.load(find_file(component_path, required=True), mmap=False)
+    weights = component_img.get_fdata(dtype=np.float32, caching='unchanged')
+    template = nib.load(find_file(template_path, required=True)).get_fdata(dtype=np.float32)
+    if template.shape != weights.shape:
+        raise ValueError(f"{template_path} has shape {template.shape}, {component_path} has shape {weights.shape}")
+
+    # zero out voxels not included in the template mask (so we only select voxels within the template network)
+    weights *= template
+    if weighted_out:
+        nib.save(nib.Nifti1Image(weights, component_img.affine, component_img.header), weighted_out)
+
+    mask, threshold = top_n_mask(weights, num_voxels)
+
+    header = component_img.header.copy()
+    header.set_data_dtype(np.int16)
+    header.set_slope_inter(1, 0)
+    nib.save(nib.Nifti1Image(mask.astype(np.int16), component_img.affine, header), out_path)
+
+    return {'nonzero_voxels': int(np.count_nonzero(weights)),
+            'threshold': threshold,
+            'mask_voxels': int(mask.sum())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build top-N voxel ROI masks from ICA components')
+    parser.add_argument('--network', nargs=4, action='append', required=True,
+                        metavar=('NAME', 'COMPONENT', 'TEMPLATE', 'OUTPUT'),
+                        help='Network name, unthresholded component, template network and output mask')
+    parser.add_argument('--num-voxels', type=int, default=NUM_VOXELS_DESIRED,
+                        help=f'Number of voxels per mask (default: {NUM_VOXELS_DESIRED})')
+    parser.add_argument('--weighted-out', action='store_true',
+                        help='Write the template-weighted component back over COMPONENT')
+    args = parser.parse_args()
+
+    try:
+        for name, component, template, output in args.network:
+            qc = build_mask(component, template, output, args.num_voxels,
+                            weighted_out=component if args.weighted_out else None)
+            print(f"{name.upper()} voxels: {qc['nonzero_voxels']}")
+            if qc['threshold'] is None:
+                print(f"{name.upper()} mask below {args.num_voxels} voxels, leaving as is.")
+            else:
+                print(f"Thresholding {name.upper()} mask at {qc['threshold']:.6g}")
+            print(f"Number of voxels in {name} mask: {qc['mask_voxels']}")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
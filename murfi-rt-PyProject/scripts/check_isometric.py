@@ -1,12 +1,69 @@
-import nibabel as nib
-import numpy as np
-import sys
+"""
+Check whether NIfTI images have isometric voxels
+
+Only the header is read (NIfTI-1 or NIfTI-2, plain or gzipped), with the standard library,
+so the check costs a few milliseconds and does not import numpy or nibabel.
+
+Usage:
+    python check_isometric.py <path_to_nifti_image>            # prints True / False
+    python check_isometric.py --batch <image> [<image> ...]    # prints a JSON list, one entry per image
+"""
+
+import gzip
+import json
 import os
+import struct
+import sys
+
+# header sizes and the offsets of the fields we need
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# xyzt_units & 0x07
+SPATIAL_UNITS = {0: 'unknown', 1: 'meter', 2: 'mm', 3: 'micron'}
+
+
+def read_header_fields(image_path):
+    """
+    Read dim, pixdim and xyzt_units straight from the NIfTI-1/2 header bytes
+
+    Returns
+    -------
+    dict with 'version', 'dim' (the 8 dim entries), 'pixdim' (the 8 pixdim entries) and 'xyzt_units'
+    """
+    opener = gzip.open if image_path.endswith('.gz') else open
+    with opener(image_path, 'rb') as f:
+        header = f.read(NIFTI2_HEADER_SIZE)
+
+    if len(header) < 4:
+        raise ValueError(f"{image_path} is too short to be a NIfTI image")
+
+    # sizeof_hdr tells both the version and the byte order
+    for endian in ('<', '>'):
+        sizeof_hdr = struct.unpack(endian + 'i', header[:4])[0]
+        if sizeof_hdr in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+            break
+    else:
+        raise ValueError(f"{image_path} is not a NIfTI-1 or NIfTI-2 image")
+
+    if len(header) < sizeof_hdr:
+        raise ValueError(f"{image_path} has a truncated header")
+
+    if sizeof_hdr == NIFTI1_HEADER_SIZE:
+        return {'version': 1,
+                'dim': struct.unpack_from(endian + '8h', header, 40),
+                'pixdim': struct.unpack_from(endian + '8f', header, 76),
+                'xyzt_units': header[123]}
+    return {'version': 2,
+            'dim': struct.unpack_from(endian + '8q', header, 16),
+            'pixdim': struct.unpack_from(endian + '8d', header, 104),
+            'xyzt_units': struct.unpack_from(endian + 'i', header, 500)[0]}
+
 
 def check_isometric(image_path, tolerance=1e-6):
     """
     Check if an fMRI image has isometric voxels.
-    
+
     Parameters
     ----------
     image_path : str
@@ -14,7 +71,7 @@ def check_isometric(image_path, tolerance=1e-6):
     tolerance : float, optional
         Tolerance for floating point comparison of voxel dimensions
         Default is 1e-6
-        
+
     Returns
     -------
     bool
@@ -22,49 +79,73 @@ def check_isometric(image_path, tolerance=1e-6):
     dict
         Dictionary containing voxel dimensions and additional information
     """
-    
-    # Load the image
     try:
-        img = nib.load(image_path)
+        fields = read_header_fields(image_path)
     except Exception as e:
         raise ValueError(f"Error loading image: {str(e)}")
-    
-    # Get voxel dimensions (pixdim)
-    voxel_dims = img.header.get_zooms()[:3]  # Get first 3 dimensions (spatial)
-    
-    # Check if all dimensions are equal within tolerance
-    is_isometric = np.allclose(voxel_dims, [voxel_dims[0]] * 3, rtol=tolerance)
-    
+
+    # Spatial voxel dimensions (pixdim[1:4]), dimensions beyond ndim count as 1 like nibabel's get_zooms
+    ndim = fields['dim'][0]
+    voxel_dims = tuple(float(fields['pixdim'][i]) if i <= ndim else 1.0 for i in (1, 2, 3))
+    dimensions = tuple(int(fields['dim'][i]) if i <= ndim else 1 for i in (1, 2, 3))
+
+    # Check if all dimensions are equal within tolerance (same test as np.allclose)
+    is_isometric = all(abs(d - voxel_dims[0]) <= 1e-8 + tolerance * abs(voxel_dims[0]) for d in voxel_dims)
+
     # Prepare detailed information
     info = {
         'voxel_dims': voxel_dims,
         'resolution': voxel_dims[0] if is_isometric else None,
         'max_difference': max(voxel_dims) - min(voxel_dims),
-        'dimensions': img.shape[:3],
-        'units': img.header.get_xyzt_units()[0]  # Spatial units
+        'dimensions': dimensions,
+        'units': SPATIAL_UNITS.get(fields['xyzt_units'] & 0x07, 'unknown'),  # Spatial units
+        'nifti_version': fields['version'],
     }
-    
+
     return is_isometric, info
 
+
+def check_batch(image_paths, tolerance=1e-6):
+    """Check many images in one process; errors are reported per image instead of stopping the batch"""
+    results = []
+    for image_path in image_paths:
+        result = {'path': image_path}
+        try:
+            is_isometric, info = check_isometric(image_path, tolerance)
+            result['is_isometric'] = is_isometric
+            result.update(info)
+        except Exception as e:
+            result['is_isometric'] = None
+            result['error'] = str(e)
+        results.append(result)
+    return results
+
+
 def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == '--batch':
+        results = check_batch(sys.argv[2:])
+        print(json.dumps(results, indent=2))
+        sys.exit(1 if any('error' in result for result in results) else 0)
+
     # Check if image path is provided
     if len(sys.argv) != 2:
-        print("Usage: python script.py <path_to_nifti_image>")
+        print("Usage: python check_isometric.py <path_to_nifti_image>")
+        print("       python check_isometric.py --batch <image> [<image> ...]")
         sys.exit(1)
-    
+
     # Get image path from command line argument
     image_path = sys.argv[1]
-    
+
     # Check if file exists
     if not os.path.exists(image_path):
         print(f"Error: File '{image_path}' does not exist")
         sys.exit(1)
-        
+
     try:
         # Check if image is isometric
         is_isometric, info = check_isometric(image_path)
         print(is_isometric)
-        
+
     except Exception as e:
         print(f"Error: {str(e)}")
         sys.exit(1)
@@ -26,6 +26,8 @@ cwd=$(pwd)
 absolute_path=$(dirname $cwd)
 subj_dir_absolute="${absolute_path}/subjects/$subj"
 fsl_scripts=../scripts/fsl_scripts
+# flirt / convert_xfm results are reused when inputs and options are unchanged (see fsl_cache.py)
+fsl_cache="python fsl_cache.py --cache-dir ${subj_dir}/xfm/cache"
 
 
 # Set template files
@@ -108,7 +110,14 @@ clear
     fi
     export MURFI_SUBJECTS_DIR="${absolute_path}/subjects/"
     export MURFI_SUBJECT_NAME=$subj
+    # preprocess the resting state runs in the background while they are acquired
+    mkdir -p $subj_dir/rest
+    python -u rest_watcher.py ${subj} > $subj_dir/rest/rest_watcher_log.txt 2>&1 &
+    rest_watcher_pid=$!
     singularity exec -B ${DICOM_FOLDER} /home/rt-mgh/murfi-sif_latest.sif murfi -f $subj_dir/xml/rest.xml
+    # finish preprocessing the last run
+    kill -TERM ${rest_watcher_pid} 2>/dev/null
+    wait ${rest_watcher_pid}
     #singularity exec /home/rt-mgh/murfi-sif_latest.sif murfi -f $subj_dir/xml/rest.xml
 
 fi
@@ -130,7 +139,8 @@ clear
     
     case $? in
         0)  # Overwrite
-            rm -rf "${subj_dir}/rest/"* 2>/dev/null
+            # keep the preprocessing done during acquisition (rest/incremental)
+            find "${subj_dir}/rest/" -mindepth 1 -maxdepth 1 ! -name incremental -exec rm -rf {} + 2>/dev/null
             mkdir -p "$subj_dir/rest"
             ;;
         1)  # Keep Existing or Back to Menu
@@ -178,163 +188,22 @@ clear
     rest_runA_num=${input_array[0]}
     rest_runB_num=${input_array[1]}
 
-    # Use 2 resting runs for ICA
+    # Use 2 resting runs for ICA, or just a single run (only to be used when 2 isn't viable)
     echo ${input_array[2]}
     if [[ ${input_array[2]} == '2' ]] ;
     then
         echo "Using run ${rest_runA_num} and run ${rest_runB_num}"
-        echo "Pre-processing images before ICA..."
-
-        # merge individual volumes to make 1 file for each resting state run
-        rest_runA_filename=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold.nii'
-        rest_runB_filename=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold.nii' 
-
-        # Merge all volumes in each run 
-        volsA=$(find ${subj_dir_absolute}/img/ -type f \( -iname "img-000${rest_runA_num}*" \))
-        volsB=$(find ${subj_dir_absolute}/img/ -type f \( -iname "img-000${rest_runB_num}*" \)) 
-        fslmerge -tr $rest_runA_filename $volsA 1.2
-        fslmerge -tr $rest_runB_filename $volsB 1.2
-
-        # figure out how many volumes of resting state data there were to be used in ICA
-        rest_runA_volumes=$(fslnvols $rest_runA_filename)
-        rest_runB_volumes=$(fslnvols $rest_runB_filename)
-        if [ ${rest_runA_volumes} -ne ${expected_volumes} ] || [ ${rest_runB_volumes} -ne ${expected_volumes} ]; 
-        then
-            echo "WARNING! ${rest_runA_volumes} volumes of resting-state data found for run 1."
-            echo "${rest_runB_volumes} volumes of resting-state data found for run 2. ${expected_volumes} expected?"
-
-            # calculate minimum volumes (which run has fewer, then use fslroi to cut both runs to this minimum)
-            minvols=$(( rest_runA_volumes < rest_runB_volumes ? rest_runA_volumes : rest_runB_volumes ))
-            echo "Clipping runs so that both have ${minvols} volumes"
-            fslroi $rest_runA_filename $rest_runA_filename 0 $minvols
-            fslroi $rest_runB_filename $rest_runB_filename 0 $minvols
-        else
-            minvols=$expected_volumes
-        fi
-
-        echo "+ computing resting state networks this will take about 25 minutes"
-        echo "+ started at: $(date)"
-
-        # realign volumes pre-FEAT
-        mcflirt -in $rest_runA_filename -out $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii'
-        mcflirt -in $rest_runB_filename -out $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt.nii'
-
-        # get median volume of 1st run
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii' \
-            -Tmedian $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii'
-
-        # get median volume of 2st run
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt.nii' \
-            -Tmedian $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_median.nii'
-                
-        # calculate registration matrix of median of 2nd run to median of 1st run
-        flirt -cost leastsq -dof 6  -noresample -noresampblur \
-            -in $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_median.nii' \
-            -ref $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            -out $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run2_median_to_run1_median.nii' \
-            -omat $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run2_median_to_run1_median.mat' 
-
-
-        # check registration of median of 2nd run to median of 1st run
-        slices $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run2_median_to_run1_median.nii' \
-            -o $subj_dir_absolute/qc/flirt_median_rest_check.gif 
-
-        # use registration matrix previously calculated to warp entire 2nd run to median of 1st run
-        flirt -noresample -noresampblur -interp nearestneighbour \
-            -in  $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt.nii' \
-            -ref $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii'  \
-            -out $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_run1space.nii' \
-            -init $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run2_median_to_run1_median.mat' \
-            -applyxfm
-
-        # skullstrip median of 1st run & check the generated mask
-        bet $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii' \
-            -R -f 0.4 -g 0 -m 
-
-        slices $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii' \
-            -o $subj_dir_absolute/qc/rest_skullstrip_check_run1.gif
-
-        # mask both runs by the mask from skullstriped median of 1st run
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii' \
-            -mas $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet_mask.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_masked.nii'
-
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_run1space.nii' \
-            -mas $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet_mask.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_run1space_masked.nii'
-
-        
-        ica_run1_input=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_masked.nii'
-        ica_run2_input=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-02_bold_mcflirt_run1space_masked.nii'
-        reference_vol_for_ica=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii'
-	#reference_vol_for_ica=$template_path
-
-        # update FEAT template with paths and # of volumes of resting state run
-        cp $fsl_scripts/basic_ica_template.fsf $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        OUTPUT_dir=$subj_dir_absolute/rest/rs_network
-        sed -i "s#DATA1#$ica_run1_input#g" $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        sed -i "s#DATA2#$ica_run2_input#g" $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        sed -i "s#OUTPUT#$OUTPUT_dir#g" $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        sed -i "s#REFERENCE_VOL#$reference_vol_for_ica#g" $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf 
-
-        # update fsf to match number of rest volumes
-        sed -i "s/set fmri(npts) 250/set fmri(npts) ${minvols}/g" $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        feat $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf        
-    
-    
+        rest_runs="${rest_runA_num} ${rest_runB_num}"
     else
-        # Use just a single run for ICA (only to be used when 2 isn't viable)
         echo "Using run ${rest_runA_num} for single-run ICA"
+        rest_runs="${rest_runA_num}"
+    fi
 
-        # merge individual volumes to make 1 file for each resting state run
-        rest_runA_filename=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold'.nii
-        volsA=$(find ${subj_dir_absolute}/img/ -type f \( -iname "img-000${rest_runA_num}*" \))
-        fslmerge -tr $rest_runA_filename $volsA 1.2
-
-        # figure out how many volumes of resting state data there were to be used in ICA
-        rest_runA_volumes=$(fslnvols $rest_runA_filename)
-        echo "${rest_runA_volumes} volumes of resting-state data found for run 1."
-        echo "+ computing resting state networks this will take about 25 minutes"
-        echo "+ started at: $(date)"
-
-         # realign volumes pre-FEAT
-        mcflirt -in $rest_runA_filename -out $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii'
-
-        # get median volume of 1st run
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii' \
-            -Tmedian $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii'
-     
-        # skullstrip median of 1st run & check the generated mask
-        bet $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii' \
-            -R -f 0.4 -g 0 -m 
-
-        slices $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii' \
-            -o $subj_dir_absolute/qc/rest_skullstrip_check_run1.gif
-
-        # mask run1 by the mask from skullstriped median of 1st run
-        fslmaths $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt.nii' \
-            -mas $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet_mask.nii' \
-            $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_masked.nii'
-        
-        ica_run1_input=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_masked.nii'
-        reference_vol_for_ica=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii'
-
-        # update FEAT template with paths and # of volumes of resting state run
-        cp fsl_scripts/basic_ica_template_single_run.fsf $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        OUTPUT_dir=$subj_dir_absolute/rest/rs_network
-        sed -i "s#DATA#$ica_run1_input#g" $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        sed -i "s#OUTPUT#$OUTPUT_dir#g" $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        sed -i "s#REFERENCE_VOL#$reference_vol_for_ica#g" $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf 
-
-        # update fsf to match number of rest volumes
-        sed -i "s/set fmri(npts) 250/set fmri(npts) ${rest_runA_volumes}/g" $subj_dir_absolute/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf
-        feat $subj_dir/rest/$subj'_'$ses'_task-rest_'$run'_bold'.fsf   
-    fi                        
+    # merge, realign, register, skullstrip & mask the runs, then run the ICA
+    # (independent per-run stages run in parallel, up-to-date stages are skipped)
+    echo "+ computing resting state networks this will take about 25 minutes"
+    echo "+ started at: $(date)"
+    python rest_pipeline.py ${subj} ${rest_runs}
 fi
 
 
@@ -395,8 +264,8 @@ then
 
     # Register example func to MNI template, then calculate inverse
     # This registration will be used to bring template networks to native space
-    flirt -in ${examplefunc} -ref MNI152_T1_2mm_brain -out ${example_func2mni} -omat ${example_func2mni_mat}
-    convert_xfm -omat ${mni2example_func_mat} -inverse ${example_func2mni_mat}
+    ${fsl_cache} flirt -in ${examplefunc} -ref MNI152_T1_2mm_brain -out ${example_func2mni} -omat ${example_func2mni_mat}
+    ${fsl_cache} convert_xfm -omat ${mni2example_func_mat} -inverse ${example_func2mni_mat}
 
     #check if examplefunc is 2mm isometric
     if [ "$(python check_isometric.py "$examplefunc")" = "True" ]
@@ -407,7 +276,7 @@ then
     else
 	echo + examplefunc is not isometric, converting melodic_IC to native space before creating masks
 	cp $infile $ica_directory/melodic_IC_examplefunc.nii
-	flirt -in $infile -ref $examplefunc -out $ica_directory/melodic_IC_examplefunc.nii -init $mni2example_func_mat -applyxfm -interp trilinear
+	${fsl_cache} flirt -in $infile -ref $examplefunc -out $ica_directory/melodic_IC_examplefunc.nii -init $mni2example_func_mat -applyxfm -interp trilinear
 	infile=$ica_directory/melodic_IC_examplefunc.nii
     
     fi
@@ -425,28 +294,19 @@ then
 
 
     # WARP MNI brain template to resting-state run native space
-    flirt -in MNI152_T1_2mm_brain -ref ${examplefunc} -out ${mni2xample_func} -init ${mni2example_func_mat} -applyxfm
+    ${fsl_cache} flirt -in MNI152_T1_2mm_brain -ref ${examplefunc} -out ${mni2xample_func} -init ${mni2example_func_mat} -applyxfm
     
     # Register the networks from template (MNI) space into resting-state run native space
-    flirt -in ${template_networks} -ref ${examplefunc} -out ${template2example_func} -init ${mni2example_func_mat} -applyxfm
-    flirt -in ${template_dmn} -ref ${examplefunc} -out ${dmn2example_func} -init ${mni2example_func_mat} -applyxfm
-    flirt -in ${template_cen} -ref ${examplefunc} -out ${cen2example_func} -init ${mni2example_func_mat} -applyxfm
-
-
-    # Correlate (spatially) ICA components (not thresholded) with DMN & CEN template files
-    rm -f ${correlfile}
-    #echo ${examplefunc_mask}
-    #echo ${infile}
-    #echo ${template2example_func}
-    #echo ${correlfile}
-    fslcc --noabs -p 8 -t -1 -m ${examplefunc_mask} ${infile} ${template2example_func}>>${correlfile}
+    ${fsl_cache} flirt -in ${template_networks} -ref ${examplefunc} -out ${template2example_func} -init ${mni2example_func_mat} -applyxfm
+    ${fsl_cache} flirt -in ${template_dmn} -ref ${examplefunc} -out ${dmn2example_func} -init ${mni2example_func_mat} -applyxfm
+    ${fsl_cache} flirt -in ${template_cen} -ref ${examplefunc} -out ${cen2example_func} -init ${mni2example_func_mat} -applyxfm
 
-    # Split ICs to separate files
-    split_outfile=$ica_directory/melodic_IC_
-    fslsplit ${infile} ${split_outfile}
 
-    # Selection of ICs most highly correlated with template networks
-    python rsn_get.py ${subj} ${ica_version}
+    # Correlate (spatially) ICA components (not thresholded) with DMN & CEN template files,
+    # select the ICs most highly correlated with the template networks and write them out as dmn/cen_uthresh
+    # (correlations are also written to ${correlfile} in fslcc format)
+    python ica_network_selection.py --ic ${infile} --templates ${template2example_func} --mask ${examplefunc_mask} \
+        --correlfile ${correlfile} --dmn-out ${dmn_uthresh} --cen-out ${cen_uthresh}
 
     ## Thresholded masks in MNI space
     dmn_thresh=$ica_directory/dmn_thresh.nii
@@ -456,52 +316,11 @@ then
     # Hard code the number of voxels desired for each mask
     num_voxels_desired=2000
 
-    # zero out voxels not included in the template masks (i.e. so we only select voxels within template DMN/CEN)
-    fslmaths ${dmn_uthresh} -mul ${dmn2example_func} ${dmn_uthresh}
-    fslmaths ${cen_uthresh} -mul ${cen2example_func} ${cen_uthresh}
-
-    # get number of non-zero voxels in masks, calculate percentile and absolute percentile cutoff needed for the desired absolute number of voxelsnum_voxels_desired
-    
-    voxels_in_dmn=$(fslstats ${dmn_uthresh} -V | awk '{print $1}')
-    echo "DMN voxels:" $voxels_in_dmn
-    if [ $voxels_in_dmn  -ge $num_voxels_desired ]; then
-        percentile_dmn=$(python -c "print(100*(1-${num_voxels_desired}/${voxels_in_dmn}))")
-        echo "DMN percentile:" $percentile_dmn
-        echo "Thresholding DMN mask to desired percentile"
-        # # Calculate the absolute value of the percentile
-        percentile_dmn_abs=$(python -c "print(abs(${percentile_dmn}))")
-        dmn_thresh_value=$(fslstats ${dmn_uthresh} -P ${percentile_dmn_abs})
-        
-        # threshold masks 
-    	fslmaths ${dmn_uthresh} -thr ${dmn_thresh_value} -bin ${dmn_thresh} -odt short
-    else
-        echo "DMN mask below 2000 voxels, leaving as is."
-        fslmaths ${dmn_uthresh} -bin ${dmn_thresh} -odt short  
-    fi
-    	
-    voxels_in_cen=$(fslstats ${cen_uthresh} -V | awk '{print $1}')
-    echo "CEN voxels:" $voxels_in_cen
-    if [ $voxels_in_cen  -ge $num_voxels_desired ]; then
-        percentile_cen=$(python -c "print(100*(1-${num_voxels_desired}/${voxels_in_cen}))")
-        echo "CEN percentile:" $percentile_cen
-        echo "Thresholding CEN mask to desired percentile"
-        # # Calculate the absolute value of the percentile
-        percentile_cen_abs=$(python -c "print(abs(${percentile_cen}))")
-        cen_thresh_value=$(fslstats ${cen_uthresh} -P ${percentile_cen_abs})
-        
-        # threshold masks 
-        fslmaths ${cen_uthresh} -thr ${cen_thresh_value} -bin ${cen_thresh} -odt short
-
-    else
-        echo "CEN mask below 2000 voxels, leaving as is."
-        fslstats ${cen_uthresh} -V
-        fslmaths ${cen_uthresh} -bin ${cen_thresh} -odt short
-        fslstats ${cen_thresh} -V
-
-    fi
-
-    echo "Number of voxels in dmn mask: $(fslstats ${dmn_thresh} -V | head -c 5)"
-    echo "Number of voxels in cen mask: $(fslstats ${cen_thresh} -V | head -c 5)"
+    # zero out voxels not included in the template masks (i.e. so we only select voxels within template DMN/CEN),
+    # then keep exactly the ${num_voxels_desired} highest voxels of each component as a binary (short) mask
+    python build_roi_masks.py --num-voxels ${num_voxels_desired} --weighted-out \
+        --network dmn ${dmn_uthresh} ${dmn2example_func} ${dmn_thresh} \
+        --network cen ${cen_uthresh} ${cen2example_func} ${cen_thresh}
 
     # copy masks to participant's mask directory
     cp ${dmn_thresh} ${subj_dir}/mask/dmn_native_rest.nii
@@ -510,17 +329,15 @@ then
 
     # create masks in MNI space and save
     echo "Created MNI masks"
-    flirt -in ${dmn_thresh} -ref MNI152_T1_2mm_brain -out ${subj_dir}/mask/mni/dmn_mni.nii -omat ${example_func2mni_mat}
-    flirt -in ${cen_thresh} -ref MNI152_T1_2mm_brain -out ${subj_dir}/mask/mni/cen_mni.nii -omat ${example_func2mni_mat}
+    ${fsl_cache} flirt -in ${dmn_thresh} -ref MNI152_T1_2mm_brain -out ${subj_dir}/mask/mni/dmn_mni.nii -omat ${example_func2mni_mat}
+    ${fsl_cache} flirt -in ${cen_thresh} -ref MNI152_T1_2mm_brain -out ${subj_dir}/mask/mni/cen_mni.nii -omat ${example_func2mni_mat}
 
 
-    # Display masks with FSLEYES
-    if [ $ica_version == 'single_run' ]
-    then
-        fsleyes $examplefunc ${mni2xample_func} ${dmn_thresh} -cm blue ${cen_thresh} -cm red
-    else
-        fsleyes $examplefunc ${mni2xample_func} ${dmn_thresh} -cm blue ${cen_thresh} -cm red
-    fi
+    # QC images of the template registration and the masks, collected in the participant's qc/index.html
+    python qc_render.py --qc-dir ${subj_dir}/qc \
+        --edges mni_to_rest_check ${examplefunc} ${mni2xample_func} \
+        --masks rest_roi_masks_check ${examplefunc} ${dmn_thresh} blue ${cen_thresh} red
+    xdg-open ${subj_dir}/qc/index.html > /dev/null 2>&1 &
 
 fi
 
@@ -548,7 +365,6 @@ then
     cp ${latest_ref}.nii ${study_ref}
 
     bet ${latest_ref} ${latest_ref}_brain -R -f 0.4 -g 0 -m # changed from -f 0.6
-    slices ${latest_ref} ${latest_ref}_brain_mask -o $subj_dir/qc/2vol_skullstrip_brain_mask_check.gif
 
     rm -r $subj_dir/xfm/epi2reg
     mkdir -p $subj_dir/xfm/epi2reg
@@ -572,10 +388,8 @@ then
     
     # # warp masks in RESTING STATE ICA SPACE (median of rest run1) into 2VOL native space (studyref)
     examplefunc=$subj_dir_absolute/rest/$subj'_'$ses'_task-rest_run-01_bold_mcflirt_median_bet.nii'
-    flirt -in $examplefunc -ref ${latest_ref}_brain -out $subj_dir/xfm/epi2reg/rest2studyref_brain -omat $subj_dir/xfm/epi2reg/rest2studyref.mat
+    ${fsl_cache} flirt -in $examplefunc -ref ${latest_ref}_brain -out $subj_dir/xfm/epi2reg/rest2studyref_brain -omat $subj_dir/xfm/epi2reg/rest2studyref.mat
 
-    # make registration image for inspection, and open it
-    slices $subj_dir/xfm/epi2reg/rest2studyref_brain ${latest_ref}_brain -o $subj_dir/qc/rest_warp_to_2vol_native_check.gif
 
     # If paths to personalized masks exist, then run MURFI. Otherwise, prompt user about whether to use template masks instead
     dmn_thresh="../subjects/${subj}/mask/dmn_native_rest.nii"
@@ -587,7 +401,7 @@ then
         echo "+ REGISTERING ${mask_name} TO study_ref" 
 
         # warp masks from resting state space to 2vol space
-        flirt -in $subj_dir/mask/${mask_name}_native_rest.nii -ref ${latest_ref} -out $subj_dir/mask/${mask_name} -init $subj_dir/xfm/epi2reg/rest2studyref.mat -applyxfm -interp nearestneighbour -datatype short
+        ${fsl_cache} flirt -in $subj_dir/mask/${mask_name}_native_rest.nii -ref ${latest_ref} -out $subj_dir/mask/${mask_name} -init $subj_dir/xfm/epi2reg/rest2studyref.mat -applyxfm -interp nearestneighbour -datatype short
         
         # erode 2vvol brain mask one voxel
         fslmaths ${latest_ref}_brain_mask -ero ${latest_ref}_brain_mask_ero1
@@ -599,10 +413,15 @@ then
         gunzip -f $subj_dir/mask/${mask_name}.nii
     done
 
+    # make skullstrip, registration and mask images for inspection (rendered together, each image read once), and open them
+    python qc_render.py --qc-dir ${subj_dir}/qc \
+        --edges 2vol_skullstrip_brain_mask_check ${latest_ref} ${latest_ref}_brain_mask \
+        --edges rest_warp_to_2vol_native_check $subj_dir/xfm/epi2reg/rest2studyref_brain ${latest_ref}_brain \
+        --masks 2vol_masks_check ${latest_ref}_brain $subj_dir/mask/dmn.nii blue $subj_dir/mask/cen.nii red
+
     echo "+ INSPECT"
     echo "++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++"
-    xdg-open $subj_dir/qc/rest_warp_to_2vol_native_check.gif
-    fsleyes ${latest_ref}_brain  $subj_dir/xfm/epi2reg/rest2studyref_brain $subj_dir/mask/cen.nii -cm red $subj_dir/mask/dmn.nii -cm blue  #$subj_dir/mask/smc.nii -cm yellow $subj_dir/mask/stg.nii -cm green
+    xdg-open $subj_dir/qc/index.html > /dev/null 2>&1 &
 fi
 
 
@@ -671,17 +490,17 @@ then
 
     # first, register the 2vol to mni
     # then calculate the inverse of the registration
-    flirt -in ${two_vol_ref_bet} -ref ${mni_template} -out ${two_vol_ref2mni} -omat ${two_vol_ref2mni_mat}
-    convert_xfm -omat ${mni2_two_vol_ref_mat} -inverse ${two_vol_ref2mni_mat}
+    ${fsl_cache} flirt -in ${two_vol_ref_bet} -ref ${mni_template} -out ${two_vol_ref2mni} -omat ${two_vol_ref2mni_mat}
+    ${fsl_cache} convert_xfm -omat ${mni2_two_vol_ref_mat} -inverse ${two_vol_ref2mni_mat}
 
 
     # "apply" the inverse of the registration to dmn/cen masks
     #put them in the participant mask folder
 
     #DMN
-    flirt -in ${dmn_mni} -ref ${two_vol_ref_bet} -out $subj_dir/mask/dmn.nii -init ${mni2_two_vol_ref_mat} -applyxfm -interp nearestneighbour -datatype short
+    ${fsl_cache} flirt -in ${dmn_mni} -ref ${two_vol_ref_bet} -out $subj_dir/mask/dmn.nii -init ${mni2_two_vol_ref_mat} -applyxfm -interp nearestneighbour -datatype short
 
     #CEN
-    flirt -in ${cen_mni} -ref ${two_vol_ref_bet} -out $subj_dir/mask/cen.nii -init ${mni2_two_vol_ref_mat} -applyxfm -interp nearestneighbour -datatype short
+    ${fsl_cache} flirt -in ${cen_mni} -ref ${two_vol_ref_bet} -out $subj_dir/mask/cen.nii -init ${mni2_two_vol_ref_mat} -applyxfm -interp nearestneighbour -datatype short
 
 fi
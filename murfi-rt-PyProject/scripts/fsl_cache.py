@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Content-addressed cache for flirt / convert_xfm
+
+Registrations and template resampling are the same computation every time process_roi_masks,
+register or backup_reg_mni_masks_to_2vol runs on the same images. Prefixing the command with
+this script looks the result up by a key made of
+
+    - the command and its arguments
+    - the content (sha256) of every input file (-in, -ref, -init, matrices ...)
+    - the FSL version and FSLOUTPUTTYPE
+
+Output paths are not part of the key, so a result is reused wherever it is written to. On a
+hit the cached outputs are copied to the requested paths; on a miss the command runs and its
+outputs are stored under the cache directory (one folder per key, normally <subject>/xfm/cache).
+File hashes are remembered by path, size and modification time, so unchanged inputs are not
+read again.
+
+Usage:
+    python fsl_cache.py --cache-dir ../subjects/<subj>/xfm/cache flirt -in a.nii -ref b.nii -out c.nii -omat c.mat
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+# flags whose value is a file written by the command
+OUTPUT_FLAGS = {
+    'flirt': ('-out', '-omat'),
+    'convert_xfm': ('-omat',),
+}
+HASH_INDEX = 'file_hashes.json'
+
+
+def image_stem(path):
+    """Path without .nii / .nii.gz"""
+    return path[:-7] if path.endswith('.nii.gz') else path[:-4] if path.endswith('.nii') else path
+
+
+def find_file(path, required=False):
+    """
+    The file FSL reads or writes for `path`: as given, or with .nii / .nii.gz added or swapped
+
+    FSL tools pick the extension from FSLOUTPUTTYPE, so 'x.nii' may exist as 'x.nii.gz' (and the
+    other way round). Returns None if there is none, or raises FileNotFoundError if required.
+    """
+    stem = image_stem(path)
+    for candidate in (path, stem + '.nii', stem + '.nii.gz'):
+        if os.path.exists(candidate):
+            return candidate
+    if required:
+        raise FileNotFoundError(f"Image '{path}' does not exist")
+    return None
+
+
+class FileHashes:
+    """sha256 of files, remembered by (size, mtime) in a JSON index"""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        try:
+            with open(index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.changed = False
+
+    def __call__(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.index[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        self.changed = True
+        return digest.hexdigest()
+
+    def save(self):
+        if self.changed:
+            with open(self.index_path, 'w') as f:
+                json.dump(self.index, f)
+
+
+def fsl_version():
+    try:
+        with open(os.path.join(os.environ.get('FSLDIR', ''), 'etc', 'fslversion')) as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def command_key(command, file_hash):
+    """
+    Cache key of a command, and the output paths it writes
+
+    Returns
+    -------
+    key : str
+    outputs : list of str
+        Output paths as given on the command line
+    """
+    tool = os.path.basename(command[0])
+    output_flags = OUTPUT_FLAGS.get(tool)
+    if output_flags is None:
+        raise ValueError(f"{tool} is not cacheable (supported: {', '.join(OUTPUT_FLAGS)})")
+
+    outputs, normalized = [], [tool]
+    args = command[1:]
+    for i, arg in enumerate(args):
+        if i > 0 and args[i - 1] in output_flags:
+            normalized.append(f'<output{len(outputs)}>')
+            outputs.append(arg)
+            continue
+        path = find_file(arg) if not arg.startswith('-') else None
+        normalized.append(f'<sha256:{file_hash(path)}>' if path and os.path.isfile(path) else arg)
+
+    material = json.dumps([normalized, fsl_version(), os.environ.get('FSLOUTPUTTYPE', '')])
+    return hashlib.sha256(material.encode()).hexdigest(), outputs
+
+
+def cached_run(command, cache_dir):
+    """
+    Run an flirt / convert_xfm command, or restore its outputs from the cache
+
+    Returns
+    -------
+    bool
+        True on a cache hit
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    file_hash = FileHashes(os.path.join(cache_dir, HASH_INDEX))
+    key, outputs = command_key(command, file_hash)
+    entry_dir = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(entry_dir, 'manifest.json')
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for output, (cached_name, extension) in zip(outputs, manifest['outputs']):
+            target = image_stem(output) + extension if extension else output
+            shutil.copyfile(os.path.join(entry_dir, cached_name), target)
+        file_hash.save()
+        return True
+
+    subprocess.run(command, check=True)
+
+    # store the outputs, with the extension FSL actually gave them
+    os.makedirs(entry_dir, exist_ok=True)
+    stored = []
+    for i, output in enumerate(outputs):
+        written = find_file(output)
+        if written is None:
+            raise FileNotFoundError(f"{command[0]} did not write {output}")
+        extension = '' if written == output else written[len(image_stem(output)):]
+        cached_name = f'output{i}{extension}'
+        shutil.copyfile(written, os.path.join(entry_dir, cached_name))
+        stored.append([cached_name, extension])
+    with open(manifest_path, 'w') as f:
+        json.dump({'command': command, 'outputs': stored}, f, indent=2)
+    file_hash.save()
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run flirt / convert_xfm through a content-addressed cache')
+    parser.add_argument('--cache-dir', required=True, help='Cache folder (e.g. ../subjects/<subj>/xfm/cache)')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='flirt or convert_xfm command')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('no command given')
+
+    try:
+        if cached_run(args.command, args.cache_dir):
+            print(f"+ {os.path.basename(args.command[0])}: reused cached result")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
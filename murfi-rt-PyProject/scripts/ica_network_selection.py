@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Select the DMN and CEN independent components by spatial correlation with template networks
+
+Replaces the fslcc -> fslsplit -> rsn_get.py sequence of the process_roi_masks step:
+melodic_IC is memory-mapped once, the masked Pearson correlations of every IC with every
+template network are computed as a single matrix product, and only the two selected
+components are written out (as dmn_uthresh.nii / cen_uthresh.nii).
+
+The correlations are also written to template_rsn_correlations_with_ICs.txt in fslcc's
+format (IC number, network number, correlation; both numbers 1-based), so rsn_get.py and
+anything else reading that file keeps working.
+
+Usage:
+    python ica_network_selection.py --ic melodic_IC.nii --templates template_networks2example_func.nii \
+        --mask examplefunc_mask.nii --correlfile template_rsn_correlations_with_ICs.txt \
+        --dmn-out dmn_uthresh.nii --cen-out cen_uthresh.nii
+"""
+
+import argparse
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from fsl_cache import find_file
+
+# Volumes of template_networks.nii (1-based, as in the correlation file)
+NETWORK_NUMBERS = {'dmn': 1, 'cen': 2}
+
+
+def load_masked(image_path, mask):
+    """
+    Voxels inside the mask of a 3D/4D image, as (n_voxels, n_volumes) float64
+
+    The image is memory-mapped, so only the masked voxels are read into memory.
+    """
+    img = nib.load(image_path, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    if data.shape[:3] != mask.shape:
+        raise ValueError(f"{image_path} has shape {data.shape[:3]}, mask has shape {mask.shape}")
+    return np.asarray(data[mask], dtype=np.float64)
+
+
+def masked_spatial_correlation(ic_data, template_data):
+    """
+    Pearson correlation of every IC with every template over the masked voxels
+
+    Parameters
+    ----------
+    ic_data : np.ndarray
+        (n_voxels, n_ics) masked IC maps
+    template_data : np.ndarray
+        (n_voxels, n_templates) masked template maps
+
+    Returns
+    -------
+    np.ndarray
+        (n_ics, n_templates) correlations (nan for constant maps)
+    """
+    ic_centered = ic_data - ic_data.mean(axis=0)
+    template_centered = template_data - template_data.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ic_centered /= np.linalg.norm(ic_centered, axis=0)
+        template_centered /= np.linalg.norm(template_centered, axis=0)
+    return ic_centered.T @ template_centered
+
+
+def write_fslcc_file(correlations, correlfile, precision=8):
+    """Write correlations like `fslcc --noabs -p <precision> -t -1`: one 'IC network r' line per pair"""
+    with open(correlfile, 'w') as f:
+        for ic in range(correlations.shape[0]):
+            for network in range(correlations.shape[1]):
+                f.write(f'{ic + 1:3d} {network + 1:3d} {correlations[ic, network]:.{precision}f}\n')
+
+
+def select_components(correlations, network_numbers=NETWORK_NUMBERS):
+    """
+    IC with the strongest absolute correlation for each network
+
+    ICs can be negatively correlated with their network, so the absolute value is used;
+    ties go to the lowest IC number.
+
+    Returns
+    -------
+    dict mapping network name to (0-based IC index, signed correlation)
+    """
+    selection = {}
+    for name, network_number in network_numbers.items():
+        column = correlations[:, network_number - 1]
+        ic_index = int(np.nanargmax(np.abs(column)))
+        selection[name] = (ic_index, float(column[ic_index]))
+    return selection
+
+
+def write_component(ic_path, ic_index, out_path):
+    """Write a single IC volume (what fslsplit would have written as melodic_IC_<index>.nii)"""
+    img = nib.load(ic_path, mmap=True)
+    volume = np.asarray(img.dataobj[..., ic_index]) if len(img.shape) == 4 else np.asarray(img.dataobj)
+    header = img.header.copy()
+    header.set_data_dtype(volume.dtype)
+    out_img = type(img)(volume, img.affine, header)
+    nib.save(out_img, out_path)
+
+
+def select_networks(ic_path, templates_path, mask_path, correlfile=None, outputs=None):
+    """
+    Correlate ICs with the templates, select the DMN/CEN components and write them out
+
+    Parameters
+    ----------
+    ic_path : str
+        4D melodic_IC image
+    templates_path : str
+        4D template networks in the same space (volume 1 DMN, volume 2 CEN)
+    mask_path : str
+        Brain mask; only voxels inside it are correlated
+    correlfile : str, optional
+        Where to write the correlations in fslcc format
+    outputs : dict, optional
+        Network name -> output path for the selected component
+
+    Returns
+    -------
+    selection : dict
+        Network name -> (0-based IC index, signed correlation)
+    correlations : np.ndarray
+        (n_ics, n_templates)
+    """
+    ic_path, templates_path, mask_path = (find_file(p, required=True) for p in (ic_path, templates_path, mask_path))
+    mask = np.asanyarray(nib.load(mask_path, mmap=True).dataobj) != 0
+    if mask.ndim == 4:
+        mask = mask[..., 0]
+    ic_data = load_masked(ic_path, mask)
+    template_data = load_masked(templates_path, mask)
+
+    correlations = masked_spatial_correlation(ic_data, template_data)
+    if correlfile:
+        write_fslcc_file(correlations, correlfile)
+
+    selection = select_components(correlations)
+    for name, (ic_index, correlation) in selection.items():
+        print(f'{name.upper()}: melodic_IC_{ic_index:04d} (r = {correlation:.4f})')
+        if outputs and name in outputs:
+            write_component(ic_path, ic_index, outputs[name])
+    return selection, correlations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Select DMN/CEN ICs by spatial correlation with template networks')
+    parser.add_argument('--ic', required=True, help='4D melodic_IC image')
+    parser.add_argument('--templates', required=True, help='4D template networks in IC space (1=DMN, 2=CEN)')
+    parser.add_argument('--mask', required=True, help='Brain mask for the correlation')
+    parser.add_argument('--correlfile', help='Write correlations here in fslcc format')
+    parser.add_argument('--dmn-out', help='Output path for the selected DMN component')
+    parser.add_argument('--cen-out', help='Output path for the selected CEN component')
+    args = parser.parse_args()
+
+    outputs = {name: path for name, path in (('dmn', args.dmn_out), ('cen', args.cen_out)) if path}
+    try:
+        select_networks(args.ic, args.templates, args.mask, args.correlfile, outputs)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Merge the single-volume images of a run into one 4D image, streaming
+
+Replaces fslmerge -tr / fslnvols / fslroi for the resting-state runs:
+
+    - the 4D header is written once and each volume is appended as it is read, so only one
+      volume is in memory at a time; dim[4] is updated after every volume, so the output is a
+      valid image at any point
+    - with --watch, volumes are merged as MURFI writes them to the subject's img/ folder
+      (from the DICOMs arriving in tmp/murfi_input), so merging overlaps with acquisition
+    - with --equalize, the runs are clipped to the shortest one by patching dim[4] and
+      truncating the file in place, instead of rewriting it with fslroi
+
+Outputs are uncompressed NIfTI-1 (.nii), which is what the in-place updates need.
+
+Usage:
+    python merge_volumes.py --img-dir ../subjects/<subj>/img --tr 1.2 --equalize \
+        --run 2 <subj>_ses-lo1_task-rest_run-01_bold.nii --run 3 <subj>_ses-lo1_task-rest_run-02_bold.nii
+    python merge_volumes.py --img-dir ../subjects/<subj>/img --watch --expected 250 --run 2 run-01_bold.nii
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import struct
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+TR = 1.2
+NIFTI1_HEADER_SIZE = 348
+DIM_OFFSET = 40  # dim[0..7], 8 x int16
+BITPIX_OFFSET = 72
+VOX_OFFSET_OFFSET = 108
+
+# seconds without a new volume before --watch gives up
+WATCH_TIMEOUT = 30
+WATCH_INTERVAL = 0.2
+
+
+def run_volumes(img_dir, run_number):
+    """Single-volume files of a run, sorted (find -iname "img-000<run>*")"""
+    pattern = f'img-000{run_number}*'.lower()
+    return sorted(os.path.join(img_dir, f) for f in os.listdir(img_dir) if fnmatch.fnmatch(f.lower(), pattern))
+
+
+def _header_layout(f):
+    """Byte order, vox_offset and bytes per volume of an uncompressed NIfTI-1 file"""
+    f.seek(0)
+    header = f.read(NIFTI1_HEADER_SIZE)
+    for endian in ('<', '>'):
+        if len(header) == NIFTI1_HEADER_SIZE and struct.unpack(endian + 'i', header[:4])[0] == NIFTI1_HEADER_SIZE:
+            break
+    else:
+        raise ValueError(f"{f.name} is not an uncompressed NIfTI-1 image")
+    dim = struct.unpack_from(endian + '8h', header, DIM_OFFSET)
+    bitpix = struct.unpack_from(endian + 'h', header, BITPIX_OFFSET)[0]
+    vox_offset = int(struct.unpack_from(endian + 'f', header, VOX_OFFSET_OFFSET)[0])
+    volume_bytes = int(np.prod(dim[1:4], dtype=np.int64)) * bitpix // 8
+    return endian, dim, vox_offset, volume_bytes
+
+
+def _set_volume_count(f, endian, n_volumes):
+    """Patch dim[0] and dim[4] of an open NIfTI-1 file"""
+    f.seek(DIM_OFFSET)
+    f.write(struct.pack(endian + 'h', 4))
+    f.seek(DIM_OFFSET + 4 * 2)
+    f.write(struct.pack(endian + 'h', n_volumes))
+
+
+def count_volumes(image_path):
+    """Number of volumes of a 4D image, from its header (like fslnvols)"""
+    shape = nib.load(image_path).shape
+    return shape[3] if len(shape) == 4 else 1
+
+
+def truncate_volumes(image_path, n_volumes):
+    """
+    Keep only the first n_volumes of an uncompressed 4D NIfTI-1 image, in place
+
+    Same result as `fslroi image image 0 n_volumes`, but only the header is rewritten and
+    the file is cut with os.truncate.
+    """
+    with open(image_path, 'r+b') as f:
+        endian, dim, vox_offset, volume_bytes = _header_layout(f)
+        if n_volumes > dim[4]:
+            raise ValueError(f"{image_path} has {dim[4]} volumes, cannot keep {n_volumes}")
+        _set_volume_count(f, endian, n_volumes)
+    os.truncate(image_path, vox_offset + n_volumes * volume_bytes)
+
+
+class StreamingMerger:
+    """
+    Append 3D volumes to a 4D NIfTI-1 file one at a time
+
+    The first volume sets the geometry, data type and header of the output; later volumes
+    must have the same shape.
+
+    Parameters
+    ----------
+    out_path : str
+        Output image (.nii)
+    tr : float
+        Repetition time written to pixdim[4] (as fslmerge -tr)
+    dtype : numpy dtype, optional
+        Output data type (default: that of the first volume)
+    """
+
+    def __init__(self, out_path, tr=TR, dtype=None):
+        if out_path.endswith('.gz'):
+            raise ValueError(f"{out_path}: streaming merge needs an uncompressed .nii output")
+        self.out_path = out_path
+        self.tr = tr
+        self.dtype = dtype
+        self.n_volumes = 0
+        self._file = None
+        self._shape = None
+        self._dtype = None
+        self._endian = None
+        self._data_offset = NIFTI1_HEADER_SIZE + 4  # header + empty extension flag
+
+    def _start(self, img):
+        header = nib.Nifti1Header.from_header(img.header)
+        self._shape = img.shape[:3]
+        if self.dtype is not None:
+            header.set_data_dtype(self.dtype)
+        elif header.get_slope_inter() not in ((None, None), (1.0, 0.0)):
+            header.set_data_dtype(np.float32)  # scaled input, store the scaled values
+        header.set_slope_inter(1, 0)
+        header.set_data_shape(self._shape + (1,))
+        header.set_zooms(header.get_zooms()[:3] + (self.tr,))
+        header.set_xyzt_units(xyz=header.get_xyzt_units()[0], t='sec')
+        header['vox_offset'] = self._data_offset
+        self._dtype = header.get_data_dtype()
+        self._endian = '>' if self._dtype.byteorder == '>' else '<'
+        self._file = open(self.out_path, 'wb')
+        header.write_to(self._file)
+
+    def append(self, volume_path):
+        """Append one single-volume image"""
+        img = nib.load(volume_path)
+        if self._file is None:
+            self._start(img)
+        shape = img.shape[:3] if len(img.shape) == 3 or img.shape[3:] == (1,) else img.shape
+        if shape != self._shape:
+            raise ValueError(f"{volume_path} has shape {img.shape}, expected {self._shape}")
+        data = np.asarray(img.dataobj).reshape(self._shape).astype(self._dtype, copy=False)
+        self._file.seek(self._data_offset + self.n_volumes * data.nbytes)
+        self._file.write(data.tobytes(order='F'))
+        self.n_volumes += 1
+        _set_volume_count(self._file, self._endian, self.n_volumes)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _is_complete(volume_path):
+    """A volume is merged only once it is fully written (header readable and all voxel data present)"""
+    try:
+        img = nib.load(volume_path)
+        if volume_path.endswith('.gz'):
+            return True
+        needed = int(img.header['vox_offset']) + int(np.prod(img.shape)) * img.get_data_dtype().itemsize
+        return os.path.getsize(volume_path) >= needed
+    except Exception:
+        return False
+
+
+def merge_run(img_dir, run_number, out_path, tr=TR, watch=False, expected=None, timeout=WATCH_TIMEOUT):
+    """
+    Merge the volumes of one run into out_path
+
+    Parameters
+    ----------
+    img_dir : str
+        Folder with the single-volume images (img-000<run>-<volume>.nii)
+    run_number : str
+        Run number as in the file names
+    out_path : str
+        Output 4D image (.nii)
+    tr : float
+        Repetition time for the output header
+    watch : bool
+        Keep merging new volumes as they arrive, until `expected` volumes have been merged
+        or no new volume arrived for `timeout` seconds
+    expected : int, optional
+        Number of volumes the run should have (stops --watch early)
+
+    Returns
+    -------
+    int
+        Number of volumes merged
+    """
+    merged = set()
+    last_volume_time = time.time()
+    with StreamingMerger(out_path, tr) as merger:
+        while True:
+            for volume in run_volumes(img_dir, run_number):
+                if volume in merged:
+                    continue
+                if watch and not _is_complete(volume):
+                    break  # keep the volume order: wait for this one to be fully written
+                merger.append(volume)
+                merged.add(volume)
+                last_volume_time = time.time()
+            if not watch or (expected and merger.n_volumes >= expected):
+                break
+            if time.time() - last_volume_time > timeout:
+                break
+            time.sleep(WATCH_INTERVAL)
+    if not merged:
+        raise FileNotFoundError(f"No volumes found for run {run_number} in {img_dir}")
+    return merger.n_volumes
+
+
+def equalize_runs(image_paths):
+    """
+    Clip all runs to the number of volumes of the shortest one
+
+    Returns
+    -------
+    counts : dict
+        Image path -> number of volumes before clipping
+    minvols : int
+    """
+    counts = {path: count_volumes(path) for path in image_paths}
+    minvols = min(counts.values())
+    for path, n_volumes in counts.items():
+        if n_volumes != minvols:
+            truncate_volumes(path, minvols)
+    return counts, minvols
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge single-volume images into 4D runs')
+    parser.add_argument('--img-dir', required=True, help='Folder with the img-000<run>-<volume>.nii files')
+    parser.add_argument('--run', nargs=2, action='append', required=True, metavar=('RUN', 'OUTPUT'),
+                        help='Run number and output 4D image')
+    parser.add_argument('--tr', type=float, default=TR, help=f'Repetition time (default: {TR})')
+    parser.add_argument('--watch', action='store_true', help='Merge volumes as they arrive')
+    parser.add_argument('--expected', type=int, help='Volumes per run (stops --watch once reached)')
+    parser.add_argument('--timeout', type=float, default=WATCH_TIMEOUT,
+                        help=f'With --watch, stop after this many seconds without a new volume (default: {WATCH_TIMEOUT})')
+    parser.add_argument('--equalize', action='store_true', help='Clip all runs to the shortest one')
+    parser.add_argument('--json', help='Write the volume counts here')
+    args = parser.parse_args()
+
+    try:
+        counts = {}
+        for run_number, output in args.run:
+            counts[output] = merge_run(args.img_dir, run_number, output, args.tr,
+                                       watch=args.watch, expected=args.expected, timeout=args.timeout)
+            print(f"Run {run_number}: {counts[output]} volumes merged into {output}")
+            if args.expected and counts[output] != args.expected:
+                print(f"WARNING! {counts[output]} volumes found for run {run_number}. {args.expected} expected?")
+        minvols = min(counts.values())
+        if args.equalize and len(counts) > 1 and len(set(counts.values())) > 1:
+            print(f"Clipping runs so that both have {minvols} volumes")
+            equalize_runs(list(counts))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'volumes': counts, 'minvols': minvols}, f, indent=2)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
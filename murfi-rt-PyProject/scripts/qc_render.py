@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+QC images without FSL slices / fsleyes
+
+Renders orthogonal slice mosaics (sagittal, coronal and axial rows) as PNG directly from the
+image arrays, with either the outline of a second image (registration / skullstrip checks, like
+`slices a b -o check.gif`) or coloured masks on top (ROI mask review). Every image is read
+once per call even if several renders use it, renders run in parallel, and all PNGs of the
+participant's qc/ folder are collected into qc/index.html.
+
+PNGs are encoded with zlib, so only numpy and nibabel are needed.
+
+Usage:
+    python qc_render.py --qc-dir ../subjects/<subj>/qc \
+        --edges rest_skullstrip_check_run1 <median.nii> <median_bet.nii> \
+        --masks roi_masks_check <examplefunc.nii> <dmn_thresh.nii> blue <cen_thresh.nii> red
+"""
+
+import argparse
+import glob
+import html
+import os
+import struct
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from fsl_cache import find_file
+
+COLORS = {
+    'red': (255, 0, 0),
+    'blue': (0, 90, 255),
+    'green': (0, 200, 0),
+    'yellow': (255, 230, 0),
+    'cyan': (0, 220, 220),
+    'magenta': (230, 0, 230),
+}
+SLICE_POSITIONS = (0.35, 0.5, 0.65)  # fraction of the field of view along each axis
+TILE_SIZE = 180  # approximate size of one slice in pixels
+MASK_OPACITY = 0.6
+
+
+def write_png(path, rgb):
+    """Write an (height, width, 3) uint8 array as PNG"""
+    height, width, _ = rgb.shape
+    # every scanline starts with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), np.uint8), rgb.reshape(height, width * 3)], axis=1).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def load_volume(path):
+    """3D float32 array in RAS orientation (first volume of a 4D image)"""
+    img = nib.as_closest_canonical(nib.load(find_file(path, required=True)))
+    data = img.get_fdata(dtype=np.float32)
+    return data[..., 0] if data.ndim == 4 else data
+
+
+def to_grey(volume):
+    """Scale to 0-255 between the 2nd and 98th percentile of the non-zero voxels"""
+    nonzero = volume[volume != 0]
+    if nonzero.size == 0:
+        return np.zeros(volume.shape, np.uint8)
+    low, high = np.percentile(nonzero, (2, 98))
+    scaled = (volume - low) / (high - low if high > low else 1)
+    return (np.clip(scaled, 0, 1) * 255).astype(np.uint8)
+
+
+def binarize(volume):
+    """Masks and skullstripped images: voxels > 0; whole-head images: voxels above the mean"""
+    if np.count_nonzero(volume) < 0.9 * volume.size:
+        return volume > 0
+    return volume > volume.mean()
+
+
+def outline(mask):
+    """Voxels of a 2D mask that touch a pixel outside it (4-neighbourhood)"""
+    interior = mask.copy()
+    for axis in range(mask.ndim):
+        interior &= np.roll(mask, 1, axis) & np.roll(mask, -1, axis)
+    return mask & ~interior
+
+
+def orthogonal_slices(volume, positions=SLICE_POSITIONS):
+    """Rows of sagittal, coronal and axial slices, rotated so superior / anterior is up"""
+    rows = []
+    for axis in range(3):
+        indices = [min(int(p * volume.shape[axis]), volume.shape[axis] - 1) for p in positions]
+        rows.append([np.rot90(np.take(volume, i, axis=axis)) for i in indices])
+    return rows
+
+
+def mosaic(background, overlays=(), positions=SLICE_POSITIONS, tile_size=TILE_SIZE):
+    """
+    Compose an RGB mosaic
+
+    Parameters
+    ----------
+    background : np.ndarray
+        3D image shown in greyscale
+    overlays : list of (mask, color, edges)
+        Boolean 3D masks drawn in color (RGB tuple), as an outline if edges is True
+
+    Returns
+    -------
+    (height, width, 3) uint8 array
+    """
+    background_rows = orthogonal_slices(to_grey(background), positions)
+    overlay_rows = [(orthogonal_slices(mask, positions), np.asarray(color, np.float32), edges)
+                    for mask, color, edges in overlays]
+    zoom = max(1, tile_size // max(background.shape))
+    tile_height = max(background.shape) * zoom
+
+    rows = []
+    for r, row in enumerate(background_rows):
+        tiles = []
+        for c, grey in enumerate(row):
+            tile = np.repeat(grey[..., np.newaxis], 3, axis=2).astype(np.float32)
+            for mask_rows, color, edges in overlay_rows:
+                mask = outline(mask_rows[r][c]) if edges else mask_rows[r][c]
+                tile[mask] = (1 - MASK_OPACITY) * tile[mask] + MASK_OPACITY * color
+            tile = tile.astype(np.uint8).repeat(zoom, axis=0).repeat(zoom, axis=1)
+            padded = np.zeros((tile_height, tile_height, 3), np.uint8)
+            top, left = (tile_height - tile.shape[0]) // 2, (tile_height - tile.shape[1]) // 2
+            padded[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+            tiles.append(padded)
+        rows.append(np.concatenate(tiles, axis=1))
+    return np.concatenate(rows, axis=0)
+
+
+class QCRenderer:
+    """
+    Render several QC images of one participant, reading every input image once
+
+    Parameters
+    ----------
+    qc_dir : str
+        Output folder (the participant's qc/ folder)
+    """
+
+    def __init__(self, qc_dir):
+        self.qc_dir = qc_dir
+        os.makedirs(qc_dir, exist_ok=True)
+        self._volumes = {}
+        self._jobs = []
+
+    def volume(self, path_or_array):
+        """Array of an image path (cached), or the array itself if one is given"""
+        if not isinstance(path_or_array, str):
+            return path_or_array
+        if path_or_array not in self._volumes:
+            self._volumes[path_or_array] = load_volume(path_or_array)
+        return self._volumes[path_or_array]
+
+    def add_edges(self, name, background, overlay, color='red'):
+        """Outline of `overlay` on `background` (what `slices background overlay` shows)"""
+        self._jobs.append((name, background, [(overlay, color, True)]))
+
+    def add_masks(self, name, background, masks):
+        """Masks filled in colour on `background`; masks is a list of (image, color name)"""
+        self._jobs.append((name, background, [(mask, color, False) for mask, color in masks]))
+
+    def _render(self, job):
+        name, background, overlays = job
+        masks = [(binarize(self.volume(overlay)), COLORS[color], edges) for overlay, color, edges in overlays]
+        path = os.path.join(self.qc_dir, f'{name}.png')
+        write_png(path, mosaic(self.volume(background), masks))
+        return path
+
+    def render(self, workers=None):
+        """Render all added images in parallel; returns the PNG paths"""
+        # read every image once, up front, so the rendering threads only share finished arrays
+        for _, background, overlays in self._jobs:
+            self.volume(background)
+            for overlay, _, _ in overlays:
+                self.volume(overlay)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            paths = list(pool.map(self._render, self._jobs))
+        self._jobs = []
+        write_index(self.qc_dir)
+        return paths
+
+
+def render_edges(qc_dir, name, background, overlay):
+    """Single outline check (the `slices background overlay -o qc/<name>.gif` replacement)"""
+    renderer = QCRenderer(qc_dir)
+    renderer.add_edges(name, background, overlay)
+    return renderer.render()[0]
+
+
+def write_index(qc_dir, title=None):
+    """qc/index.html with every PNG and GIF of the folder, newest first"""
+    images = sorted(glob.glob(os.path.join(qc_dir, '*.png')) + glob.glob(os.path.join(qc_dir, '*.gif')),
+                    key=os.path.getmtime, reverse=True)
+    title = title or f'QC - {os.path.basename(os.path.dirname(os.path.abspath(qc_dir)))}'
+    parts = [f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>',
+             '<style>body{background:#111;color:#eee;font-family:sans-serif} img{max-width:100%}</style>',
+             f'</head><body>\n<h1>{html.escape(title)}</h1>']
+    for image in images:
+        name = os.path.basename(image)
+        written = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(image)))
+        parts.append(f'<h2>{html.escape(os.path.splitext(name)[0])}</h2><p>{written}</p>'
+                     f'<img src="{html.escape(name)}">')
+    parts.append('</body></html>\n')
+    path = os.path.join(qc_dir, 'index.html')
+    with open(path, 'w') as f:
+        f.write('\n'.join(parts))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render QC mosaics and the participant QC page')
+    parser.add_argument('--qc-dir', required=True, help="Participant's qc folder")
+    parser.add_argument('--edges', nargs=3, action='append', default=[], metavar=('NAME', 'BACKGROUND', 'OVERLAY'),
+                        help='Outline of OVERLAY on BACKGROUND, written to NAME.png')
+    parser.add_argument('--masks', nargs='+', action='append', default=[],
+                        metavar='NAME BACKGROUND MASK COLOR',
+                        help='NAME BACKGROUND followed by MASK COLOR pairs: masks filled on BACKGROUND')
+    parser.add_argument('--workers', type=int, default=None, help='Images rendered at once (default: cores)')
+    args = parser.parse_args()
+
+    renderer = QCRenderer(args.qc_dir)
+    for name, background, overlay in args.edges:
+        renderer.add_edges(name, background, overlay)
+    for spec in args.masks:
+        if len(spec) < 4 or len(spec) % 2:
+            parser.error('--masks needs NAME BACKGROUND and MASK COLOR pairs')
+        pairs = list(zip(spec[2::2], spec[3::2]))
+        unknown = [color for _, color in pairs if color not in COLORS]
+        if unknown:
+            parser.error(f"unknown color(s) {', '.join(unknown)} (choose from {', '.join(COLORS)})")
+        renderer.add_masks(spec[0], spec[1], pairs)
+
+    try:
+        for path in renderer.render(args.workers):
+            print(f"+ QC image: {path}")
+        print(f"+ QC page: {os.path.join(args.qc_dir, 'index.html')}")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+"""
+Resting-state preprocessing and ICA for the extract_rs_networks step
+
+The steps feedback_<site>.sh used to run one after the other (merging, mcflirt,
+fslmaths -Tmedian, flirt, bet, masking, FEAT) are declared as stages with their input and
+output files. The stages form a DAG: independent branches (e.g. run A and run B) run
+concurrently, a stage is skipped when all its outputs are newer than its inputs and it last
+ran with the same command and input files (stamps in <subject>/rest/rest_pipeline_stamps.json),
+and the wall time of every stage is logged to <subject>/rest/rest_pipeline_timing.tsv.
+
+Usage (from the scripts folder, after choosing the runs):
+    python rest_pipeline.py <subj> <runA> [<runB>] [--workers N] [--force] [--dry-run]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from fsl_cache import find_file
+from merge_volumes import count_volumes, merge_run, run_volumes, truncate_volumes
+from qc_render import render_edges
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FSL_SCRIPTS = os.path.join(SCRIPT_DIR, 'fsl_scripts')
+
+SES = 'ses-lo1'
+RUN = 'run-01'
+EXPECTED_VOLUMES = 250
+TR = 1.2
+
+
+class Stage:
+    """
+    One step of the pipeline
+
+    Parameters
+    ----------
+    name : str
+        Unique stage name, used in the log
+    action : list or callable
+        Command to run (argument list), or a function called without arguments
+    inputs, outputs : list of str
+        Files (or directories) read and written by the stage. A stage depends on every
+        stage producing one of its inputs.
+    after : list of str, optional
+        Names of other stages to wait for, without making their outputs inputs
+    """
+
+    def __init__(self, name, action, inputs=(), outputs=(), after=()):
+        self.name = name
+        self.action = action
+        self.after = set(after)
+        self.inputs = [os.path.abspath(p) for p in inputs]
+        self.outputs = [os.path.abspath(p) for p in outputs]
+
+    def stamp(self):
+        """Hash of the command (or function and its arguments) and of the input and output file lists"""
+        if callable(self.action):
+            action = [self.action.__name__] + [repr(a) for a in getattr(self.action, 'args', ())]
+        else:
+            action = [str(a) for a in self.action]
+        signature = json.dumps({'action': action, 'inputs': self.inputs, 'outputs': self.outputs})
+        return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+    def is_up_to_date(self, stamp=None):
+        """
+        All outputs exist, none is older than the newest input, and the stage last ran as it is now
+
+        stamp is what stamp() returned when the outputs were made (None if unknown, e.g. for
+        outputs copied by adopt_incremental_runs: then only the modification times are compared)
+        """
+        if stamp is not None and stamp != self.stamp():
+            return False
+        if not self.outputs:
+            return False
+        output_paths = [find_file(p) for p in self.outputs]
+        if any(p is None for p in output_paths):
+            return False
+        input_paths = [find_file(p) for p in self.inputs]
+        if any(p is None for p in input_paths):
+            return False
+        newest_input = max((os.path.getmtime(p) for p in input_paths), default=0)
+        return min(os.path.getmtime(p) for p in output_paths) >= newest_input
+
+    def run(self):
+        if callable(self.action):
+            self.action()
+        else:
+            subprocess.run([str(a) for a in self.action], check=True)
+
+    def describe(self):
+        return self.action.__name__ if callable(self.action) else ' '.join(str(a) for a in self.action[:4]) + ' ...'
+
+
+class Pipeline:
+    """
+    DAG of stages, run with up to max_workers stages at a time
+
+    Parameters
+    ----------
+    stages : list of Stage
+    log_file : str, optional
+        Tab-separated timing log (stage, status, start time, seconds), appended to
+    stamp_file : str, optional
+        JSON file keeping the stamp of every stage that ran or was up to date; a stage whose
+        command or input files changed since then is rerun even if its outputs are newer
+    """
+
+    def __init__(self, stages, log_file=None, stamp_file=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.log_file = log_file
+        self.stamp_file = stamp_file
+        self.stamps = {}
+        if stamp_file and os.path.exists(stamp_file):
+            with open(stamp_file) as f:
+                self.stamps = json.load(f)
+        self._stamp_lock = threading.Lock()
+        producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.dependencies = {stage.name: ({producers[p] for p in stage.inputs if p in producers} | stage.after)
+                             - {stage.name} for stage in stages}
+
+    def _log(self, name, status, start, seconds):
+        print(f'+ {name:<28} {status:<8} {seconds:8.1f} s')
+        if self.log_file:
+            with open(self.log_file, 'a') as f:
+                f.write(f'{name}\t{status}\t{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))}\t{seconds:.2f}\n')
+
+    def _save_stamp(self, name, stamp):
+        with self._stamp_lock:
+            self.stamps[name] = stamp
+            if self.stamp_file:
+                with open(self.stamp_file, 'w') as f:
+                    json.dump(self.stamps, f, indent=2, sort_keys=True)
+
+    def _run_stage(self, name, force):
+        stage = self.stages[name]
+        start = time.time()
+        if not force and stage.is_up_to_date(self.stamps.get(name)):
+            self._save_stamp(name, stage.stamp())
+            self._log(name, 'skipped', start, 0.0)
+            return 'skipped'
+        # an empty stamp never matches, so outputs of an interrupted or failed run are not trusted
+        self._save_stamp(name, '')
+        stage.run()
+        self._save_stamp(name, stage.stamp())
+        self._log(name, 'ran', start, time.time() - start)
+        return 'ran'
+
+    def run(self, max_workers=None, force=False, dry_run=False):
+        """
+        Run every stage once its dependencies have finished
+
+        Returns
+        -------
+        dict mapping stage name to 'ran', 'skipped', 'failed' or 'blocked' (a dependency failed)
+        """
+        order = self.order()
+        if dry_run:
+            for name in order:
+                print(f'{name:<28} after {sorted(self.dependencies[name]) or "-"}: {self.stages[name].describe()}')
+            return {}
+
+        status = {}
+        running = {}
+        pending = set(self.stages)
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            while pending or running:
+                for name in sorted(pending):
+                    dependencies = self.dependencies[name]
+                    if any(status.get(d) in ('failed', 'blocked') for d in dependencies):
+                        status[name] = 'blocked'
+                        pending.discard(name)
+                        print(f'+ {name:<28} blocked (a previous stage failed)')
+                    elif all(status.get(d) in ('ran', 'skipped') for d in dependencies):
+                        running[pool.submit(self._run_stage, name, force)] = name
+                        pending.discard(name)
+                if not running:
+                    # order() guarantees a runnable stage while any are pending
+                    raise RuntimeError(f'No stage can run: {sorted(pending)}')
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        status[name] = 'failed'
+                        print(f'+ {name:<28} FAILED: {e}')
+        return status
+
+    def order(self):
+        """Stage names in a valid execution order (ValueError for unknown `after` names or a cycle)"""
+        for name, dependencies in self.dependencies.items():
+            unknown = dependencies - set(self.stages)
+            if unknown:
+                raise ValueError(f'Stage {name} waits for unknown stage(s): {sorted(unknown)}')
+        ordered, done = [], set()
+        while len(ordered) < len(self.stages):
+            ready = [n for n in self.stages if n not in done and self.dependencies[n] <= done]
+            if not ready:
+                raise ValueError(f'Dependency cycle between stages: {sorted(set(self.stages) - done)}')
+            ordered += ready
+            done.update(ready)
+        return ordered
+
+
+def _bind(function, *args):
+    """function(*args) as a stage action, named after the function in the log"""
+    def action():
+        function(*args)
+    action.__name__ = function.__name__
+    action.args = args
+    return action
+
+
+def build_rest_stages(subj, runs, subj_dir=None, expected_volumes=EXPECTED_VOLUMES, tr=TR):
+    """
+    Stages of the resting-state preprocessing + ICA for 1 or 2 runs
+
+    Mirrors what extract_rs_networks did in feedback_<site>.sh: run 2 is registered to the
+    median of run 1, both runs are masked with the skullstripped median of run 1, and FEAT
+    runs a multi-run (2 runs) or single-run ICA.
+    """
+    subj_dir = subj_dir or os.path.join(os.path.dirname(SCRIPT_DIR), 'subjects', subj)
+    rest = os.path.join(subj_dir, 'rest')
+    qc = os.path.join(subj_dir, 'qc')
+    img_dir = os.path.join(subj_dir, 'img')
+    os.makedirs(rest, exist_ok=True)
+    os.makedirs(qc, exist_ok=True)
+
+    def rest_file(suffix):
+        return os.path.join(rest, f'{subj}_{SES}_task-rest_{suffix}')
+
+    labels = ['run-01', 'run-02'][:len(runs)]
+    bold = {label: rest_file(f'{label}_bold.nii') for label in labels}
+    mcf = {label: rest_file(f'{label}_bold_mcflirt.nii') for label in labels}
+    median = {label: rest_file(f'{label}_bold_mcflirt_median.nii') for label in labels}
+    volume_counts = rest_file('volume_counts.json')
+    stages = []
+
+    # merge individual volumes to make 1 file for each resting state run
+    for label, run_number in zip(labels, runs):
+        volumes = run_volumes(img_dir, run_number)
+        stages.append(Stage(f'merge_{label}', _bind(merge_run, img_dir, run_number, bold[label], tr),
+                            inputs=volumes, outputs=[bold[label]]))
+
+    def equalize_lengths():
+        """Clip both runs to the shorter one and record the volume counts used for FEAT"""
+        counts = {label: count_volumes(bold[label]) for label in labels}
+        minvols = min(counts.values())
+        if len(labels) == 2 and any(n != expected_volumes for n in counts.values()):
+            print(f"WARNING! {counts['run-01']} volumes of resting-state data found for run 1.")
+            print(f"{counts['run-02']} volumes of resting-state data found for run 2. {expected_volumes} expected?")
+            print(f"Clipping runs so that both have {minvols} volumes")
+            for label in labels:
+                if counts[label] != minvols:
+                    truncate_volumes(bold[label], minvols)
+                    # motion-corrected volumes from rest_watcher.py are per volume, clip them the same way
+                    motion_corrected = find_file(mcf[label])
+                    if (motion_corrected and motion_corrected.endswith('.nii')
+                            and count_volumes(motion_corrected) == counts[label]):
+                        truncate_volumes(motion_corrected, minvols)
+        elif len(labels) == 2:
+            minvols = expected_volumes
+        else:
+            print(f"{minvols} volumes of resting-state data found for run 1.")
+        with open(volume_counts, 'w') as f:
+            json.dump({'volumes': counts, 'minvols': minvols}, f, indent=2)
+
+    stages.append(Stage('equalize_lengths', equalize_lengths, inputs=list(bold.values()), outputs=[volume_counts]))
+
+    # realign volumes pre-FEAT and get the median volume of each run
+    # (mcflirt only reruns if clipping changed the run, so results of rest_watcher.py are kept)
+    for label in labels:
+        stages.append(Stage(f'mcflirt_{label}', ['mcflirt', '-in', bold[label], '-out', mcf[label]],
+                            inputs=[bold[label]], outputs=[mcf[label]], after=['equalize_lengths']))
+        stages.append(Stage(f'median_{label}', ['fslmaths', mcf[label], '-Tmedian', median[label]],
+                            inputs=[mcf[label]], outputs=[median[label]]))
+
+    # skullstrip median of 1st run & check the generated mask
+    bet = rest_file('run-01_bold_mcflirt_median_bet.nii')
+    bet_mask = rest_file('run-01_bold_mcflirt_median_bet_mask.nii')
+    stages.append(Stage('bet_run-01', ['bet', median['run-01'], bet, '-R', '-f', '0.4', '-g', '0', '-m'],
+                        inputs=[median['run-01']], outputs=[bet, bet_mask]))
+    stages.append(Stage('qc_skullstrip_run-01',
+                        _bind(render_edges, qc, 'rest_skullstrip_check_run1', median['run-01'], bet),
+                        inputs=[median['run-01'], bet], outputs=[os.path.join(qc, 'rest_skullstrip_check_run1.png')]))
+
+    # mask run 1 by the mask from skullstriped median of 1st run
+    masked = {'run-01': rest_file('run-01_bold_mcflirt_masked.nii')}
+    stages.append(Stage('mask_run-01', ['fslmaths', mcf['run-01'], '-mas', bet_mask, masked['run-01']],
+                        inputs=[mcf['run-01'], bet_mask], outputs=[masked['run-01']]))
+
+    if len(labels) == 2:
+        # calculate registration matrix of median of 2nd run to median of 1st run, check it, and apply it to the 2nd run
+        median2to1 = rest_file('run2_median_to_run1_median.nii')
+        median2to1_mat = rest_file('run2_median_to_run1_median.mat')
+        run2_run1space = rest_file('run-02_bold_mcflirt_run1space.nii')
+        masked['run-02'] = rest_file('run-02_bold_mcflirt_run1space_masked.nii')
+        stages.append(Stage('register_run-02', ['flirt', '-cost', 'leastsq', '-dof', '6', '-noresample', '-noresampblur',
+                                                '-in', median['run-02'], '-ref', median['run-01'],
+                                                '-out', median2to1, '-omat', median2to1_mat],
+                            inputs=[median['run-01'], median['run-02']], outputs=[median2to1, median2to1_mat]))
+        stages.append(Stage('qc_register_run-02', _bind(render_edges, qc, 'flirt_median_rest_check', median['run-01'],
+                                                        median2to1),
+                            inputs=[median['run-01'], median2to1],
+                            outputs=[os.path.join(qc, 'flirt_median_rest_check.png')]))
+        stages.append(Stage('applyxfm_run-02', ['flirt', '-noresample', '-noresampblur', '-interp', 'nearestneighbour',
+                                                '-in', mcf['run-02'], '-ref', median['run-01'], '-out', run2_run1space,
+                                                '-init', median2to1_mat, '-applyxfm'],
+                            inputs=[mcf['run-02'], median['run-01'], median2to1_mat], outputs=[run2_run1space]))
+        stages.append(Stage('mask_run-02', ['fslmaths', run2_run1space, '-mas', bet_mask, masked['run-02']],
+                            inputs=[run2_run1space, bet_mask], outputs=[masked['run-02']]))
+
+    # update FEAT template with paths and # of volumes of resting state run, then run the ICA
+    fsf = os.path.join(rest, f'{subj}_{SES}_task-rest_{RUN}_bold.fsf')
+    output_dir = os.path.join(rest, 'rs_network')
+    template = os.path.join(FSL_SCRIPTS, 'basic_ica_template.fsf' if len(labels) == 2
+                            else 'basic_ica_template_single_run.fsf')
+
+    def write_fsf():
+        with open(volume_counts) as f:
+            npts = json.load(f)['minvols']
+        with open(template) as f:
+            design = f.read()
+        if len(labels) == 2:
+            design = design.replace('DATA1', masked['run-01']).replace('DATA2', masked['run-02'])
+        else:
+            design = design.replace('DATA', masked['run-01'])
+        design = design.replace('OUTPUT', output_dir).replace('REFERENCE_VOL', bet)
+        design = design.replace('set fmri(npts) 250', f'set fmri(npts) {npts}')
+        with open(fsf, 'w') as f:
+            f.write(design)
+
+    stages.append(Stage('write_fsf', write_fsf, inputs=[template, volume_counts, bet] + list(masked.values()),
+                        outputs=[fsf]))
+    feat_dir = output_dir + ('.gica' if len(labels) == 2 else '.ica')
+    stages.append(Stage('feat', ['feat', fsf], inputs=[fsf], outputs=[feat_dir]))
+    return stages
+
+
+def adopt_incremental_runs(subj, runs, subj_dir=None):
+    """
+    Use what rest_watcher.py already computed while the runs were acquired
+
+    The merged run, motion-corrected run, median and (for run 1) bet outputs of every finished
+    run are copied to the names the stages use, keeping their modification times, so those
+    stages are skipped as up to date. Existing files are never replaced.
+    """
+    from rest_watcher import CACHE_FILES, load_cached_run
+
+    subj_dir = subj_dir or os.path.join(os.path.dirname(SCRIPT_DIR), 'subjects', subj)
+    rest = os.path.join(subj_dir, 'rest')
+    for label, run_number in zip(['run-01', 'run-02'], runs):
+        cached = load_cached_run(subj_dir, run_number)
+        if cached is None:
+            continue
+        keys = CACHE_FILES if label == 'run-01' else ['bold', 'mcflirt', 'median']
+        for key in keys:
+            target = os.path.join(rest, f'{subj}_{SES}_task-rest_{label}_{CACHE_FILES[key]}')
+            if find_file(target) is None:
+                shutil.copy2(cached[key], target + ('.gz' if cached[key].endswith('.gz') else ''))
+        print(f'+ using the preprocessing done during acquisition for run {run_number} ({label})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resting-state preprocessing and ICA for one participant')
+    parser.add_argument('subj', help='Subject ID (folder in ../subjects)')
+    parser.add_argument('runs', nargs='+', help='Resting state run number(s) in img/ (1 or 2)')
+    parser.add_argument('--workers', type=int, default=None, help='Stages to run at once (default: number of cores)')
+    parser.add_argument('--force', action='store_true', help='Rerun stages even if their outputs are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the stages in execution order')
+    parser.add_argument('--no-incremental', action='store_true',
+                        help='Ignore what rest_watcher.py computed during acquisition')
+    args = parser.parse_args()
+    if len(args.runs) > 2:
+        parser.error('use 1 or 2 resting state runs')
+
+    stages = build_rest_stages(args.subj, args.runs)
+    if not args.no_incremental and not args.force:
+        adopt_incremental_runs(args.subj, args.runs)
+    rest = os.path.join(os.path.dirname(SCRIPT_DIR), 'subjects', args.subj, 'rest')
+    pipeline = Pipeline(stages, log_file=os.path.join(rest, 'rest_pipeline_timing.tsv'),
+                        stamp_file=os.path.join(rest, 'rest_pipeline_stamps.json'))
+
+    start = time.time()
+    status = pipeline.run(max_workers=args.workers, force=args.force, dry_run=args.dry_run)
+    if args.dry_run:
+        return
+    print(f'+ pipeline finished in {time.time() - start:.1f} s')
+    if any(s in ('failed', 'blocked') for s in status.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Preprocess resting-state runs while they are being acquired
+
+Started in the background by the resting_state step of feedback_<site>.sh, next to MURFI.
+Every run that starts arriving in the subject's img/ folder is processed volume by volume:
+
+    - the volume is appended to the run's 4D image (as merge_volumes.py does)
+    - motion estimation: the volume is registered to the first volume of the run with flirt
+      (6 dof, normcorr cost, like mcflirt) and appended to the motion-corrected 4D image
+    - every --checkpoint volumes, the median of the motion-corrected volumes so far is
+      recomputed and skullstripped with bet, so the brain mask can be checked early
+
+A run is finished once no new volume arrived for --run-idle seconds (or when the watcher is
+stopped with SIGTERM / Ctrl-C): the final median and bet mask are computed and the results are
+written to rest/incremental/run-<NN>/ with a done.json. rest_pipeline.py picks those up for
+the runs chosen in extract_rs_networks, so only registration of run 2, masking and ICA remain.
+
+Note: motion correction uses the first volume as reference (mcflirt uses the middle volume,
+which is not known until the run is over).
+
+Usage (from the scripts folder):
+    python rest_watcher.py <subj> [--runs 02 03] [--checkpoint 50] [--run-idle 20]
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+from fsl_cache import find_file
+from merge_volumes import TR, StreamingMerger, _is_complete, run_volumes
+from rest_pipeline import SCRIPT_DIR
+
+CHECKPOINT_VOLUMES = 50
+RUN_IDLE = 20
+POLL_INTERVAL = 0.2
+VOLUME_NAME = re.compile(r'^img-000(\d{2})-\d+\.nii(\.gz)?$', re.IGNORECASE)
+
+# names of the cached files (the rest_pipeline names without the subject/session/run prefix)
+CACHE_FILES = {
+    'bold': 'bold.nii',
+    'mcflirt': 'bold_mcflirt.nii',
+    'median': 'bold_mcflirt_median.nii',
+    'bet': 'bold_mcflirt_median_bet.nii',
+    'bet_mask': 'bold_mcflirt_median_bet_mask.nii',
+}
+
+
+def cache_dir(subj_dir, run_number):
+    return os.path.join(subj_dir, 'rest', 'incremental', f'run-{run_number}')
+
+
+def load_cached_run(subj_dir, run_number):
+    """
+    Paths of a finished run's incremental results, or None
+
+    Only returned if the run is complete: done.json exists and the run still has exactly the
+    volumes that were processed.
+    """
+    run_dir = cache_dir(subj_dir, run_number)
+    try:
+        with open(os.path.join(run_dir, 'done.json')) as f:
+            done = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if done['volumes'] != len(run_volumes(os.path.join(subj_dir, 'img'), run_number)):
+        return None
+    paths = {key: find_file(os.path.join(run_dir, name)) for key, name in CACHE_FILES.items()}
+    return paths if all(paths.values()) else None
+
+
+class RunWatcher:
+    """
+    Incremental preprocessing of one run
+
+    Parameters
+    ----------
+    img_dir : str
+        Folder MURFI writes the volumes to
+    run_number : str
+        Two-digit run number (img-000<run>-<volume>.nii)
+    out_dir : str
+        Where the run's results are written
+    """
+
+    def __init__(self, img_dir, run_number, out_dir, tr=TR, checkpoint=CHECKPOINT_VOLUMES):
+        self.img_dir = img_dir
+        self.run_number = run_number
+        self.out_dir = out_dir
+        self.checkpoint = checkpoint
+        self.paths = {key: os.path.join(out_dir, name) for key, name in CACHE_FILES.items()}
+        self.mats_dir = os.path.join(out_dir, 'mats')
+        os.makedirs(self.mats_dir, exist_ok=True)
+        self.raw = StreamingMerger(self.paths['bold'], tr)
+        self.motion_corrected = StreamingMerger(self.paths['mcflirt'], tr, dtype=np.float32)
+        self.reference = None
+        self.merged = set()
+        self.last_volume_time = time.time()
+        self.finished = False
+
+    def update(self):
+        """Process the volumes that arrived since the last call, in order; returns how many"""
+        processed = 0
+        for volume in run_volumes(self.img_dir, self.run_number):
+            if volume in self.merged:
+                continue
+            if not _is_complete(volume):
+                break
+            self._process(volume)
+            processed += 1
+        return processed
+
+    def _process(self, volume):
+        index = self.raw.n_volumes
+        self.raw.append(volume)
+        self.merged.add(volume)
+        self.last_volume_time = time.time()
+
+        mat = os.path.join(self.mats_dir, f'MAT_{index:04d}')
+        if self.reference is None:
+            self.reference = volume
+            np.savetxt(mat, np.eye(4), fmt='%.6f')
+            self.motion_corrected.append(volume)
+        else:
+            registered = os.path.join(self.mats_dir, 'registered.nii')
+            subprocess.run(['flirt', '-in', volume, '-ref', self.reference, '-dof', '6', '-cost', 'normcorr',
+                            '-interp', 'trilinear', '-omat', mat, '-out', registered], check=True)
+            registered = find_file(registered)
+            self.motion_corrected.append(registered)
+            os.remove(registered)
+
+        if self.raw.n_volumes % self.checkpoint == 0:
+            self.update_mask()
+            print(f"+ run {self.run_number}: {self.raw.n_volumes} volumes, brain mask updated")
+
+    def update_mask(self):
+        """Median of the motion-corrected volumes so far, skullstripped like rest_pipeline's bet stage"""
+        img = nib.load(self.paths['mcflirt'], mmap=True)
+        median = np.median(np.asanyarray(img.dataobj), axis=3).astype(np.float32)
+        header = img.header.copy()
+        header.set_data_shape(median.shape)
+        nib.save(nib.Nifti1Image(median, img.affine, header), self.paths['median'])
+        subprocess.run(['bet', self.paths['median'], self.paths['bet'], '-R', '-f', '0.4', '-g', '0', '-m'],
+                       check=True)
+
+    def finish(self):
+        """Close the 4D images, compute the final median and mask, and mark the run as done"""
+        if self.raw.n_volumes and self.raw.n_volumes % self.checkpoint != 0:
+            self.update_mask()
+        self.raw.close()
+        self.motion_corrected.close()
+        with open(os.path.join(self.out_dir, 'done.json'), 'w') as f:
+            json.dump({'run': self.run_number, 'volumes': self.raw.n_volumes,
+                       'reference': self.reference}, f, indent=2)
+        self.finished = True
+        print(f"+ run {self.run_number}: done, {self.raw.n_volumes} volumes preprocessed")
+
+
+def new_runs(img_dir, since, runs=None):
+    """Run numbers in img_dir whose first volume was written after `since` (or the given runs)"""
+    found = set()
+    for name in os.listdir(img_dir):
+        match = VOLUME_NAME.match(name)
+        if not match or (runs and match.group(1) not in runs):
+            continue
+        if runs or os.path.getmtime(os.path.join(img_dir, name)) >= since:
+            found.add(match.group(1))
+    return found
+
+
+def watch(subj_dir, runs=None, tr=TR, checkpoint=CHECKPOINT_VOLUMES, run_idle=RUN_IDLE):
+    """Preprocess runs as they arrive until SIGTERM / Ctrl-C, then finish the open runs"""
+    img_dir = os.path.join(subj_dir, 'img')
+    os.makedirs(img_dir, exist_ok=True)
+    start_time = time.time()
+    watchers = {}
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    print(f"+ watching {img_dir} for resting state volumes")
+    try:
+        while not stopping:
+            for run_number in sorted(new_runs(img_dir, start_time, runs) - set(watchers)):
+                out_dir = cache_dir(subj_dir, run_number)
+                shutil.rmtree(out_dir, ignore_errors=True)
+                watchers[run_number] = RunWatcher(img_dir, run_number, out_dir, tr, checkpoint)
+                print(f"+ run {run_number}: started")
+            for watcher in watchers.values():
+                if watcher.finished:
+                    continue
+                watcher.update()
+                if watcher.raw.n_volumes and time.time() - watcher.last_volume_time > run_idle:
+                    watcher.finish()
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+    for watcher in watchers.values():
+        if not watcher.finished:
+            watcher.update()
+            if watcher.raw.n_volumes:
+                watcher.finish()
+    return watchers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess resting-state runs while they are acquired')
+    parser.add_argument('subj', help='Subject ID (folder in ../subjects)')
+    parser.add_argument('--runs', nargs='+', help='Only these run numbers (default: every run started after launch)')
+    parser.add_argument('--tr', type=float, default=TR, help=f'Repetition time (default: {TR})')
+    parser.add_argument('--checkpoint', type=int, default=CHECKPOINT_VOLUMES,
+                        help=f'Update the median and brain mask every N volumes (default: {CHECKPOINT_VOLUMES})')
+    parser.add_argument('--run-idle', type=float, default=RUN_IDLE,
+                        help=f'Seconds without a new volume after which a run is finished (default: {RUN_IDLE})')
+    args = parser.parse_args()
+
+    subj_dir = os.path.join(os.path.dirname(SCRIPT_DIR), 'subjects', args.subj)
+    try:
+        watch(subj_dir, args.runs, args.tr, args.checkpoint, args.run_idle)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
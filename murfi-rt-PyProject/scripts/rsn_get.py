@@ -1,89 +1,152 @@
 #!/usr/bin/env python
-# coding: utf-8
+"""
+Select the ICs most strongly correlated with the DMN and CEN template networks
 
-# In[1]:
+Reads the fslcc correlation file (3 columns: IC #, template network # (DMN=1, CEN=2),
+correlation) with the standard library and copies the selected melodic_IC_<####>.nii
+components to dmn_uthresh.nii / cen_uthresh.nii. If the components were not split with
+fslsplit, the selected volume is taken from melodic_IC.nii instead.
 
+Only the standard library is imported unless a component has to be extracted from the 4D
+image or --flip is given (then nibabel/numpy are loaded).
 
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from nipype.interfaces import fsl
-from nipype.interfaces.fsl import MotionOutliers
-import os.path
-import subprocess
+Usage:
+    python rsn_get.py <subjID> <multi_run|single_run> [--flip]
+"""
+
+import argparse
+import gzip
 import os
-from glob import glob
+import shutil
 import sys
-import pandas as pd
-from nipype.interfaces.fsl import ImageStats
-
-subjID = sys.argv[1]
-ica_version=sys.argv[2]
-
-if ica_version == 'multi_run':
-    ica_directory=f'../subjects/{subjID}/rest/rs_network.gica/groupmelodic.ica/'
-    dmn_component=f'{ica_directory}/dmn_uthresh.nii'
-    cen_component=f'{ica_directory}/cen_uthresh.nii' 
-elif ica_version == 'single_run':
-    ica_directory=f'../subjects/{subjID}/rest/rs_network.ica/'
-    dmn_component=f'{ica_directory}/dmn_uthresh.nii'
-    cen_component=f'{ica_directory}/cen_uthresh.nii' 
-
-# Define file paths for file with correlations and IC output files
-correlfile=f'{ica_directory}/template_rsn_correlations_with_ICs.txt' 
-split_outfile=f'{ica_directory}/melodic_IC_'
-
-'''
-Read correlation file
-3 columns: IC#, Yeo Network # (DMN=1, CEN=2), Correlation
-'''
-
-fslcc_info = pd.read_csv(correlfile, sep=' ', skipinitialspace=True, header=None)
-fslcc_info.columns= ['ic_number', 'yeo_network_number', 'correlation']
-
-# Absolute value of correlations (ICs could be negatively correlated with corresponding networks)
-fslcc_info['correlation_abs'] = np.abs(fslcc_info.correlation)
-fslcc_info.sort_values(by=['correlation_abs', 'yeo_network_number'], ascending=False, inplace=True)
-
-# Correlations specifically with DMN and CEN
-dmn_info = fslcc_info[fslcc_info.yeo_network_number == 1]
-cen_info = fslcc_info[fslcc_info.yeo_network_number == 2]
-
-# Select ICs with strongest absolute value correlations
-dmn_strongest_ic = dmn_info[dmn_info.correlation_abs == dmn_info.correlation_abs.max()].head(1)
-cen_strongest_ic = cen_info[cen_info.correlation_abs == cen_info.correlation_abs.max()].head(1)
-
-#remove .iloc[0] in the nect comands for older versions of pandas
-dmn_ic_selection = int(dmn_strongest_ic.ic_number.iloc[0])-1 
-cen_ic_selection  = int(cen_strongest_ic.ic_number.iloc[0])-1
-
-print('DMN:', dmn_strongest_ic)
-print('CEN:', cen_strongest_ic)
-
-print(f'DMN: melodic_IC_{dmn_ic_selection}')
-print(f'CEN: melodic_IC_{cen_ic_selection}')
-
-# Pull the correct IC nifti files
-dmnfuncfile=split_outfile+'%0.4d.nii' % dmn_ic_selection
-cenfuncfile=split_outfile+'%0.4d.nii' % cen_ic_selection
-
-# Copy IC nifti files to new location as unthreshold DMN/CEN components
-os.system('cp %s %s' %(dmnfuncfile,dmn_component))
-os.system('cp %s %s' %(cenfuncfile,cen_component))
-
-# If either IC was loading negatively on the respective network, flip the sign of all voxels by multiplying by -1
-
-#if float(dmn_strongest_ic.correlation.iloc[0]) < 0:
-#    print('Flipping IC Loadings for DMN')
-#    os.system(f'fslmaths {dmn_component} -mul -1 {dmn_component}')
-
-#if float(cen_strongest_ic.correlation.iloc[0]) < 0:
-#    print('Flipping IC Loadings for CEN')
-#    os.system(f'fslmaths {cen_component} -mul -1 {cen_component}')
-    #print(f"Running: fslmaths {cen_component} -mul -1 {cen_component}")
-    
-
-    
-    
-    
-    
+
+from fsl_cache import find_file
+
+# template network numbers in the correlation file
+NETWORK_NUMBERS = {'dmn': 1, 'cen': 2}
+ICA_DIRECTORIES = {
+    'multi_run': '../subjects/{subj}/rest/rs_network.gica/groupmelodic.ica/',
+    'single_run': '../subjects/{subj}/rest/rs_network.ica/',
+}
+
+
+def read_correlations(correlfile):
+    """
+    Parse the fslcc output
+
+    Returns
+    -------
+    list of (ic_number, network_number, correlation) tuples, numbers 1-based
+    """
+    correlations = []
+    with open(correlfile) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3:
+                correlations.append((int(fields[0]), int(fields[1]), float(fields[2])))
+    return correlations
+
+
+def strongest_ics(correlations, network_numbers=NETWORK_NUMBERS):
+    """
+    IC with the strongest absolute correlation for each network
+
+    ICs could be negatively correlated with their network, so the absolute value is used;
+    ties go to the lowest IC number.
+
+    Returns
+    -------
+    dict mapping network name to (ic_number, correlation)
+    """
+    selection = {}
+    for name, network_number in network_numbers.items():
+        rows = [(ic, r) for ic, network, r in correlations if network == network_number]
+        if not rows:
+            raise ValueError(f"No correlations with network {network_number} ({name.upper()})")
+        selection[name] = max(rows, key=lambda row: (abs(row[1]), -row[0]))
+    return selection
+
+
+def copy_component(ica_directory, ic_number, out_path):
+    """
+    Copy melodic_IC_<####>.nii (0-based index) to out_path, or extract it from melodic_IC.nii
+
+    The component is decompressed (or compressed) when its extension differs from out_path's,
+    e.g. melodic_IC_0003.nii.gz -> dmn_uthresh.nii.
+    """
+    split_file = find_file(os.path.join(ica_directory, f'melodic_IC_{ic_number - 1:04d}.nii'))
+    if split_file:
+        if split_file.endswith('.gz') == out_path.endswith('.gz'):
+            shutil.copyfile(split_file, out_path)
+        else:
+            open_source = gzip.open if split_file.endswith('.gz') else open
+            open_target = gzip.open if out_path.endswith('.gz') else open
+            with open_source(split_file, 'rb') as source, open_target(out_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+        return
+    ic_file = find_file(os.path.join(ica_directory, 'melodic_IC.nii'))
+    if ic_file is None:
+        raise FileNotFoundError(f"Neither melodic_IC_{ic_number - 1:04d}.nii nor melodic_IC.nii in {ica_directory}")
+    from ica_network_selection import write_component
+    write_component(ic_file, ic_number - 1, out_path)
+
+
+def flip_sign(image_path):
+    """Multiply all voxels by -1 in place (as fslmaths <image> -mul -1 <image>)"""
+    import nibabel as nib
+    import numpy as np
+
+    img = nib.load(image_path, mmap=False)
+    data = -np.asarray(img.dataobj)
+    header = img.header.copy()
+    header.set_slope_inter(1, 0)
+    nib.save(type(img)(data.astype(header.get_data_dtype()), img.affine, header), image_path)
+
+
+def get_rsn(subjID, ica_version, flip=False):
+    """
+    Select and copy the DMN/CEN components of a participant
+
+    Parameters
+    ----------
+    subjID : str
+    ica_version : str
+        'multi_run' or 'single_run'
+    flip : bool
+        Flip the sign of components that correlate negatively with their network
+
+    Returns
+    -------
+    dict mapping network name to (ic_number, correlation)
+    """
+    ica_directory = ICA_DIRECTORIES[ica_version].format(subj=subjID)
+    correlfile = os.path.join(ica_directory, 'template_rsn_correlations_with_ICs.txt')
+    selection = strongest_ics(read_correlations(correlfile))
+
+    for name, (ic_number, correlation) in selection.items():
+        print(f'{name.upper()}: melodic_IC_{ic_number - 1:04d} (IC {ic_number}, r = {correlation:.4f})')
+        component = os.path.join(ica_directory, f'{name}_uthresh.nii')
+        copy_component(ica_directory, ic_number, component)
+        if flip and correlation < 0:
+            print(f'Flipping IC Loadings for {name.upper()}')
+            flip_sign(component)
+    return selection
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Select the DMN/CEN ICs from the fslcc correlation file')
+    parser.add_argument('subjID', help='Subject ID (folder in ../subjects)')
+    parser.add_argument('ica_version', choices=sorted(ICA_DIRECTORIES), help='Multi-run or single-run ICA')
+    parser.add_argument('--flip', action='store_true',
+                        help='Flip the sign of components negatively correlated with their network')
+    args = parser.parse_args()
+
+    try:
+        get_rsn(args.subjID, args.ica_version, args.flip)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
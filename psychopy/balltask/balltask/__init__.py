@@ -0,0 +1,26 @@
+"""
+DMN/CEN ball task (real-time fMRI neurofeedback with MURFI)
+
+One task for every site; site differences are described by a SiteProfile.
+
+Usage:
+    from balltask import run_session, MGH
+    run_session(MGH)
+
+or from the command line (run from the ball task folder):
+    python -m balltask mgh [participant run feedback_on feedback_condition anchor]
+
+psychopy is only imported by run_session, so the site profiles and the ball logic in
+balltask.ball can be imported (and tested) without it.
+"""
+
+from .sites import MGH, SITE_PROFILES, YALE, SiteProfile
+
+
+def run_session(config, argv=None):
+    """Run one ball task run for a site (see balltask.session.run_session)"""
+    from .session import run_session as _run_session
+    return _run_session(config, argv)
+
+
+__all__ = ['MGH', 'YALE', 'SITE_PROFILES', 'SiteProfile', 'run_session']
@@ -0,0 +1,11 @@
+"""python -m balltask <site> [participant run feedback_on feedback_condition anchor]"""
+
+import sys
+
+from . import SITE_PROFILES, run_session
+
+if len(sys.argv) < 2 or sys.argv[1] not in SITE_PROFILES:
+    sys.exit(f"usage: python -m balltask {{{','.join(SITE_PROFILES)}}} [participant run feedback_on feedback_condition anchor]")
+
+# drop the site name so the remaining arguments line up with the rt-network_feedback_<site>.py ones
+run_session(sys.argv[1], [sys.argv[0]] + sys.argv[2:])
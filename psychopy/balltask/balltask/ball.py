@@ -0,0 +1,199 @@
+"""
+Ball movement and hit logic, independent of PsychoPy
+
+These are the per-volume and per-frame hot paths of the feedback routine. They only use
+numpy, so they can be profiled and tested without opening a window.
+"""
+
+import numpy as np
+
+# Direction the ball moves when each ROI wins: CEN (target 0) is up, DMN (target 1) is down
+POSITIONS = [1, -1]
+
+# Internal scale factor to keep feedback in range (higher means the ball moves more SLOWLY)
+INTERNAL_SCALER = 10
+
+
+def in_circle(center_x, center_y, radius, x, y):
+    """Whether (x, y) is inside the circle"""
+    square_dist = (center_x - x) ** 2 + (center_y - y) ** 2
+    return square_dist <= radius ** 2
+
+
+def further_than_circles(position, circle_center, ball_center):
+    """
+    Whether the ball has passed the middle of a target circle
+
+    Parameters
+    ----------
+    position : int
+        0 for the top (CEN) circle, 1 for the bottom (DMN) circle
+    circle_center, ball_center : float
+        y positions
+    """
+    # if ball is above center of top circle
+    if position == 0:
+        further = ball_center > circle_center
+    # if ball is below center of bottom circle
+    elif position == 1:
+        further = ball_center < circle_center
+    return further
+
+
+def is_pda_outlier(roi_activities, threshold):
+    """A volume is an outlier when any ROI activation is larger than the threshold in absolute value"""
+    return np.nanmax(np.abs(roi_activities)) > threshold
+
+
+def pda_direction(roi_activities):
+    """
+    Direction and size of the ball's movement for one volume
+
+    Parameters
+    ----------
+    roi_activities : list
+        [CEN, DMN] activations for the volume
+
+    Returns
+    -------
+    (winner, direction, activity) : winner is the index of the ROI with the highest activation,
+        direction its entry in POSITIONS and activity |max - min| / 10 (always positive).
+        None when the mean activation is exactly 0 (the ball keeps its previous movement).
+    """
+    if np.nanmean(roi_activities) == 0:
+        return None
+    winner = roi_activities.index(np.nanmax(roi_activities))
+    activity = abs(np.nanmax(roi_activities) - np.nanmin(roi_activities)) / 10
+    return winner, POSITIONS[winner], activity
+
+
+def calculate_ball_position(circle_reference_position, activation, ball_x_position, ball_y_position, outlier,
+                            scale_factor_z2pixels, tr_to_frame_ratio):
+    """
+    Ball position after one more screen frame
+
+    The ball moves by direction * activity * (scale_factor / INTERNAL_SCALER) per TR, spread over
+    the frames in a TR. The ball stays put on PDA outlier volumes.
+    """
+    # New cursor position (of ball) will be dot product of position (negative if DMN, positive if CEN) and activity (always positive)
+    cursor_position = np.dot(circle_reference_position, activation)
+
+    # only update ball position if the PDA metric isn't an outlier
+    if not outlier:
+        # The position of the target circle cumulatively adds the scaled cursor position on each frame
+        ball_y_position = ball_y_position + (np.real(cursor_position) * (scale_factor_z2pixels / INTERNAL_SCALER) / tr_to_frame_ratio)
+        ball_x_position = ball_x_position + (np.imag(cursor_position) * scale_factor_z2pixels / INTERNAL_SCALER / tr_to_frame_ratio)
+
+    return (ball_x_position, ball_y_position)
+
+
+def adjust_scale_factor(last_run_scale_factor, last_run_cen_hits, last_run_dmn_hits, min_hits=3, max_hits=5):
+    """
+    Scale factor for the next run given the hits in the last complete run
+
+    More than max_hits in either direction slows the ball down (x0.75), fewer than min_hits in
+    total speeds it up (x1.25), otherwise the scale factor is kept.
+    """
+    if last_run_dmn_hits > max_hits or last_run_cen_hits > max_hits:
+        return last_run_scale_factor * 0.75
+    elif last_run_cen_hits + last_run_dmn_hits < min_hits:
+        return last_run_scale_factor * 1.25
+    return last_run_scale_factor
+
+
+class VirtualBall:
+    """
+    Ball driven by a SHAM participant's own brain activity, used only to count hits
+
+    The SHAM participant sees the yoked ball of their matched REAL participant; this ball is
+    never drawn. Each volume advances it int(tr_to_frame_ratio) frames exactly like the REAL
+    ball, stopping at the first hit, after which it goes back to the middle.
+
+    Parameters
+    ----------
+    tr_to_frame_ratio : float
+        Screen frames per TR
+    scale_factor_z2pixels : int
+        The run's scale factor
+    """
+
+    def __init__(self, tr_to_frame_ratio, scale_factor_z2pixels):
+        self.tr_to_frame_ratio = tr_to_frame_ratio
+        self.scale_factor_z2pixels = scale_factor_z2pixels
+        self.x = 0.0
+        self.y = 0.0
+        self.cen_hits = 0
+        self.dmn_hits = 0
+
+    def update(self, roi_activities, outlier, top_circle_y, bottom_circle_y):
+        """
+        Advance the ball by one volume of [CEN, DMN] activity
+
+        Returns
+        -------
+        ('CEN' or 'DMN', ball y at the hit, frame within the volume) if the ball hit a target,
+        otherwise None
+        """
+        _, hits = self.replay([roi_activities[0]], [roi_activities[1]], [outlier], top_circle_y, bottom_circle_y)
+        return hits[0][1:] if hits else None
+
+    def replay(self, cen, dmn, outliers, top_circle_y, bottom_circle_y):
+        """
+        Advance the ball through many volumes at once, with the same result as update() per volume
+
+        The ball's frame positions up to the next hit are one cumulative sum (the same sequential
+        additions as moving it frame by frame), so there is one array pass per hit instead of a
+        Python loop over frames. Outlier volumes, volumes with a missing CEN or DMN value and
+        volumes whose mean activation is exactly 0 leave the ball where it is.
+
+        Parameters
+        ----------
+        cen, dmn : array-like
+            Per-volume activations
+        outliers : array-like of bool
+            Per-volume PDA outlier flags (see is_pda_outlier)
+        top_circle_y, bottom_circle_y : float
+            CEN and DMN target circle centers
+
+        Returns
+        -------
+        (ball y after each volume, list of hits (volume index, 'CEN'/'DMN', ball y at the hit, frame))
+        """
+        cen = np.asarray(cen, dtype=float)
+        dmn = np.asarray(dmn, dtype=float)
+        n_volumes = len(cen)
+        num_frames = int(self.tr_to_frame_ratio)
+
+        with np.errstate(invalid='ignore'):
+            moving = ~(np.isnan(cen) | np.isnan(dmn)) & ~np.asarray(outliers, dtype=bool) & ((cen + dmn) / 2 != 0)
+        # direction and activity as in pda_direction (CEN wins ties), per-frame movement as in calculate_ball_position
+        direction = np.where(cen >= dmn, POSITIONS[0], POSITIONS[1])
+        activity = np.abs(cen - dmn) / 10
+        delta_per_frame = np.where(moving, direction * activity * (self.scale_factor_z2pixels / INTERNAL_SCALER)
+                                   / self.tr_to_frame_ratio, 0.0)
+        frame_deltas = np.repeat(delta_per_frame, num_frames)
+        frame_moves = np.repeat(moving, num_frames)
+
+        ball_y = np.full(n_volumes, self.y)
+        hits = []
+        start = 0
+        while start < n_volumes and num_frames > 0:
+            positions = np.cumsum(np.concatenate(([self.y], frame_deltas[start * num_frames:])))[1:]
+            # CEN (top circle) - ball above center; DMN (bottom circle) - ball below center
+            crossed = frame_moves[start * num_frames:] & ((positions > top_circle_y) | (positions < bottom_circle_y))
+            first = int(np.argmax(crossed)) if crossed.any() else len(positions)
+            hit_volume = start + first // num_frames
+            ball_y[start:hit_volume] = positions[num_frames - 1:(hit_volume - start) * num_frames:num_frames]
+            if hit_volume == n_volumes:
+                self.y = ball_y[-1]
+                break
+            if positions[first] > top_circle_y:
+                self.cen_hits += 1
+                hits.append((hit_volume, 'CEN', positions[first], first % num_frames))
+            else:
+                self.dmn_hits += 1
+                hits.append((hit_volume, 'DMN', positions[first], first % num_frames))
+            self.x = self.y = 0.0
+            ball_y[hit_volume] = 0.0
+            start = hit_volume + 1
+        return ball_y, hits
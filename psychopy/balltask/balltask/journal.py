@@ -0,0 +1,281 @@
+"""
+Append-only session journal of a ball task run, independent of PsychoPy
+
+Everything a run writes (volumes, frames, scanner pulses, slider answers) is also appended to
+<filename>_journal.bin as small binary records as it happens:
+
+    magic 'BTJ1', then per record: type (uint8), payload length (uint16), crc32 (uint32), payload
+
+The file is opened unbuffered and a record is written with a single write call, so after a
+crash the journal holds everything up to the last record; a torn last record is detected by
+its length / crc and ignored. load_journal() replays a journal into a JournalState, which
+session.py uses to resume a crashed run, and rebuild_outputs() writes every csv output of the
+run from it:
+
+    python -m balltask.journal data/sub-mindbpd2098/sub-mindbpd2098_DMN_feedback_1_journal.bin
+"""
+
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+import zlib
+
+from .outputs import (ROI_OUTPUT_COLUMNS, SLIDER_QUESTION_COLUMNS, TRIGGER_COLUMNS, frames_file, roi_output_row,
+                      roi_outputs_file, set_aside_run_files, slider_questions_file, triggers_file, write_csv)
+
+MAGIC = b'BTJ1'
+RECORD_HEADER = struct.Struct('<BHI')  # type, payload length, crc32 of the payload
+
+# record types
+RUN_INFO = 1  # json: the ExperimentHandler's extraInfo at the start of the run
+TRIGGER_START = 2  # wall clock time (time.time()) and global clock time at the trigger clock's zero
+VOLUME = 3  # one roi_outputs row
+PULSE = 4  # one scanner pulse
+FRAME_COLUMNS = 5  # json: column names of the frame records that follow
+FRAME = 6  # one frames row
+SLIDER = 7  # json: one slider_questions row
+RUN_END = 8  # the run's feedback finished normally
+
+VOLUME_RECORD = struct.Struct('<iddddBiidddddd')
+PULSE_RECORD = struct.Struct('<id')
+TRIGGER_START_RECORD = struct.Struct('<dd')
+STAGES = ['baseline', 'feedback']
+
+
+def journal_file(filename):
+    return filename + '_journal.bin'
+
+
+def _number(value):
+    return float('nan') if value is None else float(value)
+
+
+class JournalWriter:
+    """
+    Appends records to a run's journal
+
+    Parameters
+    ----------
+    path : str
+        Journal file; an existing journal is continued (after cutting off a torn last record)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            _, valid_end = read_records(path)
+            if valid_end < os.path.getsize(path):
+                os.truncate(path, valid_end)
+        self._file = open(path, 'ab', buffering=0)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._frame_columns = None
+
+    def append(self, record_type, payload):
+        self._file.write(RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload)) + payload)
+
+    def _append_json(self, record_type, value):
+        self.append(record_type, json.dumps(value, default=str).encode())
+
+    def run_info(self, exp_info):
+        self._append_json(RUN_INFO, exp_info)
+
+    def trigger_start(self, wall_time, global_time):
+        self.append(TRIGGER_START, TRIGGER_START_RECORD.pack(wall_time, global_time))
+
+    def volume(self, row):
+        """Journal a roi_outputs row (as returned by roi_output_row)"""
+        values = dict(zip(ROI_OUTPUT_COLUMNS, row))
+        self.append(VOLUME, VOLUME_RECORD.pack(
+            int(values['volume']), float(values['scale_factor']), float(values['time']), float(values['cen']),
+            float(values['dmn']), STAGES.index(values['stage']), int(values['cen_cumulative_hits']),
+            int(values['dmn_cumulative_hits']), _number(values['pda_outlier']), _number(values['ball_y_position']),
+            _number(values['top_circle_y_position']), _number(values['bottom_circle_y_position']),
+            _number(values['volume_onset']), _number(values['fitted_tr'])))
+
+    def pulse(self, volume, time):
+        self.append(PULSE, PULSE_RECORD.pack(volume, time))
+
+    def frame(self, record):
+        """Journal a frame_record dict (the columns are journaled once, with the first frame)"""
+        columns = list(record)
+        if columns != self._frame_columns:
+            self._append_json(FRAME_COLUMNS, columns)
+            self._frame_columns = columns
+        self.append(FRAME, struct.pack(f'<{len(columns)}d', *(_number(record[c]) for c in columns)))
+
+    def slider(self, row):
+        self._append_json(SLIDER, [_number(v) if isinstance(v, float) else v for v in row])
+
+    def end(self):
+        self.append(RUN_END, b'')
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def read_records(path):
+    """
+    Records of a journal
+
+    Returns
+    -------
+    records : list of (type, payload)
+        Every complete record, up to the first torn or corrupt one
+    valid_end : int
+        File offset after the last complete record
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a ball task journal')
+    records, offset = [], len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        record_type, length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        records.append((record_type, payload))
+        offset = start + length
+    return records, offset
+
+
+class JournalState:
+    """
+    A run replayed from its journal
+
+    Attributes
+    ----------
+    exp_info : dict
+    trigger_wall_time : float or None
+        time.time() at the scanner trigger (None if the run crashed before it)
+    trigger_global_time : float or None
+        The run's global clock (frame times) at the scanner trigger
+    volumes : list
+        roi_outputs rows
+    pulses : list of (volume, time)
+    frame_columns : list of str
+    frames : list of list
+        frames rows
+    sliders : list
+        slider_questions rows
+    ended : bool
+        The run's feedback finished normally
+    """
+
+    def __init__(self):
+        self.exp_info = {}
+        self.trigger_wall_time = None
+        self.trigger_global_time = None
+        self.volumes = []
+        self.pulses = []
+        self.frame_columns = []
+        self.frames = []
+        self.sliders = []
+        self.ended = False
+
+    @property
+    def next_volume(self):
+        return self.volumes[-1][0] + 1 if self.volumes else 0
+
+    @property
+    def scale_factor(self):
+        return self.volumes[-1][1] if self.volumes else self.exp_info.get('scale_factor')
+
+    @property
+    def hits(self):
+        """[CEN, DMN] cumulative hits at the last volume"""
+        if not self.volumes:
+            return [0, 0]
+        values = dict(zip(ROI_OUTPUT_COLUMNS, self.volumes[-1]))
+        return [values['cen_cumulative_hits'], values['dmn_cumulative_hits']]
+
+    @property
+    def ball_y(self):
+        """Ball position at the last volume (0 before the feedback; the virtual ball's for SHAM runs)"""
+        values = dict(zip(ROI_OUTPUT_COLUMNS, self.volumes[-1])) if self.volumes else {}
+        ball_y = values.get('ball_y_position', math.nan)
+        return 0.0 if math.isnan(ball_y) else ball_y
+
+    @property
+    def resumable(self):
+        """The run crashed after its trigger, before the feedback finished"""
+        return self.trigger_wall_time is not None and not self.ended
+
+
+def load_journal(path):
+    """Replay a journal into a JournalState"""
+    state = JournalState()
+    records, _ = read_records(path)
+    for record_type, payload in records:
+        if record_type == RUN_INFO:
+            state.exp_info = json.loads(payload)
+        elif record_type == TRIGGER_START:
+            state.trigger_wall_time, state.trigger_global_time = TRIGGER_START_RECORD.unpack(payload)
+        elif record_type == VOLUME:
+            (volume, scale_factor, time, cen, dmn, stage, cen_hits, dmn_hits, pda_outlier, ball_y, top_y, bottom_y,
+             volume_onset, fitted_tr) = VOLUME_RECORD.unpack(payload)
+            state.volumes.append(roi_output_row(
+                volume, scale_factor, time, [cen, dmn], STAGES[stage], cen_hits, dmn_hits,
+                pda_outlier if math.isnan(pda_outlier) else bool(pda_outlier), ball_y, top_y, bottom_y,
+                volume_onset=volume_onset, fitted_tr=fitted_tr))
+        elif record_type == PULSE:
+            state.pulses.append(PULSE_RECORD.unpack(payload))
+        elif record_type == FRAME_COLUMNS:
+            state.frame_columns = json.loads(payload)
+        elif record_type == FRAME:
+            state.frames.append(list(struct.unpack(f'<{len(payload) // 8}d', payload)))
+        elif record_type == SLIDER:
+            state.sliders.append(json.loads(payload))
+        elif record_type == RUN_END:
+            state.ended = True
+    return state
+
+
+def rebuild_outputs(path, filename=None):
+    """
+    Write the roi_outputs, frames, slider_questions and triggers csv files of a run from its journal
+
+    Existing files are moved aside (see set_aside_run_files), never overwritten.
+
+    Returns
+    -------
+    list of the files written
+    """
+    if filename is None:
+        filename = path[:-len('_journal.bin')] if path.endswith('_journal.bin') else os.path.splitext(path)[0]
+    state = load_journal(path)
+    outputs = [(roi_outputs_file(filename), ROI_OUTPUT_COLUMNS, state.volumes),
+               (triggers_file(filename), TRIGGER_COLUMNS, state.pulses)]
+    if state.frames:
+        outputs.append((frames_file(filename), state.frame_columns, state.frames))
+    if state.sliders:
+        outputs.append((slider_questions_file(filename), SLIDER_QUESTION_COLUMNS, state.sliders))
+
+    set_aside_run_files([output_path for output_path, _, _ in outputs])
+    for output_path, columns, rows in outputs:
+        write_csv(output_path, columns, rows)
+    return [output_path for output_path, _, _ in outputs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the csv outputs of a ball task run from its journal')
+    parser.add_argument('journal', help='<filename>_journal.bin')
+    parser.add_argument('--filename', help='Output file prefix (default: the journal name without _journal.bin)')
+    args = parser.parse_args()
+
+    try:
+        for path in rebuild_outputs(args.journal, args.filename):
+            print(f'+ {path}')
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
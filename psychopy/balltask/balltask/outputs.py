@@ -0,0 +1,142 @@
+"""
+Per-run output files of the ball task
+
+Each run writes, next to the ExperimentHandler files:
+    <filename>_roi_outputs.csv      one row per MURFI volume
+    <filename>_frames.csv           ball/circle state every 5th screen frame (feedback runs only)
+    <filename>_slider_questions.csv post-run slider answers
+    <filename>_triggers.csv         every scanner pulse (volume, time on the trigger clock)
+    <filename>_journal.bin          all of the above as it happens (see balltask.journal)
+    <filename>_records.pkl          all of the above, pickled at the end of the run
+
+During a run they are all written from one record stream (see balltask.stream).
+
+Files of a run are never deleted: set_aside_run_files moves them to an overwritten/ folder.
+"""
+
+import csv
+import glob
+import os
+import shutil
+import time
+
+import numpy as np
+
+ROI_OUTPUT_COLUMNS = ['volume', 'scale_factor', 'time', 'time_plus_1.2', 'cen', 'dmn', 'stage',
+                      'cen_cumulative_hits', 'dmn_cumulative_hits', 'pda_outlier', 'ball_y_position',
+                      'top_circle_y_position', 'bottom_circle_y_position', 'volume_onset', 'fitted_tr',
+                      'feedback_latency']
+
+TRIGGER_COLUMNS = ['volume', 'time']
+
+SLIDER_QUESTION_COLUMNS = ["id", "run", 'feedback_on', "question_text", "response", "rt"]
+
+# Only every FRAME_SAVE_INTERVAL-th frame is saved (~30fps instead of 144fps),
+# which reduces file size by 80% with no perceptible visual difference
+FRAME_SAVE_INTERVAL = 5
+
+
+def roi_outputs_file(filename):
+    return filename + '_roi_outputs.csv'
+
+
+def frames_file(filename):
+    return filename + '_frames.csv'
+
+
+def slider_questions_file(filename):
+    return filename + '_slider_questions.csv'
+
+
+def triggers_file(filename):
+    return filename + '_triggers.csv'
+
+
+def records_file(filename):
+    return filename + '_records.pkl'
+
+
+def run_files(filename):
+    """Every existing file of a run: <filename>.csv/.psydat/.log (ExperimentHandler) and <filename>_*"""
+    pattern = glob.escape(filename)
+    return sorted(glob.glob(pattern + '.*') + glob.glob(pattern + '_*'))
+
+
+def set_aside_run_files(paths):
+    """
+    Move files to overwritten/<date-time>/ in their folder instead of deleting them
+
+    Returns
+    -------
+    list of the new paths
+    """
+    existing = [path for path in paths if os.path.exists(path)]
+    if not existing:
+        return []
+    folder = os.path.join(os.path.dirname(existing[0]), 'overwritten', time.strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(folder, exist_ok=True)
+    moved = []
+    for path in existing:
+        moved.append(shutil.move(path, os.path.join(folder, os.path.basename(path))))
+    return moved
+
+
+def write_csv(path, columns, rows):
+    """Write a whole csv at once (e.g. rebuilt from a journal; during a run, see stream.CsvSink)"""
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def roi_output_row(volume, scale_factor, trigger_time, roi_raw_activations, stage, cen_hits=0, dmn_hits=0,
+                   pda_outlier=np.nan, ball_y=np.nan, top_circle_y=np.nan, bottom_circle_y=np.nan,
+                   volume_onset=np.nan, fitted_tr=np.nan):
+    """
+    One row of the roi_outputs csv; baseline volumes leave the feedback columns as nan
+
+    'time' is when the volume's activations were received; volume_onset is the scanner pulse that
+    started the volume (or the fitted model time if that pulse was missed), and feedback_latency
+    the time from the end of the volume's acquisition (volume_onset + fitted_tr) to 'time'.
+    """
+    feedback_latency = trigger_time - (volume_onset + fitted_tr)
+    return [volume, scale_factor, trigger_time, trigger_time + 1.2, roi_raw_activations[0], roi_raw_activations[1],
+            stage, cen_hits, dmn_hits, pda_outlier, ball_y, top_circle_y, bottom_circle_y, volume_onset, fitted_tr,
+            feedback_latency]
+
+
+def _color_or_black(color):
+    # 'no fill' (None) and [0,0,0] are both saved as black to ensure no mid-gray on playback
+    if color is None or (color[0] == 0 and color[1] == 0 and color[2] == 0):
+        return [-1, -1, -1]
+    return color
+
+
+def frame_record(time, ball, target_circles):
+    """
+    Ball and target circle state for one screen frame (one row of the frames csv)
+
+    SHAM runs replay these rows as the yoked feedback.
+    """
+    frame_info = {"time": time,
+                  "ball_x": ball.pos[0],
+                  "ball_y": ball.pos[1],
+                  "ball_radius": ball.radius}
+    ball_fill = [-1, -1, -1] if ball.fillColor is None else ball.fillColor
+    frame_info["ball_color_r"] = ball_fill[0]
+    frame_info["ball_color_g"] = ball_fill[1]
+    frame_info["ball_color_b"] = ball_fill[2]
+
+    for i, roi in enumerate(target_circles):
+        frame_info[f"roi{i + 1}_x"] = roi.pos[0]
+        frame_info[f"roi{i + 1}_y"] = roi.pos[1]
+        frame_info[f"roi{i + 1}_radius"] = roi.radius
+        fill_color = _color_or_black(roi.fillColor)
+        frame_info[f"roi{i + 1}_color_r"] = fill_color[0]
+        frame_info[f"roi{i + 1}_color_g"] = fill_color[1]
+        frame_info[f"roi{i + 1}_color_b"] = fill_color[2]
+        line_color = roi.lineColor
+        frame_info[f"roi{i + 1}_lineColor_r"] = line_color[0]
+        frame_info[f"roi{i + 1}_lineColor_g"] = line_color[1]
+        frame_info[f"roi{i + 1}_lineColor_b"] = line_color[2]
+    return frame_info
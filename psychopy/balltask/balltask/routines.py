@@ -0,0 +1,752 @@
+"""
+PsychoPy routines of a ball task run
+
+Each routine of the original Builder script (instructions, trigger, baseline, feedback,
+SHAM playback, end fixation, slider questions) is a function taking the RunContext, which
+holds the window, stimuli, clocks, MURFI communicator, scanner trigger timeline and output
+file names of the run.
+
+Importing this module imports psychopy.visual (and opens pyglet's GL context), so
+session.py only imports it after the participant dialog has been closed.
+"""
+
+import threading
+import time
+
+import numpy as np
+from psychopy import core, event, logging, visual
+from psychopy.hardware import keyboard
+
+from .ball import POSITIONS, VirtualBall, calculate_ball_position, further_than_circles, is_pda_outlier, pda_direction
+from .outputs import FRAME_SAVE_INTERVAL, frame_record, roi_output_row
+from .triggers import PollScheduler, TriggerTimeline
+
+ROI_NAMES = ['cen', 'dmn']
+ROI_COLORS = ['yellow', 'lightblue', 'red', 'green', 'cyan', 'magenta', 'black', 'honeydew', 'indigo', 'maroon']
+
+# Give up on the run when MURFI sends nothing new for this many seconds
+MURFI_TIMEOUT = 10
+
+# A SHAM run keeps collecting MURFI volumes after playback until it has this many (or 5 TRs pass)
+SHAM_TARGET_VOLUMES = 150
+
+# After a resume the trigger clock must read the time since the original trigger, to within this many seconds
+RESUME_CLOCK_TOLERANCE = 1.0
+
+SLIDER_QUESTIONS = [
+    ('How often were you using the Mindful Describing practice?', 'Never', 'Always'),
+    ('How often did you check the position of the ball?', 'Never', 'All the time'),
+    ('How difficult was it to apply Mindful Describing?', 'Not at all', 'Very Difficult'),
+    ('How calm do you feel right now?', 'Not at all', 'Very calm'),
+]
+
+# Extra questions after the last feedback run
+LAST_FEEDBACK_RUN_QUESTIONS = [
+    ('The ball seemed to move up while I was practicing Mindful Describing', 'False', 'True'),
+    ('The ball seemed to move down while my mind was wandering.', 'False', 'True'),
+    ('The ball seemed to move down while I was trying to control it.', 'False', 'True'),
+]
+
+
+def _text(win, name, text, pos=(0, 0), height=0.06, wrap_width=1.2, depth=0.0):
+    return visual.TextStim(win=win, ori=0, name=name, text=text, font=u'Arial',
+                           pos=pos, height=height, wrapWidth=wrap_width,
+                           color=u'white', colorSpace='rgb', opacity=1, depth=depth)
+
+
+class Stimuli:
+    """
+    All stimuli of a run, created once after the window is opened
+
+    Text is rendered to a texture when a TextStim is created or its text changes, and the first
+    draw of a stimulus uploads it to the GPU. So every text the run shows (instruction slides,
+    slider questions) gets its own prebuilt stimulus instead of re-setting the text of a shared
+    one, and warm_up() draws everything once before the run, off screen.
+
+    Parameters
+    ----------
+    win : psychopy.visual.Window
+    slides : list of str
+        Instruction slides of the run
+    questions : list of (question_text, left_label, right_label)
+        Slider questions the run may ask
+    """
+
+    def __init__(self, win, slides=(), questions=()):
+        self.win = win
+        self.slides = [_text(win, 'instruct_text', slide) for slide in slides]
+        self.sliders = {question_text: (_text(win, 'text', question_text, pos=[0, 0.2]),
+                                        visual.Slider(win,
+                                                      size=(0.85, 0.1),
+                                                      ticks=(1, 9),
+                                                      labels=(left_label, right_label),
+                                                      granularity=1,
+                                                      color='white',
+                                                      fillColor='white',
+                                                      font=u'Arial',
+                                                      labelHeight=0.06))
+                        for question_text, left_label, right_label in questions}
+        self.slider_instruction = _text(
+            win, 'text',
+            "You'll see a few slider questions next\nPress the left and right buttons to move the slider\n"
+            "And the top button to enter your response\nPress any button to continue",
+            pos=[0, 0.2])
+        self.waiting_for_trigger_text = _text(win, 'waiting_for_trigger_text', u'waiting for scanner',
+                                              height=0.1, wrap_width=2)
+        self.fixation = _text(win, 'text_2', u'+', height=0.3, wrap_width=None)
+        self.relax = _text(win, 'text_relax', u'Relax', pos=[0, -.2], height=0.07, wrap_width=None)
+        self.thank_you = _text(win, 'thank_you_end_run_text', u'thank you!', height=0.1, wrap_width=None)
+
+        # scale based on aspect ratio
+        scale = [win.size[1] / win.size[0], 1]
+
+        # CEN target on top, DMN target at the bottom
+        self.target_circles = []
+        for i, position in enumerate(POSITIONS):
+            roi_circle_i = visual.Circle(win, pos=(0, position / 3),
+                                         radius=0.15, fillColor=None,
+                                         lineColor=ROI_COLORS[i], lineWidth=3)
+            roi_circle_i.size *= scale
+            self.target_circles.append(roi_circle_i)
+
+        self.ball = visual.Circle(win, pos=(0, 0), radius=0.03, fillColor='white', lineColor='white', lineWidth=3)
+        self.ball.size *= scale
+
+    def all(self):
+        stims = [self.slider_instruction, self.waiting_for_trigger_text, self.fixation, self.relax, self.thank_you,
+                 self.ball] + self.target_circles + self.slides
+        for question, slider in self.sliders.values():
+            stims += [question, slider]
+        return stims
+
+    def warm_up(self):
+        """Draw every stimulus once to the back buffer and clear it again, so no first draw happens at an onset"""
+        for stim in self.all():
+            stim.draw()
+        self.win.clearBuffer()
+
+
+class TriggerListener:
+    """
+    Scanner pulses from the keyboard, read without blocking
+
+    psychopy.hardware.keyboard timestamps each key press when it happens, so pulse times do not
+    depend on how often poll() is called; once per screen frame (or MURFI poll) is enough.
+
+    Parameters
+    ----------
+    trigger_keys : tuple
+        Keys sent by the scanner trigger (SiteProfile.trigger_keys)
+    trigger_clock : psychopy.core.Clock
+        Pulse times are recorded on this clock
+    timeline : TriggerTimeline
+    output : RecordStream
+        New pulses are emitted as 'pulse' records
+    """
+
+    def __init__(self, trigger_keys, trigger_clock, timeline, output):
+        self.key_list = sorted({str(key) for key in trigger_keys})
+        self.keyboard = keyboard.Keyboard()
+        self.trigger_clock = trigger_clock
+        self.timeline = timeline
+        self.output = output
+
+    def clear(self):
+        self.keyboard.clearEvents()
+
+    def get_presses(self):
+        """Trigger key presses since the last call"""
+        return self.keyboard.getKeys(keyList=self.key_list, waitRelease=False)
+
+    def add(self, presses):
+        """Add key presses to the timeline; returns the number of new pulses (duplicates are dropped)"""
+        reset_time = self.trigger_clock.getLastResetTime()
+        added = 0
+        for press in presses:
+            pulse_time = press.tDown - reset_time
+            volume = self.timeline.add_pulse(pulse_time)
+            if volume is not None:
+                self.output.emit('pulse', (volume, pulse_time))
+                added += 1
+        return added
+
+    def poll(self):
+        return self.add(self.get_presses())
+
+
+class RunContext:
+    """
+    State shared by the routines of one run
+
+    Parameters
+    ----------
+    site : SiteProfile
+    exp_info : dict
+        The ExperimentHandler's extraInfo (participant, run, feedback_on, scale_factor, tr, ...)
+    filename : str
+        Output file prefix, e.g. data/sub-mindbpd2098/sub-mindbpd2098_DMN_feedback_1
+    this_exp : psychopy.data.ExperimentHandler
+    output : RecordStream
+        Where the run's records (volumes, frames, pulses, slider answers) go (see balltask.stream)
+    sham_frames : pd.DataFrame or None
+        Frames of the matched REAL participant to replay (SHAM feedback runs only)
+    resume : JournalState or None
+        The crashed run this run continues (see resume_run)
+    """
+
+    def __init__(self, site, exp_info, filename, this_exp, output, sham_frames=None, resume=None):
+        self.site = site
+        self.exp_info = exp_info
+        self.filename = filename
+        self.this_exp = this_exp
+        self.output = output
+        self.sham_frames = sham_frames
+        self.resume = resume
+
+        self.win = None
+        self.stim = None
+        self.communicator = None
+        self.triggers = None
+        self.tr_to_frame_ratio = None
+        self.scale_factor_z2pixels = int(exp_info['scale_factor'])
+
+        self.global_clock = core.Clock()  # to track the time since experiment started
+        self.trigger_clock = core.Clock()  # reset at the scanner trigger
+        self.trigger_timeline = TriggerTimeline(exp_info['tr'])  # every scanner pulse, and the TR fitted to them
+        self.poll_scheduler = PollScheduler(self.trigger_timeline)  # when the next volume is worth asking for
+        self.routine_timer = core.CountdownTimer()  # to track time remaining of each (non-slip) routine
+
+        self.volume = 0  # next MURFI volume to collect
+        self.num_pda_outliers = 0
+        self.run_stop_time = 0
+
+    @property
+    def feedback_on(self):
+        return self.exp_info['feedback_on'] == 'Feedback'
+
+    @property
+    def sham_playback(self):
+        return self.sham_frames is not None and self.feedback_on
+
+    def start_routine_timer(self, duration):
+        """Start the countdown for a timed routine (see SiteProfile.non_slip_timing)"""
+        if self.site.non_slip_timing:
+            self.routine_timer.addTime(duration)
+        else:
+            self.routine_timer = core.CountdownTimer(duration)
+
+    def check_quit(self):
+        if event.getKeys(keyList=["escape"]):
+            core.quit()
+
+    def poll_murfi(self, catch_errors=True):
+        """
+        Ask MURFI for the current volume
+
+        Returns
+        -------
+        [cen, dmn] activations, or None if the volume has not arrived yet (or MURFI was not asked
+        because the volume is not due yet, see PollScheduler)
+        """
+        self.triggers.poll()
+        now = self.trigger_clock.getTime()
+        if not self.poll_scheduler.should_poll(self.volume, now):
+            return None
+        self.poll_scheduler.polled(now)
+        self.communicator.update()
+        try:
+            roi_raw_activations = [self.communicator.get_roi_activation(roi_name, self.volume) for roi_name in ROI_NAMES]
+        except Exception:
+            if not catch_errors:
+                raise
+            roi_raw_activations = [np.nan, np.nan]
+        if np.isnan(roi_raw_activations[0]) or np.isnan(roi_raw_activations[1]):
+            return None
+        self.poll_scheduler.arrived(self.volume, now)
+        return roi_raw_activations
+
+    def write_volume(self, roi_raw_activations, stage, **feedback_columns):
+        trigger_time = self.trigger_clock.getTime()
+        timeline = self.trigger_timeline
+        row = roi_output_row(self.volume, self.exp_info['scale_factor'], trigger_time, roi_raw_activations, stage,
+                             volume_onset=timeline.onset(self.volume), fitted_tr=timeline.tr, **feedback_columns)
+        self.output.emit('volume', row)
+        return trigger_time
+
+    def write_slider_answer(self, question_text, rating, rt):
+        exp_info = self.exp_info
+        row = [exp_info['participant'], exp_info['run'], exp_info['feedback_on'], question_text, rating, rt]
+        self.output.emit('slider', row)
+
+
+def open_window(ctx, slides=()):
+    """Open the window, measure the frame rate and create (and warm up) the stimuli, including the instruction slides"""
+    site = ctx.site
+    ctx.win = visual.Window(size=site.window_size, fullscr=site.fullscr, screen=site.screen, allowGUI=False,
+                            allowStencil=False, monitor='testMonitor', color=[-1, -1, -1], colorSpace='rgb',
+                            blendMode='avg', useFBO=True)
+
+    # store frame rate of monitor if we can measure it successfully
+    ctx.exp_info['frameRate'] = ctx.win.getActualFrameRate()
+    if ctx.exp_info['frameRate'] is not None:
+        frame_dur = 1.0 / ctx.exp_info['frameRate']
+    else:
+        print('FRAME RATE GUESSING')
+        frame_dur = 1.0 / 60.0  # couldn't get a reliable measure so guess
+
+    # Approximately how many frames does the monitor refresh per volume?
+    ctx.tr_to_frame_ratio = ctx.exp_info['tr'] / frame_dur
+    ctx.stim = Stimuli(ctx.win, slides, SLIDER_QUESTIONS + LAST_FEEDBACK_RUN_QUESTIONS)
+    ctx.stim.warm_up()
+    ctx.triggers = TriggerListener(site.trigger_keys, ctx.trigger_clock, ctx.trigger_timeline, ctx.output)
+
+
+def connect_murfi(ctx):
+    """Connect to MURFI, or to a session of a feedback server if the site uses one"""
+    site = ctx.site
+    if site.feedback_server:
+        from feedback_server import RemoteActivationCommunicator
+        ctx.communicator = RemoteActivationCommunicator(site.feedback_server, site.feedback_session or site.name,
+                                                        site.murfi_num_trs, ROI_NAMES)
+        print(f"feedback server {site.feedback_server} ok")
+    else:
+        from murfi_activation_communicator import MurfiActivationCommunicator
+        ctx.communicator = MurfiActivationCommunicator(site.murfi_ip, site.murfi_port, site.murfi_num_trs,
+                                                       ROI_NAMES, ctx.exp_info['tr'], site.murfi_fake)
+        print("murfi communicator ok")
+    ctx.this_exp.addData('temporal_resolution', ctx.exp_info['tr'])
+
+
+def wait_for_keypress(key_list):
+    # keys pressed before the call count too (unlike event.waitKeys, which clears them first)
+    while not event.getKeys(keyList=list(key_list)):
+        pass
+
+
+def run_instructions(ctx):
+    """Show each instruction slide (see open_window) until space is pressed"""
+    for slide in ctx.stim.slides:
+        slide.draw()
+        ctx.win.flip()
+        wait_for_keypress(['space'])
+
+
+def wait_for_trigger(ctx):
+    """
+    Show 'waiting for scanner' until the first trigger; the trigger clock is reset at the trigger
+
+    The first pulse starts the trigger timeline; later pulses are picked up whenever MURFI is polled.
+    """
+    ctx.stim.waiting_for_trigger_text.setAutoDraw(True)
+    event.clearEvents(eventType='keyboard')
+    ctx.triggers.clear()
+    response_clock = core.Clock()
+    key, rt = None, None
+    while key is None:
+        presses = ctx.triggers.get_presses()
+        if len(presses) > 0:
+            key = presses[0].name
+            rt = presses[0].tDown - response_clock.getLastResetTime()
+            # reset trigger clock -- now it is keeping track of time relative to trigger!
+            ctx.trigger_clock.reset()
+            ctx.output.emit('trigger_start', (time.time(), ctx.global_clock.getTime()))
+            ctx.triggers.add(presses)
+            break
+        ctx.check_quit()
+        ctx.win.flip()
+    ctx.stim.waiting_for_trigger_text.setAutoDraw(False)
+    ctx.routine_timer.reset()
+
+    ctx.this_exp.addData('key_resp_3.keys', key)
+    ctx.this_exp.addData('key_resp_3.rt', rt)
+    ctx.this_exp.nextEntry()
+
+
+def resume_run(ctx, state):
+    """
+    Continue a crashed run from its journal instead of waiting for the trigger
+
+    The trigger and global clocks are set to the time since the original trigger, and the
+    scanner pulses and next volume are restored (hits and the ball position are restored by the
+    feedback routines from ctx.resume; session.py rebuilt the outputs from the journal).
+
+    Returns
+    -------
+    Seconds since the original trigger
+    """
+    elapsed = time.time() - state.trigger_wall_time
+    # Clock.reset(t) makes the clock read -t, so a clock that should read elapsed is reset to -elapsed
+    ctx.trigger_clock.reset(-elapsed)
+    ctx.global_clock.reset(-(state.trigger_global_time + elapsed))
+    ctx.routine_timer.reset()
+    if abs(ctx.trigger_clock.getTime() - elapsed) > RESUME_CLOCK_TOLERANCE:
+        raise RuntimeError(f'trigger clock reads {ctx.trigger_clock.getTime():.3f}s after resuming, '
+                           f'expected {elapsed:.3f}s')
+    for _, pulse_time in state.pulses:
+        ctx.trigger_timeline.add_pulse(pulse_time)
+    ctx.triggers.clear()
+    ctx.volume = state.next_volume
+    print(f'RESUMING at {elapsed:.1f}s after the trigger, volume {ctx.volume}, hits {state.hits}')
+    return elapsed
+
+
+def run_baseline(ctx, duration):
+    """Fixation cross and 'Relax' while the baseline volumes are recorded"""
+    ctx.start_routine_timer(duration)
+    ctx.stim.fixation.setAutoDraw(True)
+    ctx.stim.relax.setAutoDraw(True)
+    print("starting baseline")
+    while ctx.routine_timer.getTime() > 0:
+        roi_raw_activations = ctx.poll_murfi()
+        if roi_raw_activations is not None:
+            # a new volume of output from MURFI: record it and advance
+            print([ctx.volume, ctx.trigger_clock.getTime(), roi_raw_activations[0], roi_raw_activations[1]])
+            ctx.write_volume(roi_raw_activations, 'baseline')
+            ctx.volume += 1
+        ctx.check_quit()
+        ctx.win.flip()
+    ctx.stim.fixation.setAutoDraw(False)
+    ctx.stim.relax.setAutoDraw(False)
+
+
+def _save_frame(ctx, frame_counter):
+    if frame_counter % FRAME_SAVE_INTERVAL == 0:
+        ctx.output.emit('frame', frame_record(ctx.global_clock.getTime(), ctx.stim.ball, ctx.stim.target_circles))
+
+
+def run_feedback(ctx, duration, circles_move_with_hits=False, circle_radius_shrink_with_hits=True, start_time=0.0):
+    """
+    REAL feedback: move the ball with the participant's own CEN/DMN activity
+
+    For 'No Feedback' runs the same loop runs without drawing, so volumes are still recorded.
+    A resumed run starts start_time seconds into the feedback, with the hits and ball position
+    of the crashed run.
+    """
+    stim, exp_info = ctx.stim, ctx.exp_info
+    target_circles, ball = stim.target_circles, stim.ball
+    feedback_clock = core.Clock()
+    feedback_clock.reset(-start_time)  # reads start_time
+    ctx.start_routine_timer(duration - start_time)
+
+    hit_counter = [0] * len(target_circles)
+    if ctx.resume is not None:
+        hit_counter = list(ctx.resume.hits)
+        ball.pos = (0, ctx.resume.ball_y)
+        for hits, circle in zip(hit_counter, target_circles):
+            for _ in range(hits):
+                if circles_move_with_hits and np.abs(circle.pos[1]) + circle.radius + 0.1 < 1:
+                    circle.pos = ((circle.pos[0] * 1.1), (circle.pos[1] * 1.1))
+                if circle_radius_shrink_with_hits:
+                    circle.radius = np.maximum(circle.radius * .9, 0.03)
+    activity = 0
+    direction = 0
+    pda_outlier = False
+    frame_save_counter = 0
+
+    # Draw initial stim positions
+    for circle in target_circles:
+        circle.draw()
+    ball.draw()
+    ctx.win.flip()
+    event.clearEvents(eventType='keyboard')
+
+    last_acquired_frame_time = feedback_clock.getTime()
+    while ctx.routine_timer.getTime() > 0:
+        t = feedback_clock.getTime()
+        ctx.run_stop_time = t
+
+        # get updated data from MURFI
+        roi_activities = ctx.poll_murfi(catch_errors=False)
+        if roi_activities is None:
+            # data hasn't been acquired yet for the current volume -- keep polling without advancing the volume,
+            # unless nothing has arrived for MURFI_TIMEOUT seconds
+            non_new_data_time = feedback_clock.getTime()
+            if non_new_data_time - last_acquired_frame_time > MURFI_TIMEOUT:
+                print('ERROR: NO DATA ARRIVING FROM MURFI! Is this a MoCo issue?')
+                print(f'quit at {non_new_data_time} since there were no new frames since {last_acquired_frame_time}')
+                break
+        else:
+            last_acquired_frame_time = feedback_clock.getTime()
+            print(last_acquired_frame_time)
+
+            pda_outlier = is_pda_outlier(roi_activities, exp_info['pda_outlier_threshold'])
+            if pda_outlier:
+                ctx.num_pda_outliers += 1
+
+            print('time: ', ctx.routine_timer.getTime())
+            print("got feedback at frame : ", ctx.volume, roi_activities, ROI_NAMES)
+
+            # direction is 1 (upwards) when CEN is higher, -1 (downwards) when DMN is higher
+            movement = pda_direction(roi_activities)
+            if movement is not None:
+                winner, direction, activity = movement
+                print("activity", activity, " roi_activities", roi_activities)
+                print('Circle positions:', target_circles[0].pos[1], target_circles[1].pos[1])
+                print("direction -->", ROI_NAMES[winner])
+                print(ROI_NAMES[0], "hits: ", hit_counter[0], '   ', ROI_NAMES[1], "hits: ", hit_counter[1])
+
+            for i, circle in enumerate(target_circles):
+                circle.fillColor = None
+                # if the ball has passed the middle of either target circle, put position back to 0
+                if further_than_circles(position=i, circle_center=circle.pos[1], ball_center=ball.pos[1]):
+                    hit_counter[i] += 1
+                    print('HIT', ROI_NAMES[i])
+                    ball.pos = (0, 0)
+
+                    # for each hit, position of target circle moves away from the middle (up to a point)
+                    if circles_move_with_hits:
+                        if np.abs(circle.pos[1]) + circle.radius + 0.1 < 1:
+                            circle.pos = ((circle.pos[0] * 1.1), (circle.pos[1] * 1.1))
+                    if circle_radius_shrink_with_hits:
+                        circle.radius = np.maximum(circle.radius * .9, 0.03)
+                    circle.fillColor = 'white'
+
+            trigger_time = ctx.write_volume(roi_activities, 'feedback', cen_hits=hit_counter[0], dmn_hits=hit_counter[1],
+                                            pda_outlier=pda_outlier, ball_y=ball.pos[1],
+                                            top_circle_y=target_circles[0].pos[1],
+                                            bottom_circle_y=target_circles[1].pos[1])
+            if ctx.volume % 10 == 0:
+                print([ctx.volume, trigger_time, roi_activities[0], roi_activities[1],
+                       f'Hits: CEN={hit_counter[0]}, DMN={hit_counter[1]}'])
+            ctx.volume += 1
+
+        # calculate next ball position (the ball pauses once it has passed a target)
+        pause_ball_movement = any(further_than_circles(position=i, circle_center=circle.pos[1], ball_center=ball.pos[1])
+                                  for i, circle in enumerate(target_circles))
+        if not pause_ball_movement:
+            ball.pos = calculate_ball_position(direction, activity, ball.pos[0], ball.pos[1], pda_outlier,
+                                               ctx.scale_factor_z2pixels, ctx.tr_to_frame_ratio)
+
+        # Draw stimuli (if on feedback mode)
+        if ctx.feedback_on:
+            for circle in target_circles:
+                circle.draw()
+            ball.draw()
+            ctx.win.flip()
+            frame_save_counter += 1
+            _save_frame(ctx, frame_save_counter)
+
+        ctx.check_quit()
+
+
+def _record_sham_volume(ctx, virtual_ball):
+    """Poll MURFI and, if a new volume arrived, advance the virtual ball and record the volume"""
+    roi_activities = ctx.poll_murfi()
+    if roi_activities is None:
+        return
+    pda_outlier_sham = is_pda_outlier(roi_activities, ctx.exp_info['pda_outlier_threshold'])
+    target_circles = ctx.stim.target_circles
+    virtual_ball.update(roi_activities, pda_outlier_sham, target_circles[0].pos[1], target_circles[1].pos[1])
+    trigger_time = ctx.write_volume(roi_activities, 'feedback', cen_hits=virtual_ball.cen_hits,
+                                    dmn_hits=virtual_ball.dmn_hits, pda_outlier=pda_outlier_sham,
+                                    ball_y=virtual_ball.y, top_circle_y=target_circles[0].pos[1],
+                                    bottom_circle_y=target_circles[1].pos[1])
+    print([ctx.volume, trigger_time, roi_activities[0], roi_activities[1],
+           f'Hits: CEN={virtual_ball.cen_hits}, DMN={virtual_ball.dmn_hits}'])
+    ctx.volume += 1
+
+
+def run_sham_feedback(ctx, start_time=0.0):
+    """
+    SHAM feedback: replay the matched REAL participant's ball at ~60Hz
+
+    MURFI volumes are still recorded, with hits counted by a VirtualBall driven by the SHAM
+    participant's own activity (never shown, and not printed when the site is blinded).
+    A resumed run starts the playback start_time seconds in.
+    """
+    verbose = ctx.site.print_sham_progress
+    df_sham = ctx.sham_frames
+    target_circles, ball = ctx.stim.target_circles, ctx.stim.ball
+
+    # Compute offset: first frame's time value
+    time_offset = df_sham.iloc[0]["time"]
+    print(f"First frame time: {df_sham.iloc[0]['time']:.3f}s")
+    print(f"Last frame time: {df_sham.iloc[-1]['time']:.3f}s")
+    print(f"Time offset: {time_offset:.3f}s")
+    print(f"Adjusted duration: {df_sham.iloc[-1]['time'] - time_offset:.3f}s")
+
+    # Set run_stop_time to pass the check for slider questions
+    ctx.run_stop_time = 100
+
+    # Downsample to 60Hz for smooth playback
+    avg_frame_interval = df_sham['time'].diff().mean()
+    current_fps = 1.0 / avg_frame_interval if avg_frame_interval > 0 else 144
+    if current_fps > 90:
+        downsample_factor = int(current_fps / 60)
+        df_sham = df_sham.iloc[::downsample_factor].reset_index(drop=True)
+        print(f"Downsampled from {current_fps:.1f}Hz to ~60Hz")
+        print(f"Reduced from {len(df_sham) * downsample_factor} to {len(df_sham)} frames")
+
+    # Pre-convert to numpy arrays for faster access
+    ball_xy = df_sham[['ball_x', 'ball_y']].to_numpy()
+    ball_radius = df_sham['ball_radius'].to_numpy()
+    ball_color = df_sham[['ball_color_r', 'ball_color_g', 'ball_color_b']].to_numpy()
+    roi_data = []
+    for i in range(len(target_circles)):
+        prefix = f'roi{i + 1}_'
+        roi_data.append({
+            'xy': df_sham[[prefix + 'x', prefix + 'y']].to_numpy(),
+            'radius': df_sham[prefix + 'radius'].to_numpy(),
+            'fill': df_sham[[prefix + 'color_r', prefix + 'color_g', prefix + 'color_b']].to_numpy(),
+            'line': df_sham[[prefix + 'lineColor_r', prefix + 'lineColor_g', prefix + 'lineColor_b']].to_numpy(),
+        })
+    frame_times = df_sham['time'].to_numpy() - time_offset
+    num_valid_frames = len(df_sham)
+    if verbose:
+        print(f"Filtered to {num_valid_frames} frames within {frame_times[-1]:.1f}s")
+        print("Starting SHAM playback with VIRTUAL hit counting")
+
+    virtual_ball = VirtualBall(ctx.tr_to_frame_ratio, ctx.scale_factor_z2pixels)
+    if ctx.resume is not None:
+        virtual_ball.cen_hits, virtual_ball.dmn_hits = ctx.resume.hits
+        virtual_ball.y = ctx.resume.ball_y
+    playback_clock = core.Clock()
+    playback_clock.reset(-start_time)  # reads start_time
+    for idx in range(int(np.searchsorted(frame_times, start_time)), num_valid_frames):
+        ctx.check_quit()
+
+        # Check MURFI on every iteration to ensure we don't miss volumes
+        _record_sham_volume(ctx, virtual_ball)
+
+        # This is the VISUAL feedback (yoked from matched participant)
+        ball.pos = tuple(ball_xy[idx])
+        ball.radius = ball_radius[idx]
+        ball.fillColor = list(ball_color[idx])
+        for i, circle in enumerate(target_circles):
+            circle.pos = tuple(roi_data[i]['xy'][idx])
+            circle.radius = roi_data[i]['radius'][idx]
+            circle.fillColor = list(roi_data[i]['fill'][idx])
+            circle.lineColor = list(roi_data[i]['line'][idx])
+        for circle in target_circles:
+            circle.draw()
+        ball.draw()
+        ctx.win.flip()
+
+        # Timing control for smooth playback
+        wait_time = frame_times[idx] - playback_clock.getTime()
+        if wait_time > 0:
+            core.wait(wait_time)
+
+    print(f"Playback complete in {playback_clock.getTime():.1f}s")
+    print(f"Total Hits: CEN={virtual_ball.cen_hits}, DMN={virtual_ball.dmn_hits}")
+    print("Waiting for final MURFI volumes...")
+
+    # Wait for last MURFI volumes to arrive (up to 5 TRs worth of time)
+    wait_start = playback_clock.getTime()
+    max_wait_time = ctx.exp_info['tr'] * 5
+    while playback_clock.getTime() - wait_start < max_wait_time and ctx.volume < SHAM_TARGET_VOLUMES:
+        _record_sham_volume(ctx, virtual_ball)
+        core.wait(0.1)  # Small wait between checks
+
+    if verbose:
+        print(f"Playback complete. Collected {ctx.volume} volumes total")
+    if ctx.volume < SHAM_TARGET_VOLUMES:
+        print(f"WARNING: Expected {SHAM_TARGET_VOLUMES} volumes but only got {ctx.volume}")
+
+
+def save_timing(ctx):
+    """Add the fitted TR / drift and MURFI polling statistics to the experiment data (the pulses are streamed)"""
+    summary = ctx.trigger_timeline.summary()
+    polling = ctx.poll_scheduler.summary()
+    for name, value in summary.items():
+        ctx.this_exp.addData(f'trigger.{name}', value)
+    for name, value in polling.items():
+        ctx.this_exp.addData(name, value)
+    ctx.this_exp.nextEntry()
+    print(f"Scanner pulses: {summary['pulses']} ({summary['missed_pulses']} missed), "
+          f"fitted TR {summary['fitted_tr']:.4f}s, drift {summary['tr_drift'] * 1e6:.0f} ppm")
+    print(f"MURFI polls: {polling['murfi_polls']} ({polling['murfi_polls_per_volume']:.1f} per volume)")
+
+
+def run_end_fixation(ctx, duration=1.0):
+    """Short fixation cross after the feedback"""
+    ctx.start_routine_timer(duration)
+    end_clock = core.Clock()
+    ctx.stim.fixation.setAutoDraw(True)
+    while ctx.routine_timer.getTime() > 0:
+        # most of one frame period left
+        if end_clock.getTime() >= duration - ctx.win.monitorFramePeriod * 0.75:
+            ctx.stim.fixation.setAutoDraw(False)
+        ctx.check_quit()
+        ctx.win.flip()
+    ctx.stim.fixation.setAutoDraw(False)
+
+
+def run_slider(ctx, question_text):
+    """One 1-9 slider question answered with the button box; the answer is appended to the slider csv"""
+    site, win = ctx.site, ctx.win
+    slider_question, vas = ctx.stim.sliders[question_text]
+    vas.reset()
+
+    event.clearEvents('keyboard')
+    vas.markerPos = 5
+    vas.draw()
+    slider_question.draw()
+    win.flip()
+    continue_routine = True
+    while continue_routine:
+        keys = event.getKeys(keyList=[site.left_button, site.right_button, site.enter_button])
+        if len(keys):
+            if site.left_button in keys:
+                vas.markerPos = vas.markerPos - 1
+            elif site.right_button in keys:
+                vas.markerPos = vas.markerPos + 1
+            elif site.enter_button in keys:
+                vas.rating = vas.markerPos
+                continue_routine = False
+            vas.draw()
+            slider_question.draw()
+            win.flip()
+            print(keys)
+
+    print(f'Rating: {vas.rating}, RT: {vas.rt}')
+    ctx.write_slider_answer(question_text, vas.rating, vas.rt)
+    return vas.rating
+
+
+def run_slider_questions(ctx, last_feedback_run=False, min_run_time=60):
+    """
+    Post-run slider questions
+
+    Only asked if the run got at least min_run_time seconds into the feedback; otherwise the
+    questions are recorded with nan answers.
+    """
+    questions = list(SLIDER_QUESTIONS)
+    if last_feedback_run:
+        questions += LAST_FEEDBACK_RUN_QUESTIONS
+
+    if ctx.run_stop_time >= min_run_time:
+        site = ctx.site
+        ctx.stim.slider_instruction.draw()
+        ctx.win.flip()
+        wait_for_keypress([site.right_button, site.left_button, site.enter_button])
+        for question_text, _, _ in questions:
+            run_slider(ctx, question_text)
+    else:
+        for question_text, _, _ in questions:
+            ctx.write_slider_answer(question_text, np.nan, np.nan)
+
+
+def show_thank_you(ctx, duration=3):
+    ctx.stim.thank_you.draw()
+    ctx.win.flip()
+    core.wait(duration)
+    ctx.win.close()
+
+
+def quit_psychopy():
+    """Close everything and exit nicely (ending the experiment)"""
+    logging.flush()
+
+    # properly shutdown ioHub server
+    from psychopy.iohub.client import ioHubConnection
+
+    if ioHubConnection.ACTIVE_CONNECTION:
+        ioHubConnection.ACTIVE_CONNECTION.quit()
+
+    for thisThread in threading.enumerate():
+        if hasattr(thisThread, 'stop') and hasattr(thisThread, 'running'):
+            # this is one of our event threads - kill it and wait for success
+            thisThread.stop()
+            while thisThread.running == 0:
+                pass  # wait until it has properly finished polling
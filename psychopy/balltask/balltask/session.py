@@ -0,0 +1,452 @@
+"""
+Set-up and sequencing of one ball task run
+
+run_session(config) does what the old rt-network_feedback_<site>.py scripts did at import
+time: participant dialog, REAL/SHAM assignment, output files, scale factor, the run itself
+(see routines.py) and relaunching the task for the next run.
+"""
+
+import fnmatch  # for matching csv file names for given run for sham subjects
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from psychopy import core, gui, logging
+
+from .ball import adjust_scale_factor
+from .journal import JournalWriter, journal_file, load_journal, rebuild_outputs
+from .outputs import (frames_file, records_file, roi_outputs_file, run_files, set_aside_run_files,
+                      slider_questions_file, triggers_file)
+from .stream import BidsTsvSink, CsvSink, JournalSink, PickleSink, RecordStream, journal_records
+from .sites import SITE_PROFILES
+
+# The ball task folder (data/, feedback/, the reopen scripts) is the parent of this package
+TASK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXP_NAME = 'DMN_BallTask'
+FILENAME_PREFIX = 'sub-mindbpd'
+
+NUM_ROIS = 2
+RUN_TIME = 150  # seconds of feedback
+BASELINE_TIME = 30  # seconds of fixation before feedback
+PDA_OUTLIER_THRESHOLD = 2
+
+# Fewer hits than MIN_HITS --> scale factor goes up and ball moves faster
+# More hits than MAX_HITS (in either direction) --> scale factor goes down and ball moves more slowly
+MIN_HITS = 3
+MAX_HITS = 5
+# default scale factor (higher means ball moves up/down faster)
+DEFAULT_SCALE_FACTOR = 10
+# a prior run needs more than this many volumes to be used for the scale factor
+COMPLETE_RUN_VOLUMES = 140
+
+LAST_FEEDBACK_RUN = '5'
+
+# Imported in the background while the dialog is open. psychopy.visual/event are not prefetched:
+# importing pyglet's window module creates an OpenGL context, which has to belong to the main thread.
+PREFETCH_MODULES = ('pandas', 'psychopy.data', 'bids_tsv_convert_balltask', 'murfi_activation_communicator')
+
+
+def _prefetch_modules():
+    """Import modules needed after the dialog while the experimenter is still filling it in"""
+    for module_name in PREFETCH_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            print(f'WARNING: could not prefetch {module_name}: {e}')
+
+
+def parse_command_line(argv):
+    """
+    Dialog defaults from the command line: participant run feedback_on feedback_condition anchor...
+
+    The reopen_balltask scripts pass these so that runs 2+ start pre-filled.
+    """
+    num_cmd_line_arguments = len(argv)
+    inputs = {'participant': argv[1] if num_cmd_line_arguments >= 2 else '',
+              'run': argv[2] if num_cmd_line_arguments >= 3 else ''}
+
+    # cmd line arg 3 is feedback / no feedback (first entry of a list is the dialog default)
+    if num_cmd_line_arguments >= 4:
+        inputs['feedback_on'] = ['Feedback', 'No Feedback'] if argv[3] == 'Feedback' else ['No Feedback', 'Feedback']
+    else:
+        inputs['feedback_on'] = ['', 'Feedback', 'No Feedback']
+
+    # cmd line arg 4 is 15min vs 30min
+    if num_cmd_line_arguments >= 5:
+        inputs['feedback_condition'] = ['15min', '30min'] if argv[4] == '15min' else ['30min', '15min']
+    else:
+        inputs['feedback_condition'] = ['', '15min', '30min']
+
+    # cmd line arg 5+ is the anchor
+    inputs['anchor'] = ' '.join(argv[5:]) if num_cmd_line_arguments >= 6 else ''
+    return inputs
+
+
+def show_session_dialog(site, inputs):
+    """Show the dialog until feedback (and session length, if asked) is chosen; quits on Cancel"""
+    exp_info = {'participant': inputs['participant'], 'run': inputs['run'], 'anchor': inputs['anchor'],
+                'feedback_on': inputs['feedback_on']}
+    labels = {'participant': site.participant_label,
+              'run': 'Run',
+              'feedback_on': 'Display Feedback?',
+              'anchor': 'Participant Anchor'}
+    order = ['participant', 'run', 'feedback_on', 'anchor']
+    if site.ask_feedback_condition:
+        exp_info['feedback_condition'] = inputs['feedback_condition']
+        labels['feedback_condition'] = 'Session Length'
+        order.insert(3, 'feedback_condition')
+
+    def incomplete():
+        return (exp_info['feedback_on'] not in ['Feedback', 'No Feedback'] or
+                (site.ask_feedback_condition and exp_info['feedback_condition'] not in ['15min', '30min']))
+
+    while incomplete():
+        exp_info['feedback_on'] = inputs['feedback_on']
+        if site.ask_feedback_condition:
+            exp_info['feedback_condition'] = inputs['feedback_condition']
+        dlg = gui.DlgFromDict(dictionary=exp_info, title=EXP_NAME, labels=labels, order=order)
+        if not dlg.OK:
+            core.quit()  # user pressed cancel
+
+    if not site.ask_feedback_condition:
+        exp_info['feedback_condition'] = site.default_feedback_condition
+    return exp_info
+
+
+def load_randomization(site, participant):
+    """
+    REAL/SHAM assignment from the site's randomization list
+
+    Returns
+    -------
+    (sham, matched_participant) : matched_participant is the REAL participant a SHAM
+        participant is yoked to (None for REAL participants)
+    """
+    import pandas as pd
+    rand_list = pd.read_csv(site.randlist_file, delimiter='\t', header=None)
+
+    # Get the current subject number - randlist numbers are relative to the site's offset
+    sub_num = int(participant) - site.participant_offset
+    sub_row = rand_list.loc[rand_list[0] == sub_num]
+    if list(sub_row[1])[0] == 'R':
+        return False, None
+
+    # The matching REAL participant has the same code with S replaced by R
+    sham_code = list(sub_row[2])[0]
+    real_code = sham_code.replace('S', 'R')
+    sub_match_row = rand_list.loc[rand_list[2] == real_code]
+    sub_match_num = list(sub_match_row[0])[0]
+    return True, str(site.participant_offset + sub_match_num)
+
+
+def output_filename(participant, run, feedback_on):
+    """e.g. data/sub-mindbpd2098/sub-mindbpd2098_DMN_feedback_1"""
+    foldername = os.path.join('data', FILENAME_PREFIX + participant)
+    condition = 'feedback' if feedback_on == 'Feedback' else 'nofeedback'
+    return foldername + os.path.sep + '%s%s_DMN_%s_%s' % (FILENAME_PREFIX, participant, condition, run)
+
+
+def load_resumable_run(filename):
+    """JournalState of a run that crashed after its trigger, or None"""
+    try:
+        state = load_journal(journal_file(filename))
+    except (OSError, ValueError) as e:
+        if os.path.exists(journal_file(filename)):
+            print(f'WARNING: could not read the journal of {filename}: {e}')
+        return None
+    return state if state.resumable else None
+
+
+def resolve_existing_run(exp_info, filename):
+    """
+    If the run already has data, ask whether to resume it (after a crash), move on to the next run or overwrite it
+
+    Overwritten files are moved to an overwritten/ folder next to them, never deleted.
+
+    Returns
+    -------
+    (filename, resume) : the filename to use (exp_info['run'] is updated when moving on) and the
+        JournalState of the crashed run to continue, or None
+    """
+    while os.path.exists(roi_outputs_file(filename)) or os.path.exists(journal_file(filename)):
+        run = int(exp_info['run'])
+        resume = load_resumable_run(filename)
+        choices = [f"Run {run + 1}", f"Overwrite Run {run}"]
+        if resume is not None:
+            choices.insert(0, f"Resume Run {run}")
+        warning_box = gui.Dlg(title='WARNING')
+        warning_box.addText(
+            f'Already have data for {exp_info["participant"]} run {exp_info["run"]}!\n'
+            + (f'The run did not finish: choose Resume Run {run} to continue it where it stopped\n'
+               if resume is not None else '') +
+            f'Click OK to write to Run {run + 1} instead\n'
+            f'To overwrite run {exp_info["run"]}, select this option from the dropdown menu '
+            f'(the old files are kept in an overwritten folder)\n'
+            f'Or, click Cancel to exit'
+        )
+        warning_box.addField('Choose Run #', choices=choices)
+        warning_box_data = warning_box.show()
+        if not warning_box.OK:
+            core.quit()
+
+        run_choice = warning_box_data[0].strip()
+        if run_choice == f"Resume Run {run}":
+            print('RESUME')
+            return filename, resume
+        elif run_choice != f"Overwrite Run {exp_info['run']}":
+            # not overwriting: move on to the next run
+            exp_info['run'] = run + 1
+            filename = output_filename(exp_info['participant'], exp_info['run'], exp_info['feedback_on'])
+        else:
+            print('OVERWRITE')
+            print(filename)
+            for file in set_aside_run_files(run_files(filename)):
+                print(f'Moved aside: {file}')
+            break
+    return filename, None
+
+
+def open_record_stream(filename, resume=None):
+    """
+    Record stream of a run, written to its journal, csv files, records pickle and BIDS tsv
+
+    The journal sink comes first, so the journal is never behind the other outputs. For a resumed
+    run (resume is its JournalState), the records pickle and BIDS tsv, which are written at close,
+    are seeded with the records from before the crash; the csv files were rebuilt from the journal.
+    """
+    earlier = journal_records(resume) if resume is not None else {}
+    return RecordStream([JournalSink(JournalWriter(journal_file(filename))),
+                         CsvSink(roi_outputs_file(filename), 'volume'),
+                         CsvSink(frames_file(filename), 'frame'),
+                         CsvSink(triggers_file(filename), 'pulse'),
+                         CsvSink(slider_questions_file(filename), 'slider'),
+                         PickleSink(records_file(filename), earlier),
+                         BidsTsvSink(earlier.get('volume', []), earlier.get('slider', []))])
+
+
+def initial_scale_factor(filename, run):
+    """
+    Scale factor for this run
+
+    Run 1 starts at DEFAULT_SCALE_FACTOR. Later runs adjust the scale factor of the most recent
+    prior run with more than COMPLETE_RUN_VOLUMES volumes (see adjust_scale_factor).
+    """
+    import pandas as pd
+    run = int(run)
+    if run == 1:
+        print('Run 1: starting with default scale scale factor')
+        return DEFAULT_SCALE_FACTOR
+
+    try:
+        # loop through prior runs, starting at most recent, until one with enough volumes is found
+        last_run_info = None
+        for last_run in range(run - 1, 0, -1):
+            last_run_filename = roi_outputs_file(filename.replace(f"feedback_{run}", f"feedback_{last_run}"))
+            print(last_run_filename)
+            run_info = pd.read_csv(last_run_filename)
+            if run_info.shape[0] > COMPLETE_RUN_VOLUMES:
+                last_run_info = run_info
+                break
+
+        # ONLY update scale factor if there is a prior COMPLETE run to use to do this
+        if last_run_info is None:
+            print('WARNING: no prior complete runs. Settting to default scale factor.')
+            return DEFAULT_SCALE_FACTOR
+
+        # Max values in cumulative hits columns give the total number of hits each in the last run
+        last_run_cen_hits = last_run_info.cen_cumulative_hits.max()
+        last_run_dmn_hits = last_run_info.dmn_cumulative_hits.max()
+        last_run_scale_factor = last_run_info.scale_factor[0]
+        print('Last run volumes: ', last_run_info.shape[0], ' Last run filename: ', last_run_filename)
+        print('Last run CEN hits: ', last_run_cen_hits, ' Last run DMN hits: ', last_run_dmn_hits)
+
+        scale_factor = adjust_scale_factor(last_run_scale_factor, last_run_cen_hits, last_run_dmn_hits,
+                                           MIN_HITS, MAX_HITS)
+        print('Last run scale factor: ', last_run_scale_factor, ' This run scale factor: ', scale_factor)
+        return scale_factor
+
+    # If this breaks (no prior runs) use default scale factor
+    except Exception as error:
+        print(error)
+        print('ERROR: could not pull scale factor from previous run. Settting to default scale factor.')
+        return DEFAULT_SCALE_FACTOR
+
+
+def prepare_sham(participant, matched_participant, run, feedback_on):
+    """
+    Copy the matched REAL participant's data to feedback/ and load the frames to replay
+
+    Returns
+    -------
+    pd.DataFrame of the matched run's frames csv, or None for No Feedback runs
+    """
+    import pandas as pd
+    feedback_csv_path = os.path.join("feedback", FILENAME_PREFIX + participant)
+    if not os.path.exists(feedback_csv_path):
+        shutil.copytree(os.path.join("data", FILENAME_PREFIX + matched_participant), feedback_csv_path)
+
+    if feedback_on != 'Feedback':
+        return None
+
+    # exactly one frames csv of the matched participant for this run
+    pattern = f"*feedback_{run}_frames.csv"
+    matching_files = [f for f in os.listdir(feedback_csv_path) if fnmatch.fnmatch(f, pattern)]
+    print(matching_files)
+    if len(matching_files) == 0:
+        raise FileNotFoundError(f"CSV file error '{feedback_csv_path}' matching pattern '{pattern}'")
+    elif len(matching_files) > 1:
+        raise ValueError(f"Multiple CSV file error '{feedback_csv_path}' matching pattern '{pattern}'")
+
+    csv_file = os.path.join(feedback_csv_path, matching_files[0])
+    print(f"csv file: {csv_file}")
+    return pd.read_csv(csv_file)
+
+
+def next_run_settings(run, feedback_on):
+    """Run number and feedback setting the task is relaunched with after this run"""
+    run = str(run)
+    if run == '1' and feedback_on == 'No Feedback':
+        return 1, 'Feedback'
+    elif run == '2' and feedback_on == 'No Feedback':
+        return 6, 'Feedback'
+    elif run == '5':
+        return 2, 'No'
+    elif run == '10':
+        return 3, 'No'
+    return int(run) + 1, 'Feedback'
+
+
+def launch_next_run(site, exp_info):
+    """Relaunch the task for the next run (or sync the data after the last run of a 15min session)"""
+    next_run, next_feedback = next_run_settings(exp_info['run'], exp_info['feedback_on'])
+    args = [str(exp_info['participant']), str(next_run), str(next_feedback),
+            str(exp_info['feedback_condition']), str(exp_info['anchor'])]
+
+    if exp_info['feedback_condition'] == '15min' and next_run >= 6:
+        if site.sync_command:
+            print('Syncing OneDrive. Please wait')
+            subprocess.Popen(list(site.sync_command))
+    else:
+        subprocess.Popen(list(site.reopen_command) + args)
+
+
+def run_session(config, argv=None):
+    """
+    Run one ball task run for a site
+
+    Parameters
+    ----------
+    config : SiteProfile or str
+        Site profile, or its name in SITE_PROFILES ('mgh', 'yale')
+    argv : list
+        Command line used to pre-fill the dialog (default: sys.argv)
+    """
+    startup_time = time.time()
+    site = SITE_PROFILES[config] if isinstance(config, str) else config
+    argv = sys.argv if argv is None else argv
+
+    # Ensure that relative paths start from the ball task folder
+    os.chdir(TASK_DIR)
+    if TASK_DIR not in sys.path:
+        sys.path.insert(0, TASK_DIR)
+    prefetch_thread = threading.Thread(target=_prefetch_modules, name='prefetch_modules', daemon=True)
+    prefetch_thread.start()
+
+    inputs = parse_command_line(argv)
+
+    # startup_benchmark.py stops the task here, when the dialog would be shown
+    if os.environ.get('BALLTASK_STARTUP_BENCHMARK'):
+        print(f'BENCHMARK dialog_ready {time.time() - startup_time:.4f}')
+        prefetch_thread.join()
+        print(f'BENCHMARK prefetch_done {time.time() - startup_time:.4f}')
+        sys.exit(0)
+
+    exp_info = show_session_dialog(site, inputs)
+
+    # Modules prefetched in the background are already in sys.modules by now (or finish importing here)
+    prefetch_thread.join()
+    from psychopy import data
+    from . import routines
+
+    # Hard code other experiment info
+    exp_info['date'] = data.getDateStr()
+    exp_info['expName'] = EXP_NAME
+    exp_info['No_of_ROIs'] = NUM_ROIS
+    exp_info['Level_1_2_3'] = 1
+    exp_info['Run_Time'] = RUN_TIME
+    exp_info['pda_outlier_threshold'] = PDA_OUTLIER_THRESHOLD
+    exp_info['tr'] = site.tr
+
+    sham, matched_participant = load_randomization(site, exp_info['participant'])
+
+    # Setup files for saving
+    os.makedirs(os.path.join('data', FILENAME_PREFIX + exp_info['participant']), exist_ok=True)
+    print("expInfo['feedback_on'] =", exp_info['feedback_on'])
+    filename = output_filename(exp_info['participant'], exp_info['run'], exp_info['feedback_on'])
+    filename, resume = resolve_existing_run(exp_info, filename)
+    if resume is None:
+        exp_info['scale_factor'] = initial_scale_factor(filename, exp_info['run'])
+    else:
+        exp_info['scale_factor'] = resume.scale_factor
+
+    sham_frames = None
+    if sham:
+        sham_frames = prepare_sham(exp_info['participant'], matched_participant, exp_info['run'],
+                                   exp_info['feedback_on'])
+
+    # save a log file for detail verbose info
+    logging.LogFile(filename + '.log', level=logging.EXP)
+    logging.console.setLevel(logging.WARNING)  # this outputs to the screen, not a file
+
+    if resume is not None:
+        # start from csv files that match the journal (the crashed run's files are moved aside)
+        rebuild_outputs(journal_file(filename), filename)
+    # Every record of the run is emitted once and written to all outputs on a background thread
+    output = open_record_stream(filename, resume)
+    if resume is None:
+        output.emit('run_info', dict(exp_info))
+    # An ExperimentHandler isn't essential but helps with data saving (its pickle is replaced by the records pickle)
+    this_exp = data.ExperimentHandler(name=EXP_NAME, version='', extraInfo=exp_info, runtimeInfo=None,
+                                      originPath=None, savePickle=False, saveWideText=True, dataFileName=filename)
+
+    ctx = routines.RunContext(site, exp_info, filename, this_exp, output, sham_frames, resume)
+    # a resumed run skips the instructions
+    slides = [] if resume is not None else site.instruction_slides(exp_info['feedback_on'], exp_info['run'],
+                                                                   exp_info['anchor'])
+    routines.open_window(ctx, slides)
+
+    if resume is None:
+        routines.run_instructions(ctx)
+        routines.connect_murfi(ctx)
+        routines.wait_for_trigger(ctx)
+        elapsed = 0.0
+    else:
+        routines.connect_murfi(ctx)
+        elapsed = routines.resume_run(ctx, resume)
+    if elapsed < BASELINE_TIME:
+        routines.run_baseline(ctx, BASELINE_TIME - elapsed)
+    feedback_elapsed = max(0.0, elapsed - BASELINE_TIME)
+    if ctx.sham_playback:
+        routines.run_sham_feedback(ctx, start_time=feedback_elapsed)
+    else:
+        routines.run_feedback(ctx, RUN_TIME, start_time=feedback_elapsed)
+    routines.save_timing(ctx)
+    output.emit('end')
+
+    routines.run_end_fixation(ctx)
+    routines.run_slider_questions(
+        ctx, last_feedback_run=str(exp_info['run']) == LAST_FEEDBACK_RUN and ctx.feedback_on)
+
+    # Write the remaining records and the end-of-run outputs (records pickle, BIDS-format tsv)
+    output.close()
+    routines.show_thank_you(ctx)
+
+    # Shut down psychopy before starting next run
+    routines.quit_psychopy()
+    launch_next_run(site, exp_info)
+    sys.exit('Done with run')
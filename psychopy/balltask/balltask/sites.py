@@ -0,0 +1,187 @@
+"""
+Site profiles for the ball task
+
+Everything that differs between the MGH and Yale set-ups (button box codes, the MURFI
+address, screen, randomization list, how the next run is relaunched and the wording of
+a few instruction slides) lives here. The task itself is identical for every site.
+"""
+
+from dataclasses import dataclass, replace
+
+# Instruction slides shared by all sites. '{anchor}' is filled in with the participant's anchor.
+NO_FEEDBACK_RUN1_TEXT = "Next, you will get to continue the Mindful Describing practice you just learned.\
+    \n\nBefore, you mentioned using your {anchor} as an anchor for your Describing Practice. \
+Try to continue using this as your anchor, but it is also okay to switch anytime.\
+\n\nYou will see 2 circles with a white ball in the middle, but they won't move for now."
+
+READY_TEXT = "You will see the plus sign (+) for 30 seconds at the start. \
+Whenever you see the plus +, please don't practice Describing - just relax.\
+\n\nOnce the circles appear, please start the Describing practice. \
+This practice will last 2.5 min."
+
+READY_TEXT_SHORT = "When you see the plus sign (+), just relax.\
+\n\nOnce the circles appear, please start the Describing practice. \
+This scan will last 2.5 min."
+
+NO_FEEDBACK_LATER_RUNS_TEXT = "Great job! Next, you'll get to practice Describing for another 2.5min. \
+\nThis time the ball and circles will not move, so you don't need to check them."
+
+FEEDBACK_RUN1_TEXT_DESCRIBING = "Try to focus mostly on the Mindful Describing Practice by being aware of your sensations from moment to moment and silently making a note in your mind. \
+\n\nYou can check the screen every once in a while to see where the ball is going."
+
+
+@dataclass(frozen=True)
+class SiteProfile:
+    """
+    Site-specific settings for a ball task session
+
+    Parameters
+    ----------
+    name : str
+        Short site name, used in messages
+    left_button, right_button, enter_button : str
+        Button box key codes used by the slider questions
+    trigger_keys : tuple
+        Keys sent by the scanner trigger
+    murfi_ip : str
+        Address of the MURFI computer (127.0.0.1 when everything runs on one machine)
+    murfi_port : int
+        MURFI info server port
+    murfi_num_trs : int
+        Number of volumes the communicator keeps a slot for
+    murfi_fake : bool
+        Generate random activations instead of talking to MURFI (for testing without a scanner)
+    feedback_server : str or None
+        'host:port' of a feedback_server.py to get the activations from instead of MURFI itself
+    feedback_session : str or None
+        Session on the feedback server (default: the site name)
+    tr : float
+        Repetition time in seconds
+    fullscr, screen, window_size
+        psychopy.visual.Window settings
+    randlist_file : str
+        Tab-separated randomization list (subject number, R/S, matching code), relative to the task folder
+    participant_offset : int
+        Added to the randlist subject number to get the participant ID (e.g. 2000 for MGH)
+    ask_feedback_condition : bool
+        Show the 15min/30min session length in the dialog; otherwise default_feedback_condition is always used
+    default_feedback_condition : str
+        '15min' or '30min'
+    non_slip_timing : bool
+        Extend one routine timer across baseline and feedback (PsychoPy Builder's non-slip timing) instead of
+        starting a fresh countdown for each routine
+    print_sham_progress : bool
+        Print SHAM playback progress to the console (off when the experimenter must stay blind)
+    reopen_command : tuple
+        Command that relaunches the task for the next run; participant, run, feedback, condition and anchor
+        are appended
+    sync_command : tuple or None
+        Command run instead of relaunching after the last run of a 15min session
+    """
+
+    name: str
+    left_button: str
+    right_button: str
+    enter_button: str
+    trigger_keys: tuple
+    murfi_ip: str
+    reopen_command: tuple
+    randlist_file: str
+    participant_offset: int
+    murfi_port: int = 15001
+    murfi_num_trs: int = 210
+    murfi_fake: bool = False
+    feedback_server: str = None
+    feedback_session: str = None
+    tr: float = 1.2
+    fullscr: bool = True
+    screen: int = 1
+    window_size: tuple = (1080, 1080)
+    ask_feedback_condition: bool = True
+    default_feedback_condition: str = '15min'
+    non_slip_timing: bool = False
+    print_sham_progress: bool = True
+    sync_command: tuple = None
+    no_feedback_run1_slides: tuple = (NO_FEEDBACK_RUN1_TEXT, READY_TEXT)
+    no_feedback_later_runs_slides: tuple = (NO_FEEDBACK_LATER_RUNS_TEXT, READY_TEXT_SHORT)
+    feedback_run1_slides: tuple = ()
+    feedback_later_runs_slides: tuple = ()
+
+    @property
+    def participant_label(self):
+        """Label for the participant ID field, e.g. 'Participant ID (2XXX)'"""
+        return f'Participant ID ({self.participant_offset // 1000}XXX)'
+
+    def instruction_slides(self, feedback_on, run, anchor=''):
+        """Instruction slides to show before a run"""
+        first_run = int(run) == 1
+        if feedback_on == 'Feedback':
+            slides = self.feedback_run1_slides if first_run else self.feedback_later_runs_slides
+        else:
+            slides = self.no_feedback_run1_slides if first_run else self.no_feedback_later_runs_slides
+        return [slide.format(anchor=anchor) for slide in slides]
+
+    def with_overrides(self, **changes):
+        """Copy of this profile with some settings changed, e.g. MGH.with_overrides(murfi_fake=True)"""
+        return replace(self, **changes)
+
+
+MGH = SiteProfile(
+    name='mgh',
+    left_button='1',
+    right_button='2',
+    enter_button='0',
+    trigger_keys=('t', '+', '5', 5, 'equal', 'shift+=', 'num_equal', '='),
+    # MURFI computer is 192.168.2.5, the external stimulus computer 192.168.2.6;
+    # 127.0.0.1 when running everything on the System76 computer
+    murfi_ip='127.0.0.1',
+    murfi_fake=True,
+    fullscr=False,
+    randlist_file='feedback/mgh_randlist.txt',
+    participant_offset=2000,
+    ask_feedback_condition=False,
+    non_slip_timing=True,
+    print_sham_progress=False,
+    reopen_command=('bash', 'reopen_balltask_mgh.sh'),
+    sync_command=('onedrive', '--synchronize', '--single-directory', 'MIND-BPD/psychopy', '>>', 'onedrive_log.tx'),
+    feedback_run1_slides=(
+        "Great job! Now, you'll get to try moving the ball with your mindful describing practice! \
+\n\nYou will see the 2 circles and white ball again. \
+When the white ball moves up towards the top yellow circle, this means you are in a mindful brain state with your describing practice. \
+\nIf the ball reaches either of the circles, it will move back to the center.",
+        READY_TEXT_SHORT),
+    feedback_later_runs_slides=(
+        "Great job! Now, you're going practice Mindful Describing for another 2.5min with more brain feedback from the ball. \
+\n\nWhen the ball moves upwards, that corresponds to the describing practice.",
+        READY_TEXT_SHORT),
+)
+
+YALE = SiteProfile(
+    name='yale',
+    left_button='3',
+    right_button='4',
+    enter_button='1',
+    trigger_keys=('t', '+', '5', 5),
+    murfi_ip='192.168.2.6',
+    murfi_fake=False,
+    fullscr=True,
+    randlist_file='mgh_randlist.txt',
+    participant_offset=1000,
+    ask_feedback_condition=True,
+    non_slip_timing=False,
+    print_sham_progress=True,
+    reopen_command=('reopen_balltask_yale.bat',),
+    feedback_run1_slides=(
+        "Great job! Now, you'll get to continue your Mindful Describing with some feedback based on your actual brain activity to help your practice! \
+\n\nYou will see the 2 circles and white ball again. \
+When the white ball moves up towards the top yellow circle, this means you are in a mindful brain state with your Describing practice. \
+\nIf the ball reaches either of the circles, it will move back to the center.",
+        FEEDBACK_RUN1_TEXT_DESCRIBING,
+        READY_TEXT),
+    feedback_later_runs_slides=(
+        "Great job! Next, you'll get to practice Mindful Describing for another 2.5min with more brain feedback from the ball. \
+\n\nWhen the ball moves upwards, that corresponds to the Describing Practice.",
+        READY_TEXT_SHORT),
+)
+
+SITE_PROFILES = {'mgh': MGH, 'yale': YALE}
@@ -0,0 +1,235 @@
+"""
+One record stream per run, written to every output by pluggable sinks
+
+The routines emit each record once (a volume, a screen frame, a scanner pulse, a slider
+answer, ...) with RecordStream.emit(), which only puts it on a queue. A writer thread hands
+every record to each sink, so no file is opened, formatted or written in the render loop:
+
+    CsvSink      one csv per record kind (roi_outputs, frames, slider_questions, triggers),
+                 appended and flushed record by record
+    JournalSink  the binary session journal (balltask.journal)
+    PickleSink   all records of the run in one pickle, written at close
+    BidsTsvSink  the BIDS tsv (bids_tsv_convert_balltask), built from the records at close
+
+A failing sink is reported and switched off without affecting the others. A new output format
+is a new Sink subclass; the routines do not change.
+
+Record kinds and their records:
+    run_info        the ExperimentHandler's extraInfo (dict)
+    trigger_start   (wall clock time, global clock time) at the trigger clock's zero
+    volume          roi_outputs row (list, see roi_output_row)
+    pulse           (volume, time) of a scanner pulse
+    frame           frame_record dict
+    slider          slider_questions row (list)
+    end             None; the run's feedback finished normally
+"""
+
+import atexit
+import csv
+import os
+import pickle
+import queue
+import threading
+
+from .outputs import ROI_OUTPUT_COLUMNS, SLIDER_QUESTION_COLUMNS, TRIGGER_COLUMNS
+
+# columns of the record kinds written as csv rows (frames take their columns from the first record)
+RECORD_COLUMNS = {
+    'volume': ROI_OUTPUT_COLUMNS,
+    'slider': SLIDER_QUESTION_COLUMNS,
+    'pulse': TRIGGER_COLUMNS,
+    'frame': None,
+}
+
+
+class Sink:
+    """Consumes the records of a run; write() and close() are called on the writer thread"""
+
+    def write(self, kind, record):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvSink(Sink):
+    """
+    Appends one kind of record to a csv, flushing every row
+
+    The file (and its header) is created with the first record; an existing file is continued
+    without a new header (resumed runs).
+    """
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.columns = RECORD_COLUMNS[kind]
+        self._file = None
+        self._writer = None
+
+    def _open(self, record):
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self._file = open(self.path, 'a', newline='')
+        self._writer = csv.writer(self._file, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        if self.columns is None:
+            self.columns = list(record)
+        if not exists:
+            self._writer.writerow(self.columns)
+
+    def write(self, kind, record):
+        if kind != self.kind:
+            return
+        if self._file is None:
+            self._open(record)
+        self._writer.writerow([record[c] for c in self.columns] if isinstance(record, dict) else record)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class JournalSink(Sink):
+    """Appends every record to the run's binary journal (see balltask.journal)"""
+
+    def __init__(self, journal):
+        self.journal = journal
+
+    def write(self, kind, record):
+        if kind == 'run_info':
+            self.journal.run_info(record)
+        elif kind == 'trigger_start':
+            self.journal.trigger_start(*record)
+        elif kind == 'volume':
+            self.journal.volume(record)
+        elif kind == 'pulse':
+            self.journal.pulse(*record)
+        elif kind == 'frame':
+            self.journal.frame(record)
+        elif kind == 'slider':
+            self.journal.slider(record)
+        elif kind == 'end':
+            self.journal.end()
+
+    def close(self):
+        self.journal.close()
+
+
+def journal_records(state):
+    """
+    Records of a run replayed from its journal (a JournalState), by kind, as they were emitted
+
+    A resumed run seeds the sinks that write at close with them, so their outputs cover the
+    whole run and not only the part after the crash.
+    """
+    records = {'run_info': [state.exp_info],
+               'volume': list(state.volumes),
+               'pulse': [tuple(pulse) for pulse in state.pulses],
+               'frame': [dict(zip(state.frame_columns, frame)) for frame in state.frames],
+               'slider': list(state.sliders)}
+    if state.trigger_wall_time is not None:
+        records['trigger_start'] = [(state.trigger_wall_time, state.trigger_global_time)]
+    return {kind: kind_records for kind, kind_records in records.items() if kind_records}
+
+
+class PickleSink(Sink):
+    """
+    All records of the run, by kind, pickled at close
+
+    records : dict, optional
+        Records written before this sink was created (see journal_records)
+    """
+
+    def __init__(self, path, records=None):
+        self.path = path
+        self.records = {kind: list(kind_records) for kind, kind_records in (records or {}).items()}
+
+    def write(self, kind, record):
+        self.records.setdefault(kind, []).append(record)
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.records, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class BidsTsvSink(Sink):
+    """
+    BIDS tsv of the run, from the volume and slider records, written at close (if the run has both)
+
+    volumes, sliders : list, optional
+        Records written before this sink was created (see journal_records)
+    """
+
+    def __init__(self, volumes=(), sliders=()):
+        self.volumes = list(volumes)
+        self.sliders = list(sliders)
+
+    def write(self, kind, record):
+        if kind == 'volume':
+            self.volumes.append(record)
+        elif kind == 'slider':
+            self.sliders.append(record)
+
+    def close(self):
+        if not (self.volumes and self.sliders):
+            return
+        import pandas as pd
+        from bids_tsv_convert_balltask import convert_balltask_to_bids
+        convert_balltask_to_bids(pd.DataFrame(self.volumes, columns=ROI_OUTPUT_COLUMNS),
+                                 pd.DataFrame(self.sliders, columns=SLIDER_QUESTION_COLUMNS))
+
+
+class RecordStream:
+    """
+    Records of a run, written by sinks on a background thread
+
+    Parameters
+    ----------
+    sinks : list of Sink
+
+    The stream is closed at interpreter exit if close() was not called, so records emitted
+    before a Python exception still reach every output.
+    """
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='record_stream', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def emit(self, kind, record=None):
+        self._queue.put((kind, record))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            kind, record = item
+            for sink in list(self.sinks):
+                try:
+                    sink.write(kind, record)
+                except Exception as e:
+                    print(f'WARNING: {type(sink).__name__} stopped writing: {e}')
+                    self.sinks.remove(sink)
+            self._queue.task_done()
+
+    def flush(self):
+        """Wait until every record emitted so far has been written"""
+        self._queue.join()
+
+    def close(self):
+        """Write the remaining records and close every sink"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                print(f'WARNING: {type(sink).__name__} could not finish: {e}')
@@ -0,0 +1,200 @@
+"""
+Scanner trigger timeline and MURFI poll scheduling, independent of PsychoPy
+
+Every scanner pulse of a run is recorded (not only the first one, which starts the trigger
+clock). A linear model onset(volume) = offset + volume * tr is fitted to the pulses, so the
+actual TR and its drift from the nominal TR are known, missed pulses are bridged, and each
+MURFI volume can be mapped to the time its acquisition started. routines.py feeds the pulses
+in from a non-blocking keyboard; this module only does the bookkeeping.
+
+PollScheduler uses the timeline to decide when MURFI is worth asking for the next volume:
+it learns how long after its pulse a volume arrives and only polls densely around that time.
+"""
+
+from collections import deque
+
+import numpy as np
+
+# A pulse closer than this fraction of a TR to the previous one is the same pulse (e.g. key repeat,
+# or a trigger box that sends two key codes per pulse)
+DUPLICATE_FRACTION = 0.5
+
+# Poll scheduling (seconds)
+ARRIVAL_HISTORY = 20  # volumes the arrival delay is learned from
+MIN_ARRIVALS = 3  # poll on every call until this many arrivals were seen
+WINDOW_MARGIN = 0.05  # dense polling starts this long before the earliest expected arrival
+IDLE_INTERVAL = 0.5  # outside the window, still poll this often (volumes earlier than ever seen)
+LATE_INTERVAL = 0.05  # after the window, poll this often until the volume arrives
+
+
+class TriggerTimeline:
+    """
+    Pulse times of a run and the TR / drift fitted to them
+
+    Parameters
+    ----------
+    tr : float
+        Nominal repetition time in seconds
+    first_volume : int
+        MURFI volume index acquired at the first pulse
+
+    Attributes
+    ----------
+    pulses : list of (volume, time)
+        Recorded pulses, in seconds on the trigger clock
+    tr, offset : float
+        Fitted model; the nominal TR and the first pulse until two pulses are recorded
+    """
+
+    def __init__(self, tr, first_volume=0):
+        self.nominal_tr = tr
+        self.first_volume = first_volume
+        self.pulses = []
+        self._pulse_times = {}
+        self.duplicates = 0
+        self.tr = tr
+        self.offset = None
+        # running sums for the least-squares fit, so adding a pulse is O(1)
+        self._sums = np.zeros(5)  # n, sum v, sum t, sum v*v, sum v*t
+
+    def __len__(self):
+        return len(self.pulses)
+
+    @property
+    def started(self):
+        return bool(self.pulses)
+
+    @property
+    def drift(self):
+        """Relative difference between the fitted and the nominal TR (e.g. 0.001 = 1 ms per second)"""
+        return self.tr / self.nominal_tr - 1
+
+    def add_pulse(self, time):
+        """
+        Record a pulse
+
+        Returns
+        -------
+        The volume index the pulse starts, or None if it duplicates the previous pulse
+        """
+        if not self.pulses:
+            volume = self.first_volume
+        else:
+            last_volume, last_time = self.pulses[-1]
+            if time - last_time < DUPLICATE_FRACTION * self.tr:
+                self.duplicates += 1
+                return None
+            # round to the nearest volume of the model, so missed pulses leave a gap instead of shifting the rest
+            volume = max(last_volume + 1, int(round((time - self.offset) / self.tr)))
+        self.pulses.append((volume, time))
+        self._pulse_times[volume] = time
+        self._sums += (1, volume, time, volume * volume, volume * time)
+        self._fit()
+        return volume
+
+    def _fit(self):
+        n, sum_v, sum_t, sum_vv, sum_vt = self._sums
+        denominator = n * sum_vv - sum_v * sum_v
+        if n < 2 or denominator <= 0:
+            self.offset = self.pulses[0][1] - self.pulses[0][0] * self.tr
+            return
+        self.tr = (n * sum_vt - sum_v * sum_t) / denominator
+        self.offset = (sum_t - self.tr * sum_v) / n
+
+    def predicted_onset(self, volume):
+        """Model time of the pulse that starts `volume` (nan before the first pulse)"""
+        if self.offset is None:
+            return np.nan
+        return self.offset + volume * self.tr
+
+    def onset(self, volume):
+        """Recorded pulse time of `volume`, or the model time if its pulse was missed or is still to come"""
+        if volume in self._pulse_times:
+            return self._pulse_times[volume]
+        return self.predicted_onset(volume)
+
+    def next_volume(self, time):
+        """Index and model onset of the first volume that starts after `time`"""
+        if self.offset is None:
+            return self.first_volume, np.nan
+        volume = max(self.first_volume, int(np.floor((time - self.offset) / self.tr)) + 1)
+        return volume, self.predicted_onset(volume)
+
+    def residuals(self):
+        """Recorded minus model pulse times, in seconds"""
+        return np.array([time - self.predicted_onset(volume) for volume, time in self.pulses])
+
+    def summary(self):
+        """Pulse count, fitted TR, drift and pulse jitter (for the log / ExperimentHandler)"""
+        residuals = self.residuals()
+        expected = self.pulses[-1][0] - self.pulses[0][0] + 1 if self.pulses else 0
+        return {'pulses': len(self.pulses),
+                'missed_pulses': expected - len(self.pulses),
+                'duplicate_pulses': self.duplicates,
+                'fitted_tr': float(self.tr),
+                'tr_drift': float(self.drift),
+                'pulse_jitter_sd': float(np.std(residuals)) if len(residuals) > 2 else np.nan}
+
+
+class PollScheduler:
+    """
+    When to ask MURFI for the next volume
+
+    Volume v arrives a roughly constant delay after its pulse (acquisition plus MURFI's
+    processing). The scheduler learns that delay from the last ARRIVAL_HISTORY volumes and
+    returns True from should_poll() on every call inside the window where the next volume is
+    expected, every late_interval after the window (late volumes), and every idle_interval
+    before it. Until MIN_ARRIVALS volumes arrived, or before the first pulse, every call polls.
+
+    Parameters
+    ----------
+    timeline : TriggerTimeline
+    """
+
+    def __init__(self, timeline, window_margin=WINDOW_MARGIN, idle_interval=IDLE_INTERVAL,
+                 late_interval=LATE_INTERVAL, history=ARRIVAL_HISTORY):
+        self.timeline = timeline
+        self.window_margin = window_margin
+        self.idle_interval = idle_interval
+        self.late_interval = late_interval
+        self.delays = deque(maxlen=history)
+        self.last_poll = -np.inf
+        self.polls = 0
+        self.arrivals = 0
+
+    def window(self, volume):
+        """(start, end) of the dense polling window for `volume`, or None while still learning"""
+        if len(self.delays) < MIN_ARRIVALS or not self.timeline.started:
+            return None
+        delays = np.asarray(self.delays)
+        median = np.median(delays)
+        spread = 3 * 1.4826 * np.median(np.abs(delays - median))  # ~3 standard deviations, robust to outliers
+        onset = self.timeline.onset(volume)
+        # early volumes widen the window; late ones are caught by the late polls instead
+        return (onset + min(median - spread, delays.min()) - self.window_margin,
+                onset + median + spread + self.window_margin)
+
+    def should_poll(self, volume, now):
+        """Whether to ask MURFI for `volume` at time `now` (trigger clock)"""
+        window = self.window(volume)
+        if window is None or window[0] <= now <= window[1]:
+            return True
+        interval = self.idle_interval if now < window[0] else self.late_interval
+        return now - self.last_poll >= interval
+
+    def polled(self, now):
+        self.last_poll = now
+        self.polls += 1
+
+    def arrived(self, volume, now):
+        """Learn from a volume that was received at `now`"""
+        self.arrivals += 1
+        onset = self.timeline.onset(volume)
+        if not np.isnan(onset):
+            self.delays.append(now - onset)
+
+    def summary(self):
+        """Polls per received volume and the learned arrival delay"""
+        return {'murfi_polls': self.polls,
+                'murfi_polls_per_volume': self.polls / self.arrivals if self.arrivals else np.nan,
+                'arrival_delay_median': float(np.median(self.delays)) if self.delays else np.nan}
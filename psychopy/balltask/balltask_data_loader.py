@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Fast loader for balltask run outputs (roi_outputs and frames csv files)
+
+The data/ and feedback/ trees are indexed once, csv files are parsed in
+parallel with explicit dtypes, and every parsed run is cached as a .npz file
+in .balltask_cache/ keyed by the csv's mtime and size, so re-running group
+analyses only re-parses files that changed since the last run.
+
+Usage:
+    from balltask_data_loader import BalltaskDataIndex
+    index = BalltaskDataIndex('.')
+    runs = index.load_many([(2098, 1, 'roi_outputs'), (2099, 1, 'roi_outputs')])
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+FILENAME_PREFIX = 'sub-mindbpd'
+CACHE_DIRNAME = '.balltask_cache'
+
+# e.g. sub-mindbpd2098_DMN_feedback_1_roi_outputs.csv
+RUN_FILE_PATTERN = re.compile(
+    r'^' + FILENAME_PREFIX + r'(?P<participant>\d+)_DMN_(?P<condition>feedback|nofeedback)_'
+    r'(?P<run>\d+)_(?P<data_type>roi_outputs|frames)\.csv$')
+
+# Search order for a participant/run, matching the order the analysis scripts always used:
+# data/ feedback runs, then data/ no-feedback runs, then the yoked copies in feedback/
+SEARCH_ORDER = [('data', 'feedback'), ('data', 'nofeedback'), ('feedback', 'feedback')]
+
+# pda_outlier is written as True/False during feedback and nan during baseline, so it is parsed as 1.0/0.0/NaN
+ROI_OUTPUTS_DTYPES = {
+    'volume': 'int64',
+    'scale_factor': 'float64',
+    'time': 'float64',
+    'time_plus_1.2': 'float64',
+    'cen': 'float64',
+    'dmn': 'float64',
+    'stage': 'str',
+    'cen_cumulative_hits': 'int64',
+    'dmn_cumulative_hits': 'int64',
+    'pda_outlier': 'str',
+    'ball_y_position': 'float64',
+    'top_circle_y_position': 'float64',
+    'bottom_circle_y_position': 'float64',
+    'volume_onset': 'float64',
+    'fitted_tr': 'float64',
+    'feedback_latency': 'float64',
+}
+
+# Every column of the frames file is numeric (positions, radii and rgb colors)
+FRAMES_DTYPE = 'float64'
+
+
+def _read_run_csv(path, data_type):
+    """
+    Parse a single roi_outputs or frames csv with explicit dtypes
+
+    Returns
+    -------
+    pd.DataFrame or None if the file is empty or malformed
+    """
+    dtype = ROI_OUTPUTS_DTYPES if data_type == 'roi_outputs' else FRAMES_DTYPE
+    try:
+        try:
+            df = pd.read_csv(path, dtype=dtype)
+        except (ValueError, TypeError):
+            # e.g. a run that crashed mid-row -- fall back to letting pandas infer
+            df = pd.read_csv(path)
+    except pd.errors.EmptyDataError:
+        print(f"Warning: File is empty or malformed: {path}")
+        return None
+    except Exception as e:
+        print(f"Warning: Error reading {path}: {e}")
+        return None
+
+    if df.empty or len(df.columns) == 0:
+        print(f"Warning: File exists but is empty: {path}")
+        return None
+
+    if 'pda_outlier' in df.columns:
+        df['pda_outlier'] = df['pda_outlier'].astype(str).map({'True': 1.0, 'False': 0.0}).astype('float64')
+    return df
+
+
+class BalltaskDataIndex:
+    """
+    Index of every roi_outputs/frames csv under a balltask directory
+
+    Parameters
+    ----------
+    root : str
+        Balltask directory containing data/ and feedback/ (default: current directory)
+    use_cache : bool
+        Read/write parsed runs from/to the .npz cache (default: True)
+    """
+
+    def __init__(self, root='.', use_cache=True):
+        self.root = root
+        self.use_cache = use_cache
+        self.cache_dir = os.path.join(root, CACHE_DIRNAME)
+        self._files = {}
+        self._build_index()
+
+    def _build_index(self):
+        """Walk data/sub-* and feedback/sub-* once and record every run file"""
+        for tree in ('data', 'feedback'):
+            tree_path = os.path.join(self.root, tree)
+            if not os.path.isdir(tree_path):
+                continue
+            with os.scandir(tree_path) as subject_dirs:
+                for subject_dir in subject_dirs:
+                    if not (subject_dir.is_dir() and subject_dir.name.startswith(FILENAME_PREFIX)):
+                        continue
+                    with os.scandir(subject_dir.path) as run_files:
+                        for run_file in run_files:
+                            match = RUN_FILE_PATTERN.match(run_file.name)
+                            # yoked copies in feedback/ keep the REAL participant's filenames, only index
+                            # files belonging to the folder's own participant
+                            if match is None or FILENAME_PREFIX + match['participant'] != subject_dir.name:
+                                continue
+                            key = (tree, match['participant'], int(match['run']),
+                                   match['condition'], match['data_type'])
+                            self._files[key] = run_file.path
+
+    def participants(self, tree='data'):
+        """Sorted participant IDs (as strings) with at least one run file in the given tree"""
+        return sorted({key[1] for key in self._files if key[0] == tree})
+
+    def runs(self, participant_id, data_type='roi_outputs', tree='data', condition='feedback'):
+        """Sorted run numbers available for a participant"""
+        participant_id = str(participant_id)
+        return sorted(key[2] for key in self._files
+                      if key[0] == tree and key[1] == participant_id
+                      and key[3] == condition and key[4] == data_type)
+
+    def candidate_paths(self, participant_id, run_number, data_type='roi_outputs'):
+        """Existing files for a participant/run in SEARCH_ORDER"""
+        participant_id = str(participant_id)
+        paths = []
+        for tree, condition in SEARCH_ORDER:
+            path = self._files.get((tree, participant_id, int(run_number), condition, data_type))
+            if path is not None:
+                paths.append(path)
+        return paths
+
+    def _cache_path(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.cache_dir, f'{stem}_{digest}.npz')
+
+    def _read_cache(self, path, stat):
+        cache_path = self._cache_path(path)
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with np.load(cache_path, allow_pickle=False) as cached:
+                if int(cached['__mtime_ns__']) != stat.st_mtime_ns or int(cached['__size__']) != stat.st_size:
+                    return None
+                columns = [str(c) for c in cached['__columns__']]
+                return pd.DataFrame({c: cached['col_' + c] for c in columns}, columns=columns)
+        except Exception:
+            # unreadable/partial cache file -- just re-parse the csv
+            return None
+
+    def _write_cache(self, path, stat, df):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        arrays = {'col_' + c: (df[c].to_numpy() if pd.api.types.is_numeric_dtype(df[c])
+                               else df[c].astype(str).to_numpy(dtype=str))
+                  for c in df.columns}
+        cache_path = self._cache_path(path)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path,
+                 __mtime_ns__=np.int64(stat.st_mtime_ns),
+                 __size__=np.int64(stat.st_size),
+                 __columns__=np.array(df.columns, dtype=str),
+                 **arrays)
+        os.replace(tmp_path, cache_path)
+
+    def read(self, path, data_type):
+        """Read one run file, using the cache when it is up to date"""
+        stat = os.stat(path)
+        if self.use_cache:
+            df = self._read_cache(path, stat)
+            if df is not None:
+                return df
+        df = _read_run_csv(path, data_type)
+        if df is not None and self.use_cache:
+            try:
+                self._write_cache(path, stat, df)
+            except Exception as e:
+                print(f"Warning: could not cache {path}: {e}")
+        return df
+
+    def load(self, participant_id, run_number, data_type='roi_outputs', verbose=True):
+        """
+        Load data for a participant, trying each candidate file in SEARCH_ORDER
+
+        Returns
+        -------
+        pd.DataFrame or None if no valid file was found
+        """
+        for path in self.candidate_paths(participant_id, run_number, data_type):
+            if verbose:
+                print(f"Loading: {path}")
+            df = self.read(path, data_type)
+            if df is not None:
+                return df
+
+        if verbose:
+            print(f"Warning: Could not find valid {data_type} file for participant {participant_id}, run {run_number}")
+        return None
+
+    def load_many(self, requests, max_workers=None, verbose=False):
+        """
+        Load many (participant_id, run_number, data_type) tuples in parallel
+
+        Returns
+        -------
+        dict mapping each request tuple to a DataFrame (or None)
+        """
+        requests = list(dict.fromkeys(requests))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            frames = pool.map(lambda r: self.load(*r, verbose=verbose), requests)
+            return dict(zip(requests, frames))
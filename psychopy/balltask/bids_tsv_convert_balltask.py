@@ -17,9 +17,15 @@ def convert_balltask_csv_to_bids(infile):
     # presentation_duration=2.5
     # block_type_instruction_duration=2
     slider_outputs = pd.read_csv(infile.replace('roi_outputs', 'slider_questions'))
+    df = pd.read_csv(infile)
+    return convert_balltask_to_bids(df, slider_outputs)
+
+def convert_balltask_to_bids(df, slider_outputs):
+    # same as convert_balltask_csv_to_bids, for roi_outputs / slider_questions tables already in memory
+    # (the task's BidsTsvSink builds them from its record stream instead of reading the csv files back)
     slider_outputs = slider_outputs[-slider_outputs.run.isna()]
     slider_outputs.reset_index(inplace=True)
-    df = pd.read_csv(infile)
+    df = df.copy()
     df.rename(columns = {
                     'time':'onset',
                     'stage':'trial_type',
@@ -39,15 +45,13 @@ def convert_balltask_csv_to_bids(infile):
     df['slider_ballcheck'] = (slider_outputs.loc[slider_outputs.question_text=='How often did you check the position of the ball?', 'response'])
     df['slider_difficulty'] = (slider_outputs.loc[slider_outputs.question_text=='How difficult was it to apply Mindful Describing?', 'response'])
     df['slider_calm'] = (slider_outputs.loc[slider_outputs.question_text=='How calm do you feel right now?', 'response'])
-    df.fillna('n/a', inplace=True)
+    df = df.astype(object).where(df.notna(), 'n/a') # fillna('n/a') fails on float columns in newer pandas
     out_df = df[['onset', 'duration', 'trial_type', 'feedback_source_volume',
                  'cen_signal', 'dmn_signal', 'pda', 
                  'ball_y_position','cen_hit', 'dmn_hit', 
                 'scale_factor', 'participant', 'run', 'feedback_on',
                 'slider_describing', 'slider_ballcheck', 'slider_difficulty', 'slider_calm']]
 
-    outfile_stems = infile.split('_')
-    path = outfile_stems[0].split('/')
     run_num = int(slider_outputs['run'][0])
     if str(slider_outputs['feedback_on'][0]) == 'Feedback':
         run_type = 'feedback'
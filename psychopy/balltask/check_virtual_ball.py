@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Check balltask.ball.VirtualBall against recorded runs
+
+Replays the CEN/DMN activations of each recorded SHAM feedback run through the task's
+VirtualBall and compares its cumulative CEN and DMN hits with the ones the task saved, volume
+by volume. REAL runs are skipped: their hits come from the drawn ball, which keeps moving
+between volumes and is only checked when the next volume arrives. SHAM participants are
+taken from the site's randomization list. Exits with status 1 if any run differs.
+
+Usage:
+    python check_virtual_ball.py
+    python check_virtual_ball.py --site yale --participants 1012 1013
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from balltask.sites import SITE_PROFILES
+from balltask_data_loader import BalltaskDataIndex
+from diagnose_sham_hits import load_run_parameters, simulate_virtual_ball
+
+
+def sham_participants(site):
+    """Participant IDs (as strings) assigned to SHAM in the site's randomization list"""
+    rand_list = pd.read_csv(site.randlist_file, delimiter='\t', header=None)
+    return {str(site.participant_offset + num) for num in rand_list.loc[rand_list[1] == 'S', 0]}
+
+
+def check_run(participant_id, run_number, df):
+    """
+    Replay one run and list the volumes where the virtual hits differ from the recorded ones
+
+    Returns
+    -------
+    list of (volume, recorded (cen, dmn), virtual (cen, dmn)), empty if the run matches
+    """
+    df_fb = df[df['stage'] == 'feedback']
+    params = load_run_parameters(participant_id, run_number, df)
+    if 'top_circle_y_position' in df_fb.columns and 'bottom_circle_y_position' in df_fb.columns:
+        top_target, bottom_target = df_fb['top_circle_y_position'].iloc[0], df_fb['bottom_circle_y_position'].iloc[0]
+    else:
+        top_target, bottom_target = 0.33, -0.33
+    sim = simulate_virtual_ball(df_fb['cen'].to_numpy(), df_fb['dmn'].to_numpy(), params, top_target, bottom_target)
+
+    # cumulative hits after each volume
+    virtual = np.zeros((len(df_fb), 2), dtype=int)
+    for volume_idx, hit_type, _, _ in sim['hits']:
+        virtual[volume_idx:, 0 if hit_type == 'CEN' else 1] += 1
+    recorded = df_fb[['cen_cumulative_hits', 'dmn_cumulative_hits']].to_numpy(dtype=int)
+
+    volumes = df_fb['volume'].to_numpy()
+    return [(int(volumes[i]), tuple(recorded[i].tolist()), tuple(virtual[i].tolist()))
+            for i in np.nonzero((recorded != virtual).any(axis=1))[0]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check VirtualBall hits against recorded feedback runs')
+    parser.add_argument('--site', choices=sorted(SITE_PROFILES), default='mgh',
+                        help='Site whose randomization list tells SHAM from REAL participants (default: mgh)')
+    parser.add_argument('--participants', type=int, nargs='*',
+                        help='Participants to check (default: all in data/)')
+    args = parser.parse_args()
+
+    try:
+        sham = sham_participants(SITE_PROFILES[args.site])
+        index = BalltaskDataIndex('.')
+        participants = [str(pid) for pid in args.participants or index.participants()]
+        n_checked = 0
+        n_differ = 0
+        for pid in participants:
+            if pid not in sham:
+                print(f"{pid}: not a SHAM participant, skipped")
+                continue
+            for run in index.runs(pid):
+                df = index.load(pid, run, 'roi_outputs', verbose=False)
+                if df is None:
+                    continue
+                n_checked += 1
+                mismatches = check_run(pid, run, df)
+                if not mismatches:
+                    print(f"{pid} run {run}: ok")
+                    continue
+                n_differ += 1
+                volume, recorded, virtual = mismatches[0]
+                print(f"{pid} run {run}: {len(mismatches)} volume(s) differ, first at volume {volume} "
+                      f"(recorded CEN/DMN hits {recorded}, virtual {virtual})")
+        print(f"{n_checked - n_differ} of {n_checked} run(s) match")
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    if n_differ or not n_checked:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,143 @@
 """
 Diagnostic script to understand why SHAM isn't getting virtual hits
 
+Task parameters (scale factor, TR, frame rate, outlier threshold, target positions)
+are read from the run's own outputs, and the virtual ball is the task's own
+balltask.ball.VirtualBall, so the simulation cannot drift from what the task counts. The
+whole run is replayed with array operations (VirtualBall.replay) instead of a frame-by-frame
+Python loop.
+
 Usage:
     python diagnose_sham_hits.py --participant 2099 --run 1
+    python diagnose_sham_hits.py --batch
+    python diagnose_sham_hits.py --batch --participants 2099 2100 --output sham_hits_summary.csv
 """
 
+import os
+
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import argparse
 
+from balltask.ball import INTERNAL_SCALER, VirtualBall
+from balltask_data_loader import BalltaskDataIndex, FILENAME_PREFIX
+
+# Used only if a run's outputs don't contain the value
+DEFAULT_PARAMETERS = {'scale_factor': 10, 'tr': 1.2, 'frame_rate': 60.0, 'pda_outlier_threshold': 2}
+
+
+def load_run_parameters(participant_id, run_number, df_roi):
+    """
+    Read the parameters a run was actually collected with
+
+    The ExperimentHandler csv (sub-mindbpdXXXX_DMN_feedback_N.csv) stores tr, frameRate,
+    pda_outlier_threshold and scale_factor. If it is missing, scale factor and TR are
+    taken from the roi_outputs file and the rest fall back to DEFAULT_PARAMETERS.
+
+    Returns
+    -------
+    dict with scale_factor, tr, frame_rate, pda_outlier_threshold and source
+    """
+    params = dict(DEFAULT_PARAMETERS)
+    params['source'] = 'defaults'
+
+    if 'scale_factor' in df_roi.columns and df_roi['scale_factor'].notna().any():
+        params['scale_factor'] = float(df_roi['scale_factor'].dropna().iloc[0])
+        params['source'] = 'roi_outputs'
+    if 'time' in df_roi.columns and len(df_roi) > 1:
+        params['tr'] = float(np.nanmedian(np.diff(df_roi['time'].to_numpy(dtype=float))))
+
+    exp_file = os.path.join('data', f'{FILENAME_PREFIX}{participant_id}',
+                            f'{FILENAME_PREFIX}{participant_id}_DMN_feedback_{run_number}.csv')
+    if os.path.exists(exp_file):
+        try:
+            exp_info = pd.read_csv(exp_file, encoding='utf-8-sig').iloc[0]
+            for column, key in (('tr', 'tr'), ('frameRate', 'frame_rate'),
+                                ('pda_outlier_threshold', 'pda_outlier_threshold'), ('scale_factor', 'scale_factor')):
+                if column in exp_info and pd.notna(exp_info[column]):
+                    params[key] = float(exp_info[column])
+            params['source'] = exp_file
+        except Exception as e:
+            print(f"Warning: could not read run parameters from {exp_file}: {e}")
+
+    return params
+
+
+def simulate_virtual_ball(cen, dmn, params, top_target, bottom_target):
+    """
+    Replay the task's virtual ball for one run
+
+    Replays all volumes through a balltask.ball.VirtualBall, the ball the SHAM branch of the
+    task counts hits with. Volumes with a missing CEN or DMN value leave the ball where it is.
+
+    Parameters
+    ----------
+    cen, dmn : np.ndarray
+        Per-volume activations for the feedback period
+    params : dict
+        Output of load_run_parameters()
+    top_target, bottom_target : float
+        CEN and DMN target circle centers
+
+    Returns
+    -------
+    dict with per-volume ball_positions, list of hits (volume_index, 'CEN'/'DMN', ball_y, frame),
+    and cen_hits/dmn_hits counts
+    """
+    cen = np.asarray(cen, dtype=float)
+    dmn = np.asarray(dmn, dtype=float)
+
+    tr_to_frame_ratio = params['tr'] * params['frame_rate']
+    # the task moves the ball with int(scale_factor)
+    virtual_ball = VirtualBall(tr_to_frame_ratio, int(params['scale_factor']))
+
+    # same test as is_pda_outlier, for every volume at once
+    with np.errstate(invalid='ignore'):
+        outliers = np.maximum(np.abs(cen), np.abs(dmn)) > params['pda_outlier_threshold']
+    ball_positions, hits = virtual_ball.replay(cen, dmn, outliers, top_target, bottom_target)
+
+    return {'ball_positions': ball_positions,
+            'hits': hits,
+            'cen_hits': virtual_ball.cen_hits,
+            'dmn_hits': virtual_ball.dmn_hits,
+            'num_frames_per_tr': int(tr_to_frame_ratio),
+            'tr_to_frame_ratio': tr_to_frame_ratio}
+
+
+def _targets(df_fb):
+    if 'top_circle_y_position' in df_fb.columns and 'bottom_circle_y_position' in df_fb.columns:
+        return df_fb['top_circle_y_position'].iloc[0], df_fb['bottom_circle_y_position'].iloc[0]
+    return 0.33, -0.33
+
+
+def summarize_run(participant_id, run_number, df):
+    """Simulate one run and return a one-row summary (used by batch mode)"""
+    df_fb = df[df['stage'] == 'feedback']
+    params = load_run_parameters(participant_id, run_number, df)
+    top_target, bottom_target = _targets(df_fb)
+    sim = simulate_virtual_ball(df_fb['cen'].to_numpy(), df_fb['dmn'].to_numpy(), params, top_target, bottom_target)
+    pda = df_fb['cen'] - df_fb['dmn']
+    outliers = (np.abs(df_fb['cen']) > params['pda_outlier_threshold']) | (np.abs(df_fb['dmn']) > params['pda_outlier_threshold'])
+    return {
+        'participant': participant_id,
+        'run': run_number,
+        'feedback_volumes': len(df_fb),
+        'scale_factor': params['scale_factor'],
+        'tr': params['tr'],
+        'frame_rate': params['frame_rate'],
+        'pda_outlier_threshold': params['pda_outlier_threshold'],
+        'recorded_cen_hits': df_fb['cen_cumulative_hits'].max(),
+        'recorded_dmn_hits': df_fb['dmn_cumulative_hits'].max(),
+        'virtual_cen_hits': sim['cen_hits'],
+        'virtual_dmn_hits': sim['dmn_hits'],
+        'mean_pda': pda.mean(),
+        'outlier_volumes': int(outliers.sum()),
+        'max_ball_y': sim['ball_positions'].max() if len(df_fb) else np.nan,
+        'min_ball_y': sim['ball_positions'].min() if len(df_fb) else np.nan,
+        'parameter_source': params['source'],
+    }
+
+
 def diagnose_sham_virtual_hits(participant_id, run_number):
     """Diagnose why SHAM isn't getting virtual hits"""
     
@@ -32,98 +160,48 @@ def diagnose_sham_virtual_hits(participant_id, run_number):
     
     print(f"Total volumes: {len(df)}")
     print(f"Feedback volumes: {len(df_fb)}")
-    print(f"\nBrain Activity Statistics:")
+    print("\nBrain Activity Statistics:")
     print(f"  CEN - Mean: {df_fb['cen'].mean():.4f}, Std: {df_fb['cen'].std():.4f}, Min: {df_fb['cen'].min():.4f}, Max: {df_fb['cen'].max():.4f}")
     print(f"  DMN - Mean: {df_fb['dmn'].mean():.4f}, Std: {df_fb['dmn'].std():.4f}, Min: {df_fb['dmn'].min():.4f}, Max: {df_fb['dmn'].max():.4f}")
     
     # Check current hit counts
-    print(f"\nRecorded Hit Counts:")
+    print("\nRecorded Hit Counts:")
     print(f"  CEN hits: {df_fb['cen_cumulative_hits'].max()}")
     print(f"  DMN hits: {df_fb['dmn_cumulative_hits'].max()}")
     
-    # Simulate virtual ball movement
-    scale_factor = 10
-    internal_scaler = 10
-    tr = 1.2
-    frame_rate = 60.0
-    tr_to_frame_ratio = tr / (1.0 / frame_rate)
-    pda_outlier_threshold = 2
-    positions = [1, -1]  # CEN=1, DMN=-1
+    # Parameters this run was collected with
+    params = load_run_parameters(participant_id, run_number, df)
+    pda_outlier_threshold = params['pda_outlier_threshold']
     
     # Get target positions
-    if 'top_circle_y_position' in df_fb.columns and 'bottom_circle_y_position' in df_fb.columns:
-        top_target = df_fb['top_circle_y_position'].iloc[0]
-        bottom_target = df_fb['bottom_circle_y_position'].iloc[0]
-    else:
-        top_target = 0.33
-        bottom_target = -0.33
+    top_target, bottom_target = _targets(df_fb)
     
-    print(f"\nTarget Positions:")
+    print("\nTarget Positions:")
     print(f"  CEN (top): {top_target:.4f}")
     print(f"  DMN (bottom): {bottom_target:.4f}")
-    print(f"\nSimulating Virtual Ball Movement...")
-    print(f"  Scale factor: {scale_factor}")
-    print(f"  Internal scaler: {internal_scaler}")
-    print(f"  TR to frame ratio: {tr_to_frame_ratio:.2f}")
+    print("\nSimulating Virtual Ball Movement...")
+    print(f"  Parameters from: {params['source']}")
+    print(f"  Scale factor: {params['scale_factor']}")
+    print(f"  Internal scaler: {INTERNAL_SCALER}")
+    print(f"  TR: {params['tr']:.3f}s, frame rate: {params['frame_rate']:.2f}Hz")
+    print(f"  TR to frame ratio: {params['tr'] * params['frame_rate']:.2f}")
     
     # Simulate
-    virtual_cen_hits = 0
-    virtual_dmn_hits = 0
-    virtual_ball_y = 0.0
+    sim = simulate_virtual_ball(df_fb['cen'].to_numpy(), df_fb['dmn'].to_numpy(), params, top_target, bottom_target)
+    virtual_cen_hits = sim['cen_hits']
+    virtual_dmn_hits = sim['dmn_hits']
+    ball_positions = sim['ball_positions']
     
-    ball_positions = []
+    volumes = df_fb['volume'].to_numpy()
     hit_volumes = []
-    
-    for idx, row in df_fb.iterrows():
-        cen_val = row['cen']
-        dmn_val = row['dmn']
-        volume = row['volume']
-        
-        if pd.isna(cen_val) or pd.isna(dmn_val):
-            ball_positions.append(virtual_ball_y)
-            continue
-        
-        roi_activities = [cen_val, dmn_val]
-        
-        # Check for outlier
-        if np.max(np.abs(roi_activities)) > pda_outlier_threshold:
-            pda_outlier = True
-        else:
-            pda_outlier = False
-        
-        # Calculate virtual ball movement
-        if not pda_outlier and np.mean(roi_activities) != 0:
-            max_roi_idx = roi_activities.index(np.max(roi_activities))
-            activity = abs(np.max(roi_activities) - np.min(roi_activities)) / 10
-            direction = positions[max_roi_idx]
-            
-            # Calculate movement per frame (matching REAL mode exactly)
-            cursor_position = direction * activity
-            num_frames_per_tr = int(tr_to_frame_ratio)
-            delta_per_frame = (cursor_position * (scale_factor/internal_scaler) / tr_to_frame_ratio)
-            
-            # Simulate frame-by-frame updates within this TR
-            for frame_idx in range(num_frames_per_tr):
-                virtual_ball_y += delta_per_frame
-                
-                # Check for hits after each simulated frame
-                if virtual_ball_y > top_target:
-                    virtual_cen_hits += 1
-                    hit_volumes.append((volume, 'CEN', virtual_ball_y))
-                    print(f"  Volume {volume}: VIRTUAL CEN HIT (ball_y={virtual_ball_y:.4f}, frame={frame_idx}/{num_frames_per_tr}, CEN={cen_val:.4f}, DMN={dmn_val:.4f})")
-                    virtual_ball_y = 0.0
-                    break
-                elif virtual_ball_y < bottom_target:
-                    virtual_dmn_hits += 1
-                    hit_volumes.append((volume, 'DMN', virtual_ball_y))
-                    print(f"  Volume {volume}: VIRTUAL DMN HIT (ball_y={virtual_ball_y:.4f}, frame={frame_idx}/{num_frames_per_tr}, CEN={cen_val:.4f}, DMN={dmn_val:.4f})")
-                    virtual_ball_y = 0.0
-                    break
-        
-        ball_positions.append(virtual_ball_y)
+    for volume_idx, hit_type, ball_y, frame_idx in sim['hits']:
+        volume = volumes[volume_idx]
+        hit_volumes.append((volume, hit_type, ball_y))
+        print(f"  Volume {volume}: VIRTUAL {hit_type} HIT (ball_y={ball_y:.4f}, frame={frame_idx}/{sim['num_frames_per_tr']}, "
+              f"CEN={df_fb['cen'].iloc[volume_idx]:.4f}, DMN={df_fb['dmn'].iloc[volume_idx]:.4f})")
     
     print(f"\n{'='*70}")
-    print(f"SIMULATION RESULTS:")
+    print("SIMULATION RESULTS:")
     print(f"  Virtual CEN hits: {virtual_cen_hits}")
     print(f"  Virtual DMN hits: {virtual_dmn_hits}")
     print(f"  Total virtual hits: {virtual_cen_hits + virtual_dmn_hits}")
@@ -149,6 +227,7 @@ def diagnose_sham_virtual_hits(participant_id, run_number):
     print(f"  Distance from DMN target: {abs(min_ball_y - bottom_target):.4f}")
     
     # Create visualization
+    import matplotlib.pyplot as plt
     fig, axes = plt.subplots(3, 1, figsize=(14, 10))
     
     # Plot 1: Virtual ball position over time
@@ -198,14 +277,56 @@ def diagnose_sham_virtual_hits(participant_id, run_number):
     return virtual_cen_hits, virtual_dmn_hits
 
 
+def diagnose_batch(participants=None, output_file='sham_hits_summary.csv', max_workers=None):
+    """
+    Simulate virtual hits for every feedback run of many participants and write a summary csv
+
+    Parameters
+    ----------
+    participants : list or None
+        Participant IDs to include (default: every participant in data/)
+    output_file : str
+        Summary csv filename
+    max_workers : int or None
+        Threads used to load csv files
+    """
+    index = BalltaskDataIndex('.')
+    if not participants:
+        participants = index.participants()
+    requests = [(str(pid), run, 'roi_outputs') for pid in participants for run in index.runs(pid)]
+    print(f"Simulating {len(requests)} feedback runs from {len(participants)} participants")
+
+    loaded = index.load_many(requests, max_workers=max_workers)
+    rows = [summarize_run(pid, run, df) for (pid, run, _), df in loaded.items() if df is not None]
+    summary = pd.DataFrame(rows)
+    summary.to_csv(output_file, index=False)
+
+    print(f"Summary saved as: {output_file}")
+    if not summary.empty:
+        print(summary[['participant', 'run', 'recorded_cen_hits', 'recorded_dmn_hits',
+                       'virtual_cen_hits', 'virtual_dmn_hits', 'outlier_volumes']].to_string(index=False))
+    return summary
+
+
 def main():
     parser = argparse.ArgumentParser(description='Diagnose SHAM virtual hits')
-    parser.add_argument('--participant', type=int, required=True, help='Participant ID (e.g., 2099)')
+    parser.add_argument('--participant', type=int, help='Participant ID (e.g., 2099)')
     parser.add_argument('--run', type=int, default=1, help='Run number (default: 1)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Simulate every feedback run and write a summary csv instead of plotting one run')
+    parser.add_argument('--participants', type=int, nargs='*',
+                        help='Participants to include in batch mode (default: all in data/)')
+    parser.add_argument('--output', type=str, default='sham_hits_summary.csv',
+                        help='Batch summary filename (default: sham_hits_summary.csv)')
     
     args = parser.parse_args()
     
-    diagnose_sham_virtual_hits(args.participant, args.run)
+    if args.batch:
+        diagnose_batch(args.participants, args.output)
+    elif args.participant is None:
+        parser.error('--participant is required unless --batch is given')
+    else:
+        diagnose_sham_virtual_hits(args.participant, args.run)
 
 
 if __name__ == '__main__':
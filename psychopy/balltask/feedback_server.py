@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Feedback server: several ROI activation sources and several displays in one process
+
+Every session has one source of [CEN, DMN] activations:
+    murfi   a MURFI info server (host:port), asked with the same roi-weightedave query as
+            MurfiActivationCommunicator
+    sham    a stored run's roi_outputs csv, replayed with its recorded timing once the first
+            display subscribes (mock sessions, staff training)
+    fake    random activations every TR (testing without a scanner)
+
+Displays connect to the server's local TCP port, subscribe to a session and receive its
+volumes as newline-delimited JSON. RemoteActivationCommunicator is the display side; it has
+the MurfiActivationCommunicator interface (update / get_roi_activation), so the ball task
+uses it unchanged (see SiteProfile.feedback_server).
+
+Sessions are isolated: each has its own source task, volume buffer and subscriber queues,
+so a failing MURFI connection or a display that stops reading only affects its own session.
+A {"op": "metrics"} request returns per-session counters.
+
+Only the standard library is used.
+
+Usage (from the ball task folder):
+    python feedback_server.py --listen 127.0.0.1:15100 \
+        --session scanner1 murfi 192.168.2.5:15001 \
+        --session scanner2 murfi 192.168.3.5:15001 \
+        --session training sham data/sub-mindbpd2098/sub-mindbpd2098_DMN_feedback_1_roi_outputs.csv
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import random
+import re
+import socket
+import sys
+import time
+
+DEFAULT_LISTEN = '127.0.0.1:15100'
+ROI_NAMES = ('cen', 'dmn')
+NUM_TRS = 210
+TR = 1.2
+
+ROI_QUERY = ('<?xml version="1.0" encoding="UTF-8"?>'
+             '<info>'
+             '<get dataid=":*:*:*:__TR__:*:*:roi-weightedave:__ROI__:"></get>'
+             '</info>\n')
+
+MURFI_TIMEOUT = 2.0  # seconds to wait for a MURFI answer
+POLL_INTERVAL = 0.02  # polling interval once the next volume is due
+ARRIVAL_MARGIN = 0.2  # start polling this long before a TR has passed since the last volume
+RETRY_INTERVAL = 1.0  # wait after a MURFI connection error
+MAX_BACKLOG = 1000  # messages queued for a display before it is disconnected as too slow
+
+
+def parse_address(address):
+    """'host:port' -> (host, port)"""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def encode(message):
+    return (json.dumps(message) + '\n').encode()
+
+
+def parse_activation(response):
+    """Activation in a MURFI response (nan if the volume is not there yet)"""
+    try:
+        return float(re.sub(rb'<.*?>', b'', response))
+    except ValueError:
+        return float('nan')
+
+
+class Session:
+    """
+    One source of activations and the displays subscribed to it
+
+    Parameters
+    ----------
+    name : str
+    source : tuple
+        ('murfi', 'host:port'), ('sham', roi_outputs_csv) or ('fake',)
+    """
+
+    def __init__(self, name, source, roi_names=ROI_NAMES, num_trs=NUM_TRS, tr=TR):
+        self.name = name
+        self.source = source
+        self.roi_names = list(roi_names)
+        self.num_trs = num_trs
+        self.tr = tr
+        self.volumes = []
+        self.subscribers = set()
+        self.first_subscriber = asyncio.Event()
+        self.metrics = {'source': source[0], 'volumes': 0, 'source_queries': 0, 'source_errors': 0,
+                        'source_query_time_mean': 0.0, 'last_volume_age': None, 'displays': 0,
+                        'messages_sent': 0, 'displays_dropped': 0}
+        self._last_volume_time = None
+
+    def publish(self, activations):
+        """Store a new volume ({roi: activation}) and queue it for every subscribed display"""
+        volume = len(self.volumes)
+        self.volumes.append(activations)
+        self._last_volume_time = time.time()
+        self.metrics['volumes'] += 1
+        message = encode({'type': 'volume', 'session': self.name, 'volume': volume, 'rois': activations})
+        for queue in list(self.subscribers):
+            self._queue(queue, message)
+
+    def _queue(self, queue, message):
+        if queue.qsize() >= MAX_BACKLOG:
+            # this display stopped reading: drop it instead of buffering for it forever
+            self.unsubscribe(queue)
+            self.metrics['displays_dropped'] += 1
+            queue.put_nowait(None)
+            return
+        queue.put_nowait(message)
+
+    def subscribe(self, since=0):
+        """Queue with the volumes from `since` on, then every new one (None ends the subscription)"""
+        queue = asyncio.Queue()
+        for volume, activations in enumerate(self.volumes[since:], start=since):
+            queue.put_nowait(encode({'type': 'volume', 'session': self.name, 'volume': volume, 'rois': activations}))
+        self.subscribers.add(queue)
+        self.metrics['displays'] = len(self.subscribers)
+        self.first_subscriber.set()
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        self.metrics['displays'] = len(self.subscribers)
+
+    def snapshot(self):
+        """Metrics of the session (for the metrics request)"""
+        metrics = dict(self.metrics)
+        if self._last_volume_time is not None:
+            metrics['last_volume_age'] = round(time.time() - self._last_volume_time, 3)
+        return metrics
+
+    async def run(self):
+        kind = self.source[0]
+        if kind == 'murfi':
+            await self._murfi_source(*parse_address(self.source[1]))
+        elif kind == 'sham':
+            await self._sham_source(self.source[1])
+        elif kind == 'fake':
+            await self._fake_source()
+        else:
+            raise ValueError(f'unknown source {kind} for session {self.name}')
+
+    async def _query_murfi(self, host, port, roi_name, volume):
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), MURFI_TIMEOUT)
+        try:
+            query = ROI_QUERY.replace('__TR__', str(volume + 1)).replace('__ROI__', roi_name)
+            writer.write(query.encode('utf-8'))
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(4096), MURFI_TIMEOUT)
+        finally:
+            writer.close()
+        queries = self.metrics['source_queries'] = self.metrics['source_queries'] + 1
+        mean = self.metrics['source_query_time_mean']
+        self.metrics['source_query_time_mean'] = mean + (time.perf_counter() - started - mean) / queries
+        return parse_activation(response)
+
+    async def _murfi_source(self, host, port):
+        """Ask MURFI for the next volume; sleep most of the TR after each volume unless MURFI is behind"""
+        loop = asyncio.get_running_loop()
+        last_arrival = -float('inf')
+        answering = True  # only changes are printed, source_errors counts every failed query
+        while len(self.volumes) < self.num_trs:
+            volume = len(self.volumes)
+            try:
+                values = [await self._query_murfi(host, port, roi_name, volume) for roi_name in self.roi_names]
+            except (OSError, asyncio.TimeoutError) as e:
+                self.metrics['source_errors'] += 1
+                if answering:
+                    print(f'{self.name}: MURFI at {host}:{port} not answering ({e!r})')
+                    answering = False
+                await asyncio.sleep(RETRY_INTERVAL)
+                continue
+            if not answering:
+                print(f'{self.name}: MURFI at {host}:{port} answering again')
+                answering = True
+            if all(value == value for value in values):
+                self.publish(dict(zip(self.roi_names, values)))
+                last_arrival = loop.time()
+                continue  # MURFI may already have the next one (e.g. after a reconnect)
+            due_in = last_arrival + self.tr - ARRIVAL_MARGIN - loop.time()
+            await asyncio.sleep(max(due_in, POLL_INTERVAL))
+
+    async def _sham_source(self, path):
+        """Replay a stored roi_outputs csv with its recorded timing, starting with the first display"""
+        with open(path, newline='') as f:
+            rows = [(float(row['time']), {roi_name: float(row[roi_name]) for roi_name in self.roi_names})
+                    for row in csv.DictReader(f)]
+        await self.first_subscriber.wait()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for row_time, activations in rows:
+            await asyncio.sleep(max(0.0, start + row_time - rows[0][0] - loop.time()))
+            self.publish(activations)
+
+    async def _fake_source(self):
+        while len(self.volumes) < self.num_trs:
+            await asyncio.sleep(self.tr)
+            self.publish({roi_name: random.gauss(0, 1) for roi_name in self.roi_names})
+
+
+class FeedbackServer:
+    """
+    Serves the sessions' volumes to displays over newline-delimited JSON
+
+    Requests (one JSON object per line):
+        {"op": "subscribe", "session": NAME, "since": 0}   stream the session's volumes
+        {"op": "sessions"}                                 names and sources of the sessions
+        {"op": "metrics"}                                  per-session counters
+    """
+
+    def __init__(self, sessions):
+        self.sessions = {session.name: session for session in sessions}
+        self.connections = 0
+
+    async def _send(self, writer, session, queue):
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            writer.write(message)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                # the display went away; handle_client cleans up the rest when its read fails
+                session.unsubscribe(queue)
+                break
+            session.metrics['messages_sent'] += 1
+
+    async def handle_client(self, reader, writer):
+        self.connections += 1
+        subscriptions = []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request['op']
+                except (ValueError, KeyError, TypeError):
+                    writer.write(encode({'type': 'error', 'message': f'bad request: {line[:100]!r}'}))
+                    continue
+                if op == 'subscribe':
+                    session = self.sessions.get(request.get('session'))
+                    if session is None:
+                        writer.write(encode({'type': 'error', 'message': f"no session {request.get('session')}"}))
+                        continue
+                    queue = session.subscribe(int(request.get('since', 0)))
+                    subscriptions.append((session, queue, asyncio.create_task(self._send(writer, session, queue))))
+                elif op == 'sessions':
+                    writer.write(encode({'type': 'sessions',
+                                         'sessions': {name: list(s.source) for name, s in self.sessions.items()}}))
+                elif op == 'metrics':
+                    writer.write(encode({'type': 'metrics', 'connections': self.connections,
+                                         'sessions': {name: s.snapshot() for name, s in self.sessions.items()}}))
+                else:
+                    writer.write(encode({'type': 'error', 'message': f'unknown op {op}'}))
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            for session, queue, task in subscriptions:
+                session.unsubscribe(queue)
+                task.cancel()
+            writer.close()
+
+    async def _run_session(self, session):
+        try:
+            await session.run()
+        except Exception as e:
+            session.metrics['source_errors'] += 1
+            print(f'{session.name}: source stopped: {e!r}')
+
+    async def serve(self, host, port):
+        for session in self.sessions.values():
+            asyncio.create_task(self._run_session(session))
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f"+ feedback server on {host}:{port}, sessions: {', '.join(self.sessions)}")
+        async with server:
+            await server.serve_forever()
+
+
+class RemoteActivationCommunicator:
+    """
+    MurfiActivationCommunicator interface on top of a feedback server session
+
+    update() reads whatever volumes have arrived without blocking; get_roi_activation()
+    returns nan for volumes that have not.
+
+    Parameters
+    ----------
+    address : str
+        'host:port' of the feedback server
+    session : str
+        Session to subscribe to
+    """
+
+    def __init__(self, address, session, num_trs, roi_names, timeout=5.0):
+        self._num_trs = num_trs
+        self._rois = {roi_name: {'last_tr': -1, 'activation': [float('nan')] * num_trs} for roi_name in roi_names}
+        self._sock = socket.create_connection(parse_address(address), timeout)
+        self._sock.sendall(encode({'op': 'subscribe', 'session': session}))
+        self._sock.setblocking(False)
+        self._buffer = b''
+
+    def update(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except BlockingIOError:
+                break
+            if not data:
+                raise ConnectionError('feedback server closed the connection')
+            self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            message = json.loads(line)
+            if message['type'] == 'error':
+                raise RuntimeError(f"feedback server: {message['message']}")
+            if message['type'] != 'volume' or message['volume'] >= self._num_trs:
+                continue
+            volume = message['volume']
+            for roi_name, roi in self._rois.items():
+                roi['activation'][volume] = message['rois'][roi_name]
+                roi['last_tr'] = max(roi['last_tr'], volume)
+
+    def get_roi_activation(self, roi_name, tr=None):
+        if roi_name not in self._rois:
+            raise ValueError("No such roi %s" % roi_name)
+        if tr is None:
+            tr = self._rois[roi_name]['last_tr']
+        if tr < 0 or tr >= self._num_trs:
+            raise ValueError("Requested TR out of bounds (tr=%s" % tr)
+        return self._rois[roi_name]['activation'][tr]
+
+    def close(self):
+        self._sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve ROI activations of several MURFI/sham sessions to displays')
+    parser.add_argument('--listen', default=DEFAULT_LISTEN, help=f'host:port to listen on (default: {DEFAULT_LISTEN})')
+    parser.add_argument('--session', nargs='+', action='append', required=True,
+                        metavar='NAME KIND [SOURCE]',
+                        help='NAME murfi HOST:PORT, NAME sham ROI_OUTPUTS_CSV or NAME fake')
+    parser.add_argument('--rois', nargs='+', default=list(ROI_NAMES), help='ROI names (default: cen dmn)')
+    parser.add_argument('--num-trs', type=int, default=NUM_TRS, help=f'Volumes per session (default: {NUM_TRS})')
+    parser.add_argument('--tr', type=float, default=TR, help=f'Repetition time (default: {TR})')
+    args = parser.parse_args()
+
+    sessions = []
+    for spec in args.session:
+        if len(spec) < 2 or spec[1] not in ('murfi', 'sham', 'fake') or len(spec) != (2 if spec[1] == 'fake' else 3):
+            parser.error(f"bad --session {' '.join(spec)} (NAME murfi HOST:PORT, NAME sham CSV or NAME fake)")
+        sessions.append(Session(spec[0], tuple(spec[1:]), args.rois, args.num_trs, args.tr))
+
+    try:
+        asyncio.run(FeedbackServer(sessions).serve(*parse_address(args.listen)))
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,12 @@ Usage:
     python compare_real_sham_visualization.py --real 2098 --sham 2099 --run 1
 """
 
-import pandas as pd
 import matplotlib.pyplot as plt
-import numpy as np
 import argparse
-import os
-from pathlib import Path
+from balltask_data_loader import BalltaskDataIndex
+
+# Built on first use by load_participant_data
+_data_index = None
 
 def load_participant_data(participant_id, run_number, data_type='roi_outputs'):
     """
@@ -31,34 +31,11 @@ def load_participant_data(participant_id, run_number, data_type='roi_outputs'):
     --------
     pd.DataFrame or None if file not found
     """
-    participant_id = str(participant_id)
-    
-    # Try multiple possible locations
-    possible_paths = [
-        f'data/sub-mindbpd{participant_id}/sub-mindbpd{participant_id}_DMN_feedback_{run_number}_{data_type}.csv',
-        f'data/sub-mindbpd{participant_id}/sub-mindbpd{participant_id}_DMN_nofeedback_{run_number}_{data_type}.csv',
-        f'feedback/sub-mindbpd{participant_id}/sub-mindbpd{participant_id}_DMN_feedback_{run_number}_{data_type}.csv',
-    ]
-    
-    for path in possible_paths:
-        if os.path.exists(path):
-            try:
-                print(f"Loading: {path}")
-                df = pd.read_csv(path)
-                # Check if dataframe is empty
-                if df.empty or len(df.columns) == 0:
-                    print(f"Warning: File exists but is empty: {path}")
-                    continue
-                return df
-            except pd.errors.EmptyDataError:
-                print(f"Warning: File is empty or malformed: {path}")
-                continue
-            except Exception as e:
-                print(f"Warning: Error reading {path}: {e}")
-                continue
-    
-    print(f"Warning: Could not find valid {data_type} file for participant {participant_id}, run {run_number}")
-    return None
+    # data/ and feedback/ are indexed once per process, parsed runs come from the .npz cache when up to date
+    global _data_index
+    if _data_index is None:
+        _data_index = BalltaskDataIndex('.')
+    return _data_index.load(participant_id, run_number, data_type)
 
 
 def create_comparison_figure(real_id, sham_id, run_number, output_file='real_vs_sham_comparison.png'):
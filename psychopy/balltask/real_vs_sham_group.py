@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Group-level comparison of REAL vs SHAM participants across all matched pairs
+
+Builds every matched REAL/SHAM pair from the randomization list, loads every
+feedback run both participants completed (in parallel, via the cached loader),
+stacks the runs into volume-aligned arrays and computes per pair/run metrics in
+one vectorized pass:
+    - hits and hit rate (hits per minute of feedback) for REAL and SHAM (virtual)
+    - correlation between REAL and SHAM PDA (CEN - DMN) time courses
+    - time-lagged cross-correlation of the ball everyone SAW (REAL's ball)
+      against each participant's own PDA
+
+Writes a summary table (csv) and a summary figure.
+
+Usage:
+    python real_vs_sham_group.py
+    python real_vs_sham_group.py --randlist feedback/mgh_randlist.txt --site-offset 2000 --max-lag 5
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+from balltask_data_loader import BalltaskDataIndex
+
+
+def load_matched_pairs(randlist_file='feedback/mgh_randlist.txt', site_offset=2000):
+    """
+    Build (real_id, sham_id) pairs from the randomization list
+
+    The list has 3 tab-separated columns: subject number, R/S, and a code (e.g. R4 / S4).
+    A SHAM participant with code S4 is yoked to the REAL participant with code R4.
+
+    Parameters
+    ----------
+    randlist_file : str
+        Path to the randomization list
+    site_offset : int
+        Added to the subject number to get the participant ID (MGH is 2000s, Yale is 1000s)
+
+    Returns
+    -------
+    list of (str, str) tuples
+    """
+    rand_list = pd.read_csv(randlist_file, delimiter='\t', header=None, dtype=str)
+    rand_list[0] = rand_list[0].str.strip()
+    rand_list[2] = rand_list[2].str.strip()
+    sub_by_code = dict(zip(rand_list[2], rand_list[0]))
+
+    pairs = []
+    for sub_num, code in zip(rand_list[0], rand_list[2]):
+        if not code.startswith('S'):
+            continue
+        real_sub_num = sub_by_code.get(code.replace('S', 'R'))
+        if real_sub_num is None:
+            continue
+        pairs.append((str(site_offset + int(real_sub_num)), str(site_offset + int(sub_num))))
+    return pairs
+
+
+def _stack_by_volume(frames, column, n_volumes):
+    """Stack a column of each run into an (n_runs, n_volumes) array indexed by volume number, NaN padded"""
+    stacked = np.full((len(frames), n_volumes), np.nan)
+    for row, df in enumerate(frames):
+        stacked[row, df['volume'].to_numpy()] = df[column].to_numpy(dtype=float)
+    return stacked
+
+
+def _rowwise_corr(x, y):
+    """Pearson correlation of each row of x with the same row of y, ignoring NaNs"""
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=1)
+    x = np.where(valid, x, 0.0)
+    y = np.where(valid, y, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_dm = np.where(valid, x - x.sum(axis=1, keepdims=True) / n[:, None], 0.0)
+        y_dm = np.where(valid, y - y.sum(axis=1, keepdims=True) / n[:, None], 0.0)
+        r = (x_dm * y_dm).sum(axis=1) / np.sqrt((x_dm ** 2).sum(axis=1) * (y_dm ** 2).sum(axis=1))
+    r[n < 3] = np.nan
+    return r
+
+
+def _lagged_corr(seen, brain, max_lag):
+    """
+    Time-lagged cross-correlation for every row at lags -max_lag..max_lag (in volumes)
+
+    A positive lag correlates the brain signal with the ball position that many volumes EARLIER
+    (i.e. the brain following what was seen).
+
+    Returns
+    -------
+    np.ndarray of shape (n_rows, 2*max_lag+1)
+    """
+    n_volumes = seen.shape[1]
+    lags = np.arange(-max_lag, max_lag + 1)
+    out = np.full((seen.shape[0], len(lags)), np.nan)
+    for j, lag in enumerate(lags):
+        if lag >= 0:
+            out[:, j] = _rowwise_corr(seen[:, :n_volumes - lag], brain[:, lag:])
+        else:
+            out[:, j] = _rowwise_corr(seen[:, -lag:], brain[:, :n_volumes + lag])
+    return out
+
+
+def compute_group_metrics(index, pairs, max_lag=5, max_workers=None):
+    """
+    Load every matched pair/run and compute the per pair/run metrics
+
+    Parameters
+    ----------
+    index : BalltaskDataIndex
+        Index of the balltask data/ and feedback/ trees
+    pairs : list of (real_id, sham_id)
+        Matched pairs, e.g. from load_matched_pairs()
+    max_lag : int
+        Largest lag (in volumes) for the time-lagged cross-correlations
+    max_workers : int or None
+        Threads used to load csv files
+
+    Returns
+    -------
+    (pd.DataFrame of metrics with one row per pair/run, np.ndarray of lags,
+     np.ndarray of REAL lagged correlations, np.ndarray of SHAM lagged correlations)
+    """
+    pair_runs = [(real_id, sham_id, run)
+                 for real_id, sham_id in pairs
+                 for run in sorted(set(index.runs(real_id)) & set(index.runs(sham_id)))]
+    if not pair_runs:
+        raise ValueError('No runs found for any matched REAL/SHAM pair')
+
+    requests = [(pid, run, 'roi_outputs') for real_id, sham_id, run in pair_runs for pid in (real_id, sham_id)]
+    loaded = index.load_many(requests, max_workers=max_workers)
+
+    rows, real_frames, sham_frames = [], [], []
+    for real_id, sham_id, run in pair_runs:
+        real_df = loaded[(real_id, run, 'roi_outputs')]
+        sham_df = loaded[(sham_id, run, 'roi_outputs')]
+        if real_df is None or sham_df is None:
+            continue
+        real_frames.append(real_df[real_df['stage'] == 'feedback'])
+        sham_frames.append(sham_df[sham_df['stage'] == 'feedback'])
+        rows.append({'real_id': real_id, 'sham_id': sham_id, 'run': run})
+    if not rows:
+        raise ValueError(f'No runs loaded: none of the roi_outputs files of the {len(pair_runs)} matched '
+                         f'pair/runs could be read')
+
+    metrics = pd.DataFrame(rows)
+    n_volumes = 1 + max(int(df['volume'].max()) for df in real_frames + sham_frames)
+
+    # (n_pair_runs, n_volumes) arrays, aligned on volume number
+    stacked = {}
+    for who, frames in (('real', real_frames), ('sham', sham_frames)):
+        for column in ('cen', 'dmn', 'cen_cumulative_hits', 'dmn_cumulative_hits', 'ball_y_position', 'time'):
+            stacked[who, column] = _stack_by_volume(frames, column, n_volumes)
+
+    # Ball that BOTH participants saw -- SHAM is yoked to REAL's display
+    seen_ball = stacked['real', 'ball_y_position']
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    lagged = {}
+    for who in ('real', 'sham'):
+        cen_hits = np.nanmax(stacked[who, 'cen_cumulative_hits'], axis=1)
+        dmn_hits = np.nanmax(stacked[who, 'dmn_cumulative_hits'], axis=1)
+        n_feedback = np.sum(~np.isnan(stacked[who, 'cen']), axis=1)
+        tr = np.nanmedian(np.diff(stacked[who, 'time'], axis=1), axis=1)
+        feedback_minutes = n_feedback * tr / 60.0
+        pda = stacked[who, 'cen'] - stacked[who, 'dmn']
+
+        metrics[f'{who}_volumes'] = n_feedback
+        metrics[f'{who}_cen_hits'] = cen_hits
+        metrics[f'{who}_dmn_hits'] = dmn_hits
+        metrics[f'{who}_total_hits'] = cen_hits + dmn_hits
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics[f'{who}_hits_per_min'] = (cen_hits + dmn_hits) / feedback_minutes
+            metrics[f'{who}_cen_hit_fraction'] = cen_hits / (cen_hits + dmn_hits)
+        metrics[f'{who}_mean_pda'] = np.nanmean(pda, axis=1)
+
+        lagged[who] = _lagged_corr(seen_ball, pda, max_lag)
+        peak = np.nanargmax(np.where(np.isnan(lagged[who]), -np.inf, np.abs(lagged[who])), axis=1)
+        metrics[f'{who}_ball_pda_r_lag0'] = lagged[who][:, max_lag]
+        metrics[f'{who}_ball_pda_peak_lag'] = lags[peak]
+        metrics[f'{who}_ball_pda_peak_r'] = lagged[who][np.arange(len(peak)), peak]
+
+    metrics['real_sham_pda_r'] = _rowwise_corr(stacked['real', 'cen'] - stacked['real', 'dmn'],
+                                               stacked['sham', 'cen'] - stacked['sham', 'dmn'])
+    return metrics, lags, lagged['real'], lagged['sham']
+
+
+def create_group_figure(metrics, lags, real_lagged, sham_lagged, output_file='real_vs_sham_group.png'):
+    """Summary figure: hits, hit rate per run, REAL-SHAM PDA correlation and ball-vs-brain cross-correlation"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    color_real = '#2E7D32'  # Green
+    color_sham = '#D32F2F'  # Red
+
+    fig, axes = plt.subplots(2, 2, figsize=(16, 12))
+
+    # Total hits REAL vs SHAM (virtual), one point per pair/run
+    ax = axes[0, 0]
+    lim = max(metrics['real_total_hits'].max(), metrics['sham_total_hits'].max()) + 1
+    ax.scatter(metrics['real_total_hits'], metrics['sham_total_hits'], color='purple', alpha=0.7)
+    ax.plot([0, lim], [0, lim], color='gray', linestyle='--', alpha=0.5)
+    ax.set_xlabel('REAL Total Hits', fontsize=12, fontweight='bold')
+    ax.set_ylabel('SHAM Total Hits (Virtual)', fontsize=12, fontweight='bold')
+    ax.set_title('Hits per Run (each point = 1 pair/run)', fontsize=13, fontweight='bold')
+    ax.grid(True, alpha=0.3)
+
+    # Hit rate by run number
+    ax = axes[0, 1]
+    by_run = metrics.groupby('run')[['real_hits_per_min', 'sham_hits_per_min']].agg(['mean', 'sem'])
+    ax.errorbar(by_run.index, by_run['real_hits_per_min']['mean'], yerr=by_run['real_hits_per_min']['sem'],
+                color=color_real, marker='o', linewidth=2, capsize=4, label='REAL')
+    ax.errorbar(by_run.index, by_run['sham_hits_per_min']['mean'], yerr=by_run['sham_hits_per_min']['sem'],
+                color=color_sham, marker='s', linewidth=2, capsize=4, label='SHAM (Virtual)')
+    ax.set_xlabel('Run', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Hits per Minute', fontsize=12, fontweight='bold')
+    ax.set_title('Hit Rate Across Runs (mean ± SEM)', fontsize=13, fontweight='bold')
+    ax.legend(loc='upper right', fontsize=10)
+    ax.grid(True, alpha=0.3)
+
+    # REAL vs SHAM PDA correlation
+    ax = axes[1, 0]
+    ax.hist(metrics['real_sham_pda_r'].dropna(), bins=20, color='purple', alpha=0.7)
+    ax.axvline(x=0, color='black', linestyle='-', alpha=0.5)
+    ax.set_xlabel('r (REAL PDA, SHAM PDA)', fontsize=12, fontweight='bold')
+    ax.set_ylabel('Pair/Runs', fontsize=12, fontweight='bold')
+    ax.set_title('Correlation of REAL and SHAM PDA Time Courses', fontsize=13, fontweight='bold')
+    ax.grid(True, alpha=0.3)
+
+    # Ball seen vs own brain
+    ax = axes[1, 1]
+    for lagged, color, label in ((real_lagged, color_real, 'REAL'), (sham_lagged, color_sham, 'SHAM')):
+        mean = np.nanmean(lagged, axis=0)
+        sem = np.nanstd(lagged, axis=0) / np.sqrt(np.sum(~np.isnan(lagged), axis=0))
+        ax.plot(lags, mean, color=color, linewidth=2, marker='o', label=label)
+        ax.fill_between(lags, mean - sem, mean + sem, color=color, alpha=0.2)
+    ax.axhline(y=0, color='black', linestyle='-', alpha=0.5)
+    ax.axvline(x=0, color='gray', linestyle='--', alpha=0.5)
+    ax.set_xlabel('Lag (volumes, + = brain follows ball)', fontsize=12, fontweight='bold')
+    ax.set_ylabel('r (ball seen, own PDA)', fontsize=12, fontweight='bold')
+    ax.set_title('Time-Lagged Cross-Correlation: Ball Seen vs Own Brain', fontsize=13, fontweight='bold')
+    ax.legend(loc='upper right', fontsize=10)
+    ax.grid(True, alpha=0.3)
+
+    fig.suptitle(f'REAL vs SHAM - {metrics[["real_id", "sham_id"]].drop_duplicates().shape[0]} pairs, '
+                 f'{len(metrics)} runs', fontsize=16, fontweight='bold')
+    plt.savefig(output_file, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return output_file
+
+
+def main():
+    """Main function to run from command line"""
+    parser = argparse.ArgumentParser(description='Group-level REAL vs SHAM comparison across all matched pairs')
+    parser.add_argument('--randlist', type=str, default='feedback/mgh_randlist.txt',
+                        help='Randomization list (default: feedback/mgh_randlist.txt)')
+    parser.add_argument('--site-offset', type=int, default=2000,
+                        help='Added to subject numbers to get participant IDs (default: 2000 for MGH, 1000 for Yale)')
+    parser.add_argument('--max-lag', type=int, default=5,
+                        help='Largest lag in volumes for ball vs brain cross-correlation (default: 5)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Threads used to load csv files (default: python default)')
+    parser.add_argument('--output', type=str, default='real_vs_sham_group',
+                        help='Output file stem for the .csv table and .png figure (default: real_vs_sham_group)')
+    args = parser.parse_args()
+
+    index = BalltaskDataIndex('.')
+    pairs = load_matched_pairs(args.randlist, args.site_offset)
+    print(f"Found {len(pairs)} matched REAL/SHAM pairs in {args.randlist}")
+
+    try:
+        metrics, lags, real_lagged, sham_lagged = compute_group_metrics(index, pairs, args.max_lag, args.workers)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    metrics.to_csv(args.output + '.csv', index=False)
+    print(f"Summary table saved as: {args.output}.csv ({len(metrics)} pair/runs)")
+
+    create_group_figure(metrics, lags, real_lagged, sham_lagged, args.output + '.png')
+    print(f"Figure saved as: {args.output}.png")
+
+    print("\nSUMMARY STATISTICS:")
+    print(metrics[['real_total_hits', 'sham_total_hits', 'real_hits_per_min', 'sham_hits_per_min',
+                   'real_sham_pda_r', 'real_ball_pda_r_lag0', 'sham_ball_pda_r_lag0']].describe().round(3))
+
+
+if __name__ == '__main__':
+    main()
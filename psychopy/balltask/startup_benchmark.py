@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measure how long the balltask entry scripts take to reach the participant dialog
+
+Each repeat runs the script in a fresh interpreter with BALLTASK_STARTUP_BENCHMARK set
+(the script prints timing markers and exits right before showing the dialog) and with
+`python -X importtime`, so the slowest imports can be listed.
+
+Usage:
+    python startup_benchmark.py
+    python startup_benchmark.py --script rt-network_feedback_yale.py --repeats 10 --top 25
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+# e.g. "import time:      1523 |      48211 |   pandas"
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S.*)$')
+BENCHMARK_PATTERN = re.compile(r'^BENCHMARK (\S+) ([\d.]+)$')
+
+
+def run_once(script, python=sys.executable):
+    """
+    Run the entry script once up to the dialog
+
+    Returns
+    -------
+    wall_time : float
+        Seconds from process start to exit
+    markers : dict
+        BENCHMARK markers printed by the script (seconds since its first line)
+    imports : list of (self_us, cumulative_us, depth, module)
+    """
+    env = dict(os.environ, BALLTASK_STARTUP_BENCHMARK='1')
+    script_dir = os.path.dirname(os.path.abspath(script))
+    start = time.perf_counter()
+    result = subprocess.run([python, '-X', 'importtime', os.path.abspath(script)],
+                            cwd=script_dir, env=env, capture_output=True, text=True)
+    wall_time = time.perf_counter() - start
+
+    if result.returncode != 0:
+        print(result.stdout)
+        print(result.stderr[-2000:])
+        raise RuntimeError(f'{script} exited with code {result.returncode}')
+
+    markers = {}
+    for line in result.stdout.splitlines():
+        match = BENCHMARK_PATTERN.match(line.strip())
+        if match:
+            markers[match.group(1)] = float(match.group(2))
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            depth = len(match.group(3)) // 2
+            imports.append((int(match.group(1)), int(match.group(2)), depth, match.group(4).strip()))
+    return wall_time, markers, imports
+
+
+def summarize_imports(imports, top=20):
+    """Top-level (depth 0) imports sorted by cumulative time"""
+    top_level = [entry for entry in imports if entry[2] == 0]
+    return sorted(top_level, key=lambda entry: entry[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark balltask startup time up to the participant dialog')
+    parser.add_argument('--script', default='rt-network_feedback_mgh.py',
+                        help='Entry script to benchmark (default: rt-network_feedback_mgh.py)')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of runs (default: 5)')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to list (default: 15)')
+    args = parser.parse_args()
+
+    print('=' * 60)
+    print(f'STARTUP BENCHMARK: {args.script} ({args.repeats} runs)')
+    print('=' * 60)
+
+    wall_times = []
+    marker_times = {}
+    imports = []
+    for i in range(args.repeats):
+        wall_time, markers, imports = run_once(args.script)
+        wall_times.append(wall_time)
+        for name, value in markers.items():
+            marker_times.setdefault(name, []).append(value)
+        print(f'  run {i + 1}: {wall_time:.3f} s')
+
+    print(f'\nProcess wall time: median {statistics.median(wall_times):.3f} s, '
+          f'min {min(wall_times):.3f} s, max {max(wall_times):.3f} s')
+    for name, values in marker_times.items():
+        print(f'  {name:<16} median {statistics.median(values):.3f} s after the first line of the script')
+
+    # import timings from the last run (the first one also pays for cold .pyc compilation)
+    print('\nSlowest top-level imports (last run):')
+    print(f'  {"cumulative (ms)":>16} {"self (ms)":>10}  module')
+    for self_us, cumulative_us, _, module in summarize_imports(imports, args.top):
+        print(f'  {cumulative_us / 1000:>16.1f} {self_us / 1000:>10.1f}  {module}')
+
+
+if __name__ == '__main__':
+    main()
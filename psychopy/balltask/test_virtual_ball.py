@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Checks of balltask.ball.VirtualBall.replay
+
+replay() must count the same hits as moving the ball frame by frame, one volume at a time,
+the way the SHAM branch of the task did, and must match the hits saved in the recorded SHAM
+runs (see check_virtual_ball.py).
+
+Usage (from the ball task folder):
+    python test_virtual_ball.py
+or
+    python -m pytest test_virtual_ball.py
+"""
+
+import os
+
+import numpy as np
+
+from balltask.ball import INTERNAL_SCALER, VirtualBall, is_pda_outlier, pda_direction
+from balltask.sites import SITE_PROFILES
+from balltask_data_loader import BalltaskDataIndex
+from check_virtual_ball import check_run, sham_participants
+
+TASK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def frame_by_frame(cen, dmn, threshold, tr_to_frame_ratio, scale_factor, top, bottom):
+    """Reference: the virtual ball moved one frame at a time, as the task originally did"""
+    y, hits, ball_y = 0.0, [], []
+    for volume, roi_activities in enumerate(zip(cen, dmn)):
+        roi_activities = list(roi_activities)
+        movement = None if is_pda_outlier(roi_activities, threshold) else pda_direction(roi_activities)
+        if movement is not None:
+            _, direction, activity = movement
+            delta = np.real(np.dot(direction, activity)) * (scale_factor / INTERNAL_SCALER) / tr_to_frame_ratio
+            for frame in range(int(tr_to_frame_ratio)):
+                y += delta
+                if y > top:
+                    hits.append((volume, 'CEN', y, frame))
+                    y = 0.0
+                    break
+                elif y < bottom:
+                    hits.append((volume, 'DMN', y, frame))
+                    y = 0.0
+                    break
+        ball_y.append(y)
+    return np.array(ball_y), hits
+
+
+def test_replay_matches_frame_by_frame():
+    rng = np.random.default_rng(0)
+    for tr_to_frame_ratio, scale_factor in [(72.0, 10), (172.9, 13), (86.4, 7)]:
+        cen = rng.normal(0, 1, 150)
+        dmn = rng.normal(0, 1, 150)
+        dmn[::17] = cen[::17]  # mean 0 once in a while
+        expected_y, expected_hits = frame_by_frame(cen, dmn, 2, tr_to_frame_ratio, scale_factor, 0.3, -0.3)
+        assert expected_hits, 'the random run should have hits'
+
+        outliers = np.maximum(np.abs(cen), np.abs(dmn)) > 2
+        ball_y, hits = VirtualBall(tr_to_frame_ratio, scale_factor).replay(cen, dmn, outliers, 0.3, -0.3)
+        assert hits == expected_hits
+        assert np.array_equal(ball_y, expected_y)
+
+        # update() one volume at a time gives the same hits too
+        ball = VirtualBall(tr_to_frame_ratio, scale_factor)
+        hits = []
+        for volume, roi_activities in enumerate(zip(cen, dmn)):
+            hit = ball.update(list(roi_activities), outliers[volume], 0.3, -0.3)
+            if hit is not None:
+                hits.append((volume,) + hit)
+        assert hits == expected_hits
+        assert (ball.cen_hits, ball.dmn_hits) == (sum(h[1] == 'CEN' for h in hits), sum(h[1] == 'DMN' for h in hits))
+
+
+def test_recorded_sham_runs():
+    cwd = os.getcwd()
+    os.chdir(TASK_DIR)
+    try:
+        sham = sham_participants(SITE_PROFILES['mgh'])
+        index = BalltaskDataIndex('.', use_cache=False)
+        for pid in sorted(set(index.participants()) & sham):
+            for run in index.runs(pid):
+                df = index.load(pid, run, 'roi_outputs', verbose=False)
+                assert check_run(pid, run, df) == [], f'{pid} run {run}'
+    finally:
+        os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    test_replay_matches_frame_by_frame()
+    test_recorded_sham_runs()
+    print('ok')
@@ -0,0 +1,71 @@
+'''
+Buffered writer for the SRET events csv
+
+write() only appends the row to an in-memory buffer, so no file is opened or written between a
+win.flip() and the response collection that follows it. A background thread writes the buffered
+rows every FLUSH_INTERVAL seconds to the file, which stays open for the whole run. The rows
+are also written when the run ends, including through core.quit() or an exception. A hard crash
+can lose at most the last FLUSH_INTERVAL seconds of events.
+'''
+
+import atexit
+import csv
+import os
+import threading
+
+FLUSH_INTERVAL = 0.5  # seconds
+
+
+class EventWriter:
+    '''
+    Events csv of a run
+
+    columns: header row, written when the file is created; rows must follow this column order
+    '''
+
+    def __init__(self, path, columns, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.columns = list(columns)
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        if self._file.tell() == 0:
+            self._writer.writerow(self.columns)
+            self._file.flush()
+        self._thread = threading.Thread(target=self._run, name='event_writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError(f'event row has {len(row)} values, expected {len(self.columns)}: {row}')
+        with self._lock:
+            self._rows.append(list(row))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''Write every buffered row to the file'''
+        with self._file_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            if rows and not self._file.closed:
+                self._writer.writerows(rows)
+                self._file.flush()
+
+    def close(self):
+        '''Write the remaining rows and close the file (called automatically at exit)'''
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._file_lock:
+            os.fsync(self._file.fileno())
+            self._file.close()
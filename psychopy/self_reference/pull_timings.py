@@ -1,36 +1,112 @@
+import argparse
+import glob
+import os
+import sys
+
 import numpy as np
 import pandas as pd
 
+# word presentation and block length (seconds) the timing templates were optimized for
+PRESENTATION_DURATION = 2.5
+BLOCK_WORDS_DURATION = 28
+
+TEMPLATE_DIR = 'stim_timing_template_files'
+
+
+# Words of every block in presentation order, for all blocks at once
+# returns (word onsets within each block, 'positive'/'negative' per word), both blocks x words arrays
+def block_word_timings(pos, neg):
+    pos, neg = np.atleast_2d(pos), np.atleast_2d(neg)
+    times = np.hstack([pos, neg])
+    stim_types = np.array(['positive'] * pos.shape[1] + ['negative'] * neg.shape[1])
+    order = np.argsort(times, axis=1, kind='stable')
+    return np.take_along_axis(times, order, axis=1), stim_types[order]
+
+
+# Make timings for each block of the run
+# One row per word: block, time (within the block), stim_type, time_diff (from the previous word of the block)
+# and fix_duration (fixation before the word: time_diff - 2.5 seconds, 0 for the first word of a block)
+def make_run_timings(pos, neg):
+    times, stim_types = block_word_timings(pos, neg)
+    n_blocks, n_words = times.shape
+    time_diff = np.diff(times, axis=1, prepend=np.nan)
+    # '0 second' fixation for the first trial in the block -- that's because the fixation is coded to be at the start of each trial
+    fix_duration = np.where(np.isnan(time_diff), 0.0, time_diff - PRESENTATION_DURATION)
+    return pd.DataFrame({'time': times.ravel(),
+                         'stim_type': stim_types.ravel(),
+                         'time_diff': time_diff.ravel(),
+                         'fix_duration': fix_duration.ravel(),
+                         'block': np.repeat(np.arange(n_blocks), n_words)},
+                        index=np.tile(np.arange(n_words), n_blocks))
+
 
 # Makes stim timings for a single block within a run
 def make_block_timings(block_num, pos, neg):
-    # Make a 6 row dataframe with the timings of positive/negative words for a given block
-    pos_frame = pd.DataFrame({'time':pos[block_num, ], 'stim_type': ['positive']*3})
-    neg_frame =pd.DataFrame({'time':neg[block_num, ], 'stim_type': ['negative']*3})
-    full_frame = pd.concat([pos_frame, neg_frame])
+    timings = make_run_timings(pos, neg)
+    return timings[timings.block == block_num].reset_index(drop=True)
 
-    # sort values by time
-    full_frame.sort_values(by = 'time', axis = 0, inplace = True)
 
-    # get the difference in time between each set of stimuli
-    full_frame['time_diff'] = full_frame.time.diff() 
+# Problems of a timing template (empty list if there are none): words that overlap the previous word
+# of their block, start before the block or do not end within the block
+def check_timing_template(pos, neg):
+    pos, neg = np.atleast_2d(pos), np.atleast_2d(neg)
+    if pos.shape[0] != neg.shape[0]:
+        return [f'{pos.shape[0]} blocks of positive words but {neg.shape[0]} of negative words']
+    times, _ = block_word_timings(pos, neg)
+    problems = []
+    gaps = np.diff(times, axis=1)
+    for block, word in zip(*np.nonzero(gaps < PRESENTATION_DURATION)):
+        problems.append(f'block {block}: word {word + 1} at {times[block, word + 1]}s starts '
+                        f'{gaps[block, word]:.2f}s after the previous word (< {PRESENTATION_DURATION}s)')
+    for block, word in zip(*np.nonzero(times < 0)):
+        problems.append(f'block {block}: word {word} starts before the block ({times[block, word]}s)')
+    for block, word in zip(*np.nonzero(times + PRESENTATION_DURATION > BLOCK_WORDS_DURATION)):
+        problems.append(f'block {block}: word {word} at {times[block, word]}s ends after the block '
+                        f'({BLOCK_WORDS_DURATION}s)')
+    return problems
 
-    # fixation duration is the difference in time between trials - 2.5 seconds (when the word is on the screen)
-    full_frame['fix_duration'] = full_frame.time_diff - 2.5
-    full_frame.reset_index(inplace = True, drop = True)
 
-    # '0 second' fixation for the first trial in the block -- that's because the fixation is coded to be at the start of each trial
-    full_frame['fix_duration'][0] = 0
-    full_frame['block'] = block_num
-    return(full_frame)
+# Load the positive & negative word onsets of a timing template (e.g. '0005')
+def load_timing_template(template, template_dir=TEMPLATE_DIR):
+    pos = np.loadtxt(os.path.join(template_dir, f'stimes_pos_{template}.1D'))
+    neg = np.loadtxt(os.path.join(template_dir, f'stimes_neg_{template}.1D'))
+    return pos, neg
 
-# Make timings for each block of the run
-def make_run_timings(pos, neg):
-    blocks = 10
-    block_timing_list = []
-    for block in range(blocks):
-        block_timing_list.append(make_block_timings(block_num = block, pos = pos, neg = neg))
-
-    # Concatenate 1 dataframe with timings for all blocks of the run
-    all_block_timings = pd.concat(block_timing_list)
-    return(all_block_timings)
\ No newline at end of file
+
+# Every timing template in the template folder
+def list_timing_templates(template_dir=TEMPLATE_DIR):
+    paths = glob.glob(os.path.join(template_dir, 'stimes_pos_*.1D'))
+    return sorted(os.path.basename(path)[len('stimes_pos_'):-len('.1D')] for path in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the SRET timing templates, and precompute the run '
+                                                 'schedules of every counterbalancing condition for QA')
+    parser.add_argument('--template-dir', default=TEMPLATE_DIR, help='Folder of the .1D timing templates')
+    parser.add_argument('--schedules', help='Write the schedules of all conditions to this csv')
+    parser.add_argument('--frame-rate', type=float, default=60.0, help='Display refresh rate for the schedules (Hz)')
+    args = parser.parse_args()
+
+    try:
+        n_problems = 0
+        for template in list_timing_templates(args.template_dir):
+            problems = check_timing_template(*load_timing_template(template, args.template_dir))
+            n_problems += len(problems)
+            print(f"{template}: {'ok' if not problems else f'{len(problems)} problem(s)'}")
+            for problem in problems:
+                print(f'  {problem}')
+
+        if args.schedules:
+            from schedule import compile_all_conditions
+            schedules = compile_all_conditions(args.frame_rate, args.template_dir)
+            schedules.to_csv(args.schedules, index=False)
+            print(f'{schedules.groupby(["participant_group", "run"]).ngroups} schedules written to {args.schedules}')
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    if n_problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
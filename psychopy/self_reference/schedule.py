@@ -0,0 +1,124 @@
+'''
+Trial schedule of a SRET run, compiled before the trigger
+
+A run is 10 blocks of [8 s fixation, 2 s block question, 28 s of 6 words with fixations in
+between], then a final 8 s fixation. compile_schedule() turns the .1D timing templates (word
+onsets within each block), the block order and the shuffled word lists into one flat array
+with the absolute onset of every event (seconds after the trigger), quantized to display
+frames. The task shows each event at the first flip at or after its onset frame, so timing
+errors no longer add up over the run: every onset is within one frame of the design.
+'''
+
+import numpy as np
+import pandas as pd
+
+from pull_timings import TEMPLATE_DIR, block_word_timings, load_timing_template
+
+FIXATION_DURATION = 8  # before each block, and at the end of the run
+BLOCK_INTRO_DURATION = 2  # block question before the words
+TRIAL_DURATION = 2.5  # word presentation
+BLOCK_WORDS_DURATION = 28  # words of a block (the last word starts at 25.5 s)
+BLOCK_DURATION = FIXATION_DURATION + BLOCK_INTRO_DURATION + BLOCK_WORDS_DURATION
+
+SCHEDULE_DTYPE = np.dtype([
+    ('onset', 'f8'),  # seconds after the trigger
+    ('frame', 'i8'),  # onset in display frames after the trigger
+    ('kind', 'U24'),  # fixation, block_type_instruction, block_start, word_presentation or end
+    ('block', 'i4'),  # -1 for the final fixation and the end
+    ('trial', 'i4'),  # word within the block, -1 for other events
+    ('condition', 'U8'),  # block type: self, other or semantic
+    ('valence', 'U8'),  # positive or negative (words only)
+    ('word', 'U32'),
+])
+
+
+# Counterbalance block orders
+BLOCK_ORDERS = [
+    ['self', 'other',  'other', 'semantic', 'self',  'other', 'semantic', 'self',  'self', 'other'],
+    ['other', 'self',  'self', 'semantic', 'other',  'self', 'semantic', 'other',  'other', 'self'],
+    ['other', 'self', 'semantic',  'self', 'other',  'self', 'other',  'semantic', 'other','self'],
+    ['self', 'other', 'semantic',  'other', 'self',  'other', 'self',  'semantic', 'self','other'],
+]
+# block order (index into BLOCK_ORDERS) of internal runs 1-4, by participant number % 3
+BLOCK_ORDER_RUNS = {0: [0, 1, 2, 3], 1: [3, 2, 1, 0], 2: [1, 0, 3, 2]}
+
+# Counterbalance ISI orders: timing template of internal runs 1-4, by participant number % 4
+TIMING_TEMPLATE_RUNS = {0: ['0005', '0014', '0067', '0072'], 1: ['0005', '0014', '0067', '0072'],
+                        2: ['0072', '0067', '0014', '0005'], 3: ['0072', '0067', '0014', '0005']}
+
+
+# Block order of an internal run (1-4) for a participant
+def block_order(participant_number, run_num):
+    return BLOCK_ORDERS[BLOCK_ORDER_RUNS[participant_number % 3][run_num - 1]]
+
+
+# Timing template of an internal run (1-4) for a participant
+def timing_template(participant_number, run_num):
+    return TIMING_TEMPLATE_RUNS[participant_number % 4][run_num - 1]
+
+
+# Compile the schedule of a run
+# pos, neg: word onsets per block from the .1D timing templates (blocks x 3 array each)
+# block_types: 'self' / 'other' / 'semantic' for each block
+# positive_words, negative_words: the run's words, used in order
+# frame_rate: display refresh rate in Hz
+def compile_schedule(pos, neg, block_types, positive_words, negative_words, frame_rate):
+    word_times, valences = block_word_timings(pos, neg)
+    if word_times.shape[0] != len(block_types):
+        raise ValueError(f'timing templates have {word_times.shape[0]} blocks, the block order has {len(block_types)}')
+    words = {'positive': iter(positive_words), 'negative': iter(negative_words)}
+
+    events = []
+    for block, block_type in enumerate(block_types):
+        block_onset = block * BLOCK_DURATION
+        words_onset = block_onset + FIXATION_DURATION + BLOCK_INTRO_DURATION
+        events.append((block_onset, 'fixation', block, -1, '', '', ''))
+        events.append((block_onset + FIXATION_DURATION, 'block_type_instruction', block, -1, block_type, '', ''))
+        events.append((words_onset, 'block_start', block, -1, block_type, '', ''))
+        for trial, (time, valence) in enumerate(zip(word_times[block], valences[block])):
+            if trial > 0:
+                # fixation between the words (the first word of a block follows the block question)
+                events.append((words_onset + word_times[block, trial - 1] + TRIAL_DURATION, 'fixation',
+                               block, trial, block_type, '', ''))
+            word = next(words[valence], None)
+            if word is None:
+                raise ValueError(f'not enough {valence} words for block {block}')
+            events.append((words_onset + time, 'word_presentation', block, trial, block_type, valence, word))
+    run_end = len(block_types) * BLOCK_DURATION
+    events.append((run_end, 'fixation', -1, -1, '', '', ''))
+    events.append((run_end + FIXATION_DURATION, 'end', -1, -1, '', '', ''))
+
+    schedule = np.zeros(len(events), dtype=SCHEDULE_DTYPE)
+    for i, (onset, kind, block, trial, condition, valence, word) in enumerate(events):
+        schedule[i] = (onset, 0, kind, block, trial, condition, valence, word)
+    schedule['frame'] = np.round(schedule['onset'] * frame_rate).astype(np.int64)
+    if np.any(np.diff(schedule['onset']) < 0):
+        raise ValueError('events of the schedule overlap')
+    return schedule
+
+
+# Schedules of every counterbalancing condition (participant number % 12 and internal run 1-4) in one table, for QA
+# Words are placeholders (positive_0, negative_0, ...) as the real ones depend on the participant's word list
+def compile_all_conditions(frame_rate=60.0, template_dir=TEMPLATE_DIR):
+    templates = {}
+    schedules = []
+    for participant_group in range(12):
+        for run_num in range(1, 5):
+            template = timing_template(participant_group, run_num)
+            if template not in templates:
+                templates[template] = load_timing_template(template, template_dir)
+            pos, neg = templates[template]
+            schedule = compile_schedule(pos, neg, block_order(participant_group, run_num),
+                                        [f'positive_{i}' for i in range(pos.size)],
+                                        [f'negative_{i}' for i in range(neg.size)], frame_rate)
+            table = pd.DataFrame(schedule)
+            table.insert(0, 'participant_group', participant_group)
+            table.insert(1, 'run', run_num)
+            table.insert(2, 'timing_template', template)
+            schedules.append(table)
+    return pd.concat(schedules, ignore_index=True)
+
+
+# Index of the flip since the trigger at time t (seconds after the trigger)
+def flip_index(t, frame_rate):
+    return int(round(t * frame_rate))
@@ -17,8 +17,13 @@ import random
 import os  # handy system and path functions
 import csv
 import time
-from pull_timings import *
+from pull_timings import load_timing_template
+from schedule import *
 from bids_tsv_convert_function import *
+from stimulus_cache import *
+from event_writer import EventWriter
+from word_index import WordIndex, check_run_words
+from collections import deque
 # Ensure that relative paths start from the same directory as this script
 _thisDir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(_thisDir)
@@ -62,10 +67,6 @@ if not os.path.exists(f"{_thisDir}/data/{expInfo['participant']}"):
 participant_number = int(expInfo['participant'].replace('sub-midbpd', '')[-3:])
 print(participant_number)
 
-# pull corresponding file
-word_order_file = f"word_list_splits/word_order_{participant_number}.csv"
-word_order = pd.read_csv(word_order_file)
-
 # internal run numbers 1-4 based on session (loc vs. nf) and run within session (1 vs. 2)
 if int(expInfo['run']) == 1:
     if expInfo['session'] == 'loc':
@@ -78,87 +79,45 @@ if int(expInfo['run']) == 2:
     elif expInfo['session'] == 'nf':
         run_num = 4
 
-# Pull words specifically for this run & split into positive/negative lists
-word_list = word_order[word_order.run == run_num]
-negative_words = list(word_list.word[word_list.valence_condition == '-'])
-positive_words = list(word_list.word[word_list.valence_condition == '+']) 
+# Pull words specifically for this run, as positive/negative lists (from the word-order index, see word_index.py)
+word_index = WordIndex()
+positive_words, negative_words = word_index.run_words(participant_number, run_num)
+word_index.close()
 
 # Shuffle the order of positive/negative word lists within the run
 random.shuffle(positive_words)
 random.shuffle(negative_words)
 
 # for practice in very first run
-practice_words = ['quiet', 'loud', 'cautious', 'wild', 'ordinary', 'precise']
-
-# Counterbalence ISI orders
-if participant_number % 4 in [0,1]:
-    timing_templates = ['0005', '0014', '0067', '0072']
-elif participant_number % 4 in [2,3]:
-    timing_templates = ['0072', '0067', '0014', '0005']
+practice_words = deque(['quiet', 'loud', 'cautious', 'wild', 'ordinary', 'precise'])
 
+# Counterbalance ISI orders & block orders (see schedule.py)
 # load timings for positive & negative word depending on run
-pos = np.loadtxt(f"stim_timing_template_files/stimes_pos_{timing_templates[run_num-1]}.1D")
-neg = np.loadtxt(f"stim_timing_template_files/stimes_neg_{timing_templates[run_num-1]}.1D")
-
-
-# Counterbalance block orders
-block_order1=['self', 'other',  'other', 'semantic', 'self',  'other', 'semantic', 'self',  'self', 'other']
-block_order2=['other', 'self',  'self', 'semantic', 'other',  'self', 'semantic', 'other',  'other', 'self']
-block_order3=['other', 'self', 'semantic',  'self', 'other',  'self', 'other',  'semantic', 'other','self']
-block_order4=['self', 'other', 'semantic',  'other', 'self',  'other', 'self',  'semantic', 'self','other']
-
-if participant_number % 3 ==0:
-    if run_num==1:
-      cur_block_order = block_order1
-    elif run_num==2:
-      cur_block_order = block_order2
-    elif run_num==3:
-      cur_block_order = block_order3
-    elif run_num==4:
-      cur_block_order = block_order4
-elif participant_number % 3 == 1:
-    if run_num==1:
-      cur_block_order = block_order4
-    elif run_num==2:
-      cur_block_order = block_order3
-    elif run_num==3:
-      cur_block_order = block_order2
-    elif run_num==4:
-      cur_block_order = block_order1
-elif participant_number % 3 ==2:
-    if run_num==1:
-      cur_block_order = block_order2
-    elif run_num==2:
-      cur_block_order = block_order1
-    elif run_num==3:
-      cur_block_order = block_order4
-    elif run_num==4:
-      cur_block_order = block_order3
-
-block_order = pd.DataFrame({'block': np.arange(10), 
-    'block_type': cur_block_order})
-
-all_block_timings = make_run_timings(pos = pos, neg = neg)
-print(all_block_timings)
+pos, neg = load_timing_template(timing_template(participant_number, run_num))
+cur_block_order = block_order(participant_number, run_num)
+
+# make sure the run has exactly the words its timing template needs before anything is shown
+word_problems = check_run_words(positive_words, negative_words, pos, neg)
+if word_problems:
+    raise ValueError(f"word list of participant {participant_number}, run {run_num} does not match timing template "
+                     f"{timing_template(participant_number, run_num)}: {'; '.join(word_problems)}")
 
 
 # output file stem
 filename = f"{_thisDir}/data/{expInfo['participant']}/{expInfo['participant']}_ses-{expInfo['session']}_task-selfref_run-{expInfo['run']}"
 
+# Events file of the run, buffered in memory and written by a background thread (see event_writer.py)
+# Header column (following this, very important to make sure rows are written matching this column order)
+event_writer = EventWriter(filename+'_events.csv', ['participant','session', 'date', 'exp_name', 'frame_rate', 'absolute_time', 'trigger_time', 'trial_type', 'trial_num', 'word', 'response_time','reponse_key', 'response_endorse', 'condition', 'word_valence', 'block_number'])
+
 # Function to write a line of data to the output file
 def write_to_tsv(row_info:list):
-    with open(filename+'_events.csv', 'a') as csvfile:
-        stim_writer = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        stim_writer.writerow(row_info)
- 
-# Header column (following this, very important to make sure rows are written matching this column order)
-write_to_tsv(['participant','session', 'date', 'exp_name', 'frame_rate', 'absolute_time', 'trigger_time', 'trial_type', 'trial_num', 'word', 'response_time','reponse_key', 'response_endorse', 'condition', 'word_valence', 'block_number'])
+    event_writer.write(row_info)
 
 # Data file name stem = absolute path + name; later add .psyexp, .csv, .log, etc
 logFile = logging.LogFile(filename+'.log', level=logging.EXP)
 logging.console.setLevel(logging.WARNING)
-trial_duration = 2.5
-block_intro_time = 2
+trial_duration = TRIAL_DURATION
 
 # Setup the Window
 win = visual.Window(size=(1920, 1080), fullscr=True, screen=1, allowGUI=False, allowStencil=False,
@@ -241,6 +200,47 @@ if expInfo['frameRate']!=None:
 else:
     frameDur = 1.0/60.0 # couldn't get a reliable measure so guess
 
+# absolute onsets of every event of the run, in frames after the trigger (see schedule.py)
+run_schedule_events = compile_schedule(pos, neg, cur_block_order, positive_words, negative_words, 1.0/frameDur)
+print(run_schedule_events[['onset', 'frame', 'kind', 'block', 'trial', 'valence', 'word']])
+
+# Texts shown during the run, each prebuilt as its own TextStim (see stimulus_cache.py)
+question_types_text = f'The 3 types of YES or NO questions you will see will be:\
+\n\n1) Does a word describe you?\
+\n\n2) Does a word describe {expInfo["friend_name"]} (who you mentioned earlier)?\
+\n\n3) Is a word positive?'
+no_wrong_answers_text = "There are no right or wrong answers!\
+\n\nIf you see a word you don't know, you can just wait for the next one"
+buttons_text = 'Each time you answer a question:\
+        \n\n\npress the left button to answer YES\n\npress the right button to answer NO'
+check_yes_text = 'Just to make sure everything is working with the buttons.\
+        \n\nPlease press the left button to answer YES'
+check_no_text = 'Just to make sure everything is working with the buttons.\
+        \n\nPlease press the right button to answer NO'
+practice_start_text = 'Great! We will go through a few practice trials of each type now.\
+        \n\nTry to make your decision quickly!'
+practice_end_text = 'Great job! Any questions on what to do?'
+run_end_text = 'Great job! You have finished this run'
+instruction_stims = build_text_stims(instruct_text, [question_types_text, no_wrong_answers_text, buttons_text,
+    check_yes_text, check_no_text, practice_start_text, practice_end_text, run_end_text])
+
+# question shown before each block, and above each word of the block
+block_intro_texts = {'semantic': 'Is the word positive?',
+                     'self': 'Does this word describe you?',
+                     'other': f'Does this word describe {expInfo["friend_name"]}?'}
+block_question_texts = {'semantic': 'Is this word positive?',
+                        'self': 'Are you?',
+                        'other': f'Is {expInfo["friend_name"]}?'}
+block_stims = build_text_stims(block_type_text, list(block_intro_texts.values()) + list(block_question_texts.values()))
+
+# every word of the run (and of the practice), and YES/NO as shown once selected
+word_stims = build_text_stims(word, positive_words + negative_words + practice_words)
+yes_selected = copy_text_stim(yes, bold=True, italic=True)
+no_selected = copy_text_stim(no, bold=True, italic=True)
+
+warm_up(win, [instruct_text, trigger_text, fix_stim, yes, no, yes_selected, no_selected]
+    + list(instruction_stims.values()) + list(block_stims.values()) + list(word_stims.values()))
+
 def run_instructions():
     instruct_text.draw()
     win.flip()
@@ -281,49 +281,12 @@ def get_trigger():
                     expName, expInfo['frameRate'], time.time(), 0, 'trigger', '', '', '','', '', '', '', ''])
 
 '''
-Run a block of trials
+Show a practice block question, for longer than in the scanned blocks
 '''
-def run_block(n_trials, block_type, block_number, practice=False):
-    if block_type == 'semantic':
-        block_type_text.setText(f'Is the word positive?')
-    elif block_type == 'self':
-        block_type_text.setText(f'Does this word describe you?')
-    elif block_type == 'other':
-        block_type_text.setText(f'Does this word describe {expInfo["friend_name"]}?')
-    block_type_text.height = 0.2    
-    block_type_text.draw()
+def run_practice_block(block_type):
+    block_stims[block_intro_texts[block_type]].draw()
     win.flip()
-    
-    # Show questions for longer during practice
-    if not practice:
-        write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
-            expName, expInfo['frameRate'], time.time(), triggerClock.getTime(), 'block_type_instruction', '', 
-            '', '', '', '', block_type, '', block_number])
-        core.wait(block_intro_time)
-
-    elif practice:
-        core.wait(4)
-    if block_type == 'semantic':
-        block_type_text.setText(f'Is this word positive?')
-    elif block_type == 'self':
-        block_type_text.setText(f'Are you?')
-    elif block_type == 'other':
-        block_type_text.setText(f'Is {expInfo["friend_name"]}?')
-    block_type_text.height = 0.2
-    if not practice:
-        # get timings just for the current block
-        block_timing_frame = all_block_timings[all_block_timings.block == block_number]
-        block_timing_frame.reset_index(inplace = True)
-        write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
-            expName, expInfo['frameRate'], time.time(), triggerClock.getTime(), 'block_start', '', 
-            '', '', '', '', block_type, '', block_number])
-
-        # run each trial in the block, pulling the word type (positive vs. negative) and fixation duration (ISI) from the block_timing_frame
-        for trial_num in range(n_trials):
-            run_trial(trial_type = block_timing_frame.stim_type[trial_num], 
-                      fixation_duration= block_timing_frame.fix_duration[trial_num],
-                      practice=False, block_type=block_type, block_number=block_number,
-                      trial_num=trial_num)
+    core.wait(4)
 
 '''
 Show a fixation cross 
@@ -341,133 +304,156 @@ def run_fixation(duration):
     event.clearEvents(eventType='keyboard')
 
 '''
-Run a single trial
+Run a single practice trial (fixation, then the next practice word)
 '''
-def run_trial(trial_type, fixation_duration, practice=False, block_type='', block_number='', trial_num=''):
-    # fixation at beginning of trial (unless it is first trial of the block)
-    if trial_num > 0:
-        run_fixation(duration=fixation_duration)
+def run_practice_trial(block_type):
+    run_fixation(duration=1)
     # present word 
     trial_clock.reset()
-
-    # determine the word to display
-    if not practice:
-        if trial_type == 'negative':
-            trial_word = negative_words.pop(0)
-        elif trial_type == 'positive':
-            trial_word = positive_words.pop(0)
-    elif practice:
-        trial_word = practice_words.pop(0)
-    word.setText(trial_word)
-    endExpNow = False
-    no.bold = False
-    no.italic = False
-    yes.bold = False
-    yes.italic = False
-    word.draw()
-    yes.draw()
-    no.draw()
-    block_type_text.draw()
+    trial_word = practice_words.popleft()
+    word_stim = word_stims[trial_word]
+    question_stim = block_stims[block_question_texts[block_type]]
+    yes_stim, no_stim = yes, no
+    word_stim.draw()
+    yes_stim.draw()
+    no_stim.draw()
+    question_stim.draw()
     win.flip()
-    if not practice:
-        write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
-                      expName, expInfo['frameRate'], time.time(), triggerClock.getTime(), 
-                      'word_presentation', trial_num, trial_word, '', '', '', block_type, trial_type, block_number])
     
     # get participant button press response for word
-    continueRoutine = True
-    response_endorse=''
-    while continueRoutine:            
-        trial_time = trial_clock.getTime()
-        if trial_time > 0 and trial_time < trial_duration:
+    while trial_clock.getTime() < trial_duration:
+        theseKeys = event.getKeys(keyList=[yes_button_number, no_button_number, 'escape'])
+        if "escape" in theseKeys:
+            win.close()
+            event_writer.close()
+            convert_sret_csv_to_bids(infile = filename+'_events.csv')
+            core.quit()
+        # if participant has pressed a button    
+        if len(theseKeys) > 0 :
+            # change color of selected word
+            if no_button_number in theseKeys:
+                no_stim = no_selected
+            elif yes_button_number in theseKeys:
+                yes_stim = yes_selected
+            word_stim.draw()
+            yes_stim.draw()
+            no_stim.draw()
+            question_stim.draw()
+            win.flip()
+
+'''
+Run the scanned part of the task from the compiled schedule (see schedule.py)
+
+Every event is shown at the first flip at or after its onset frame. The flip index is re-read
+from the trigger clock after every flip, so dropped frames or a refresh rate slightly off the
+measured one never accumulate: every onset is within one frame of the design.
+'''
+def run_schedule(schedule):
+    frame_rate = 1.0/frameDur
+    frame = flip_index(triggerClock.getTime(), frame_rate)
+    stims = [fix_stim]
+    current_word = None
+    # the last event of the run is shown until the flip of the 'end' event
+    end_frame = schedule['frame'][schedule['kind'] == 'end'][0]
+    i = 0
+    while frame + 1 < end_frame:
+        # events that start at the coming flip
+        due = []
+        while schedule['kind'][i] != 'end' and schedule['frame'][i] <= frame + 1:
+            due.append(schedule[i])
+            i += 1
+        for scheduled in due:
+            if scheduled['kind'] == 'fixation':
+                stims, current_word = [fix_stim], None
+            elif scheduled['kind'] == 'block_type_instruction':
+                stims, current_word = [block_stims[block_intro_texts[str(scheduled['condition'])]]], None
+            elif scheduled['kind'] == 'word_presentation':
+                current_word = scheduled
+                yes_stim, no_stim = yes, no
+                word_stim = word_stims[str(scheduled['word'])]
+                question_stim = block_stims[block_question_texts[str(scheduled['condition'])]]
+        if current_word is not None:
+            stims = [word_stim, yes_stim, no_stim, question_stim]
+        for stim in stims:
+            stim.draw()
+        if any(scheduled['kind'] == 'word_presentation' for scheduled in due):
+            event.clearEvents(eventType='keyboard')
+        win.flip()
+        flip_time = triggerClock.getTime()
+        frame = flip_index(flip_time, frame_rate)
+
+        for scheduled in due:
+            block_type, block_number = str(scheduled['condition']), int(scheduled['block'])
+            if scheduled['kind'] == 'fixation':
+                write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
+                    expName, expInfo['frameRate'], time.time(), flip_time, 'fixation', '', '', '', '','', '', '', ''])
+            elif scheduled['kind'] == 'word_presentation':
+                word_onset = flip_time
+                write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
+                    expName, expInfo['frameRate'], time.time(), flip_time, 
+                    'word_presentation', int(scheduled['trial']), str(scheduled['word']), '', '', '', block_type, str(scheduled['valence']), block_number])
+            else:
+                write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
+                    expName, expInfo['frameRate'], time.time(), flip_time, str(scheduled['kind']), '', 
+                    '', '', '', '', block_type, '', block_number])
+
+        # get participant button press response for the word on screen
+        if current_word is not None:
             theseKeys = event.getKeys(keyList=[yes_button_number, no_button_number, 'escape'])
             if "escape" in theseKeys:
-                endExpNow = True
-            # if participant has pressed a button    
+                win.close()
+                event_writer.close()
+                convert_sret_csv_to_bids(infile = filename+'_events.csv')
+                core.quit()
             if len(theseKeys) > 0 :
                 # change color of selected word
                 if no_button_number in theseKeys:
-                    no.bold = True
-                    no.italic = True
+                    no_stim = no_selected
                     response_endorse = 0
                 elif yes_button_number in theseKeys:
-                    yes.bold = True
-                    yes.italic = True
+                    yes_stim = yes_selected
                     response_endorse = 1
-                if not practice:  
-                    write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
-                                    expName, expInfo['frameRate'], time.time(), triggerClock.getTime(), 'response', trial_num, 
-                                    trial_word, trial_clock.getTime(), theseKeys[0], response_endorse, block_type, trial_type, block_number])
-                word.draw()
-                yes.draw()
-                no.draw()
-                block_type_text.draw()
-                win.flip()
-            if endExpNow:
-                win.close()
-                convert_sret_csv_to_bids(infile = filename+'_events.csv')
-                core.quit()
-        else:
-            continueRoutine = False 
-            if endExpNow:
-                convert_sret_csv_to_bids(infile = filename+'_events.csv')
-                core.quit()
+                now = triggerClock.getTime()
+                write_to_tsv([expInfo['participant'],expInfo['session'], expInfo['date'], 
+                                expName, expInfo['frameRate'], time.time(), now, 'response', int(current_word['trial']), 
+                                str(current_word['word']), now - word_onset, theseKeys[0], response_endorse,
+                                str(current_word['condition']), str(current_word['valence']), int(current_word['block'])])
 
 
 # Run the practice (only for first run of localizer) / with instructions & checking keys
 def run_practice():
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText(f'The 3 types of YES or NO questions you will see will be:\
-\n\n1) Does a word describe you?\
-\n\n2) Does a word describe {expInfo["friend_name"]} (who you mentioned earlier)?\
-\n\n3) Is a word positive?')
-    instruct_text.draw()
+    instruction_stims[question_types_text].draw()
     win.flip()
     wait_for_keypress(key_list=['space'])
 
-    instruct_text.setText("There are no right or wrong answers!\
-\n\nIf you see a word you don't know, you can just wait for the next one")
-    instruct_text.draw()
+    instruction_stims[no_wrong_answers_text].draw()
     win.flip()
     event.clearEvents(eventType='keyboard')
     wait_for_keypress(key_list=['space'])
 
-    instruct_text.setText('Each time you answer a question:\
-        \n\n\npress the left button to answer YES\n\npress the right button to answer NO')
-    instruct_text.draw()
+    instruction_stims[buttons_text].draw()
     win.flip()
     wait_for_keypress(key_list=['space'])
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText('Just to make sure everything is working with the buttons.\
-        \n\nPlease press the left button to answer YES')
-    instruct_text.draw()
+    instruction_stims[check_yes_text].draw()
     win.flip()
     wait_for_keypress(key_list=[yes_button_number])
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText('Just to make sure everything is working with the buttons.\
-        \n\nPlease press the right button to answer NO')
-    instruct_text.draw()
+    instruction_stims[check_no_text].draw()
     win.flip()
     wait_for_keypress(key_list=[no_button_number])
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText('Great! We will go through a few practice trials of each type now.\
-        \n\nTry to make your decision quickly!')
-    instruct_text.draw()
+    instruction_stims[practice_start_text].draw()
     win.flip()
     wait_for_keypress(key_list=['space'])
 
     # Run actual practice trials (6 of them, 2 of each type)
-    run_block(n_trials = 0, block_type = 'self', block_number = 0, practice = True)
-    run_trial(trial_type = 'self', fixation_duration=1, practice = True, block_type = 'self', trial_num=1)
-    run_trial(trial_type = 'self', fixation_duration=1, practice = True, block_type = 'self', trial_num=1)
-    run_block(n_trials = 0, block_type = 'other', block_number = 0, practice = True)
-    run_trial(trial_type = 'other', fixation_duration=1, practice = True, block_type = 'other', trial_num=1)
-    run_trial(trial_type = 'other', fixation_duration=1, practice = True, block_type = 'other', trial_num=1)
-    run_block(n_trials = 0, block_type = 'semantic', block_number = 0, practice = True)
-    run_trial(trial_type = 'positive', fixation_duration=1, practice = True, block_type = 'semantic', trial_num=1)
-    run_trial(trial_type = 'positive', fixation_duration=1, practice = True, block_type = 'semantic', trial_num=1)
-    instruct_text.setText('Great job! Any questions on what to do?')
-    instruct_text.draw()
+    for block_type in ['self', 'other', 'semantic']:
+        run_practice_block(block_type)
+        run_practice_trial(block_type)
+        run_practice_trial(block_type)
+    instruction_stims[practice_end_text].draw()
     win.flip()
     wait_for_keypress(key_list=['space'])
 
@@ -484,15 +470,11 @@ if expInfo['run'] == '1' and expInfo['session'] == 'loc':
     run_practice()
 elif expInfo['run'] == '1' and expInfo['session'] == 'nf':
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText('Just to make sure everything is working with the buttons.\
-        \n\nPlease press the right button to answer NO')
-    instruct_text.draw()
+    instruction_stims[check_no_text].draw()
     win.flip()
     wait_for_keypress(key_list=[no_button_number])
     event.clearEvents(eventType='keyboard')
-    instruct_text.setText('Just to make sure everything is working with the buttons.\
-        \n\nPlease press the left button to answer YES')
-    instruct_text.draw()
+    instruction_stims[check_yes_text].draw()
     win.flip()
     wait_for_keypress(key_list=[yes_button_number])
     event.clearEvents(eventType='keyboard')
@@ -500,21 +482,16 @@ elif expInfo['run'] == '1' and expInfo['session'] == 'nf':
 # trigger - timings are relative to this
 get_trigger()
 
-# Run each baseline fixation period & block
-for block_num in range(block_order.shape[0]):
-    run_fixation(8)
-    run_block(n_trials = 6, block_type = block_order.block_type[block_num], block_number = block_num)
-
-# Final fixation block at the end of the task
-run_fixation(8)
+# Run each baseline fixation period & block, and the final fixation block at the end of the task
+run_schedule(run_schedule_events)
 
 # At end, convert csv to bids-compliant tsv file
+event_writer.close()
 convert_sret_csv_to_bids(infile = filename+'_events.csv')
 
 
 # Shut down
-instruct_text.setText('Great job! You have finished this run')
-instruct_text.draw()
+instruction_stims[run_end_text].draw()
 win.flip()
 core.wait(3)
 win.close()
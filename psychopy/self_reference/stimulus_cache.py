@@ -0,0 +1,33 @@
+'''
+Prebuilt text stimuli for the SRET task
+
+PsychoPy renders a TextStim's text when the text (or bold/italic) is set, and uploads the
+texture on its first draw. Setting the text of a shared TextStim right before the flip that
+shows it therefore delays that flip. Instead, every text of a run gets its own TextStim,
+built during setup, and everything is drawn once off screen before the run starts.
+'''
+
+from psychopy import visual
+
+
+# Make a new TextStim that looks like the template (same window, font, position, size, color...)
+def copy_text_stim(template, text=None, **changes):
+    params = dict(win=template.win, name=template.name, text=template.text if text is None else text,
+                  font=template.font, pos=template.pos, height=template.height, wrapWidth=template.wrapWidth,
+                  ori=template.ori, color=template.color, colorSpace=template.colorSpace,
+                  opacity=template.opacity, depth=template.depth, bold=template.bold, italic=template.italic)
+    params.update(changes)
+    return visual.TextStim(**params)
+
+
+# Make one TextStim per distinct text, styled like the template -- returns a dict of text -> TextStim
+def build_text_stims(template, texts):
+    return {text: copy_text_stim(template, text) for text in dict.fromkeys(texts)}
+
+
+# Draw every stimulus once to the back buffer and clear it again without flipping,
+# so no texture is created or uploaded at a stimulus onset
+def warm_up(win, stims):
+    for stim in stims:
+        stim.draw()
+    win.clearBuffer()
@@ -0,0 +1,157 @@
+'''
+Word-order index of the SRET task
+
+word_list_splits/word_order_{participant_number}.csv holds the words of every run of a
+participant. Instead of reading and filtering that csv with pandas at startup, the task looks
+the run's words up in word_list_splits/word_order_index.sqlite, one table covering every
+participant, run and valence with (participant, run, valence, position) as its primary key.
+The index is built from the csv files on first use, and a participant's rows are rebuilt
+whenever their csv changed (size or modification time).
+
+It also checks that a run has exactly the words its timing template needs, so a mismatch is
+caught at startup rather than during the scan. Checking every participant and run:
+
+    python word_index.py
+'''
+
+import argparse
+import csv
+import glob
+import os
+import re
+import sqlite3
+import sys
+from collections import Counter, deque
+
+import numpy as np
+
+from pull_timings import load_timing_template
+from schedule import timing_template
+
+WORD_LIST_DIR = 'word_list_splits'
+INDEX_FILENAME = 'word_order_index.sqlite'
+VALENCES = {'+': 'positive', '-': 'negative'}
+
+WORD_ORDER_PATTERN = re.compile(r'^word_order_(\d+)\.csv$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (participant INTEGER PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS words (participant INTEGER, run INTEGER, valence TEXT, position INTEGER, word TEXT,
+                                  PRIMARY KEY (participant, run, valence, position)) WITHOUT ROWID;
+'''
+
+
+def word_order_file(participant_number, word_list_dir=WORD_LIST_DIR):
+    return os.path.join(word_list_dir, f'word_order_{participant_number}.csv')
+
+
+class WordIndex:
+    '''
+    Words of every participant and run, from the word order csv files
+
+    word_list_dir: folder of the word_order_{participant_number}.csv files (the index is kept there too)
+    '''
+
+    def __init__(self, word_list_dir=WORD_LIST_DIR):
+        self.word_list_dir = word_list_dir
+        self.connection = sqlite3.connect(os.path.join(word_list_dir, INDEX_FILENAME))
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def participants(self):
+        '''Participant numbers with a word order csv'''
+        names = (os.path.basename(path) for path in glob.glob(os.path.join(self.word_list_dir, 'word_order_*.csv')))
+        return sorted(int(match[1]) for match in map(WORD_ORDER_PATTERN.match, names) if match)
+
+    def _is_current(self, participant_number, stat):
+        row = self.connection.execute('SELECT mtime_ns, size FROM sources WHERE participant = ?',
+                                      (participant_number,)).fetchone()
+        return row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size
+
+    def _index(self, participant_number, stat):
+        '''(Re)build the rows of a participant from their csv'''
+        rows, positions = [], {}
+        with open(word_order_file(participant_number, self.word_list_dir), newline='') as f:
+            for record in csv.DictReader(f):
+                run, valence = int(record['run']), VALENCES[record['valence_condition']]
+                position = positions.get((run, valence), 0)
+                positions[(run, valence)] = position + 1
+                rows.append((participant_number, run, valence, position, record['word']))
+        with self.connection:
+            self.connection.execute('DELETE FROM words WHERE participant = ?', (participant_number,))
+            self.connection.executemany('INSERT INTO words VALUES (?, ?, ?, ?, ?)', rows)
+            self.connection.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)',
+                                    (participant_number, stat.st_mtime_ns, stat.st_size))
+
+    def update(self, participant_numbers=None):
+        '''Index the csv files that are new or changed since they were last indexed; returns how many were'''
+        updated = 0
+        for participant_number in self.participants() if participant_numbers is None else participant_numbers:
+            stat = os.stat(word_order_file(participant_number, self.word_list_dir))
+            if not self._is_current(participant_number, stat):
+                self._index(participant_number, stat)
+                updated += 1
+        return updated
+
+    def run_words(self, participant_number, run_num):
+        '''
+        Words of an internal run (1-4), in the order of the word order csv
+
+        returns (positive_words, negative_words), each a deque to be consumed from the left
+        '''
+        self.update([participant_number])
+        rows = self.connection.execute('SELECT valence, word FROM words WHERE participant = ? AND run = ? '
+                                       'ORDER BY valence, position', (participant_number, run_num)).fetchall()
+        words = {'positive': deque(), 'negative': deque()}
+        for valence, word in rows:
+            words[valence].append(word)
+        return words['positive'], words['negative']
+
+
+# Problems of a run's words (empty list if there are none): the run needs exactly one positive word
+# per positive onset of its timing template (pos) and one negative word per negative onset (neg)
+def check_run_words(positive_words, negative_words, pos, neg):
+    problems = []
+    for valence, words, onsets in [('positive', positive_words, pos), ('negative', negative_words, neg)]:
+        needed = np.size(onsets)
+        if len(words) != needed:
+            problems.append(f'{len(words)} {valence} words, the timing template needs {needed}')
+        duplicates = sorted(word for word, count in Counter(words).items() if count > 1)
+        if duplicates:
+            problems.append(f'{valence} words listed more than once: {", ".join(duplicates)}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the SRET word-order index and check every participant and '
+                                                 'run against its timing template')
+    parser.add_argument('--word-list-dir', default=WORD_LIST_DIR, help='Folder of the word_order_*.csv files')
+    args = parser.parse_args()
+
+    try:
+        index = WordIndex(args.word_list_dir)
+        print(f'{index.update()} word order file(s) indexed')
+        templates = {}
+        n_problems = 0
+        for participant_number in index.participants():
+            for run_num in range(1, 5):
+                template = timing_template(participant_number, run_num)
+                if template not in templates:
+                    templates[template] = load_timing_template(template)
+                problems = check_run_words(*index.run_words(participant_number, run_num), *templates[template])
+                n_problems += len(problems)
+                for problem in problems:
+                    print(f'participant {participant_number}, run {run_num}: {problem}')
+        index.close()
+        print(f'{n_problems} problem(s)')
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    if n_problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()